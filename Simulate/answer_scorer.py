@@ -0,0 +1,143 @@
+from collections import Counter
+from difflib import SequenceMatcher
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from prompt_templates import PROMPTS
+from response_parser import ANSWER_JUDGE
+
+# 选项字母：A / (B) / c. / Answer: D / option E，后面只能跟标点、空白或结尾
+OPTION_LETTER = (r"^(?:(?:the\s+)?(?:correct\s+)?(?:answer|option|choice)(?:\s+is)?\s*[:：]?\s*)?"
+                 r"[(\[（]?([a-h])(?:[)\]）.:：、,，]|\s|$)")
+OPTION_KEY = r"[(\[（]?([a-h])[)\]）.]?"
+PUNCTUATION = r"[^\w\s]"
+ARTICLES = r"\b(?:a|an|the)\b"
+
+
+def prepare(values):
+    """NFKC-normalized, case-folded, stripped strings; missing values become empty strings"""
+    return values.fillna("").astype(str).str.normalize("NFKC").str.casefold().str.strip()
+
+
+def normalize(values):
+    """prepare() with punctuation and English articles removed and whitespace collapsed, for token comparison"""
+    return (prepare(values).str.replace(PUNCTUATION, " ", regex=True).str.replace(ARTICLES, " ", regex=True)
+            .str.replace(r"\s+", " ", regex=True).str.strip())
+
+
+@lru_cache(maxsize=65536)
+def token_ratio(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def fuzzy_f1(answer, correct, token_similarity):
+    """
+    Token-overlap F1 of two normalized strings, where a token matches an unused token of the other
+    string when they are equal or their character similarity reaches `token_similarity` (typos).
+    """
+    answer_tokens = answer.split()
+    correct_tokens = correct.split()
+    if not answer_tokens or not correct_tokens:
+        return float(answer_tokens == correct_tokens)
+    unmatched = Counter(correct_tokens)
+    matched = 0
+    fuzzy = []
+    for token in answer_tokens:
+        if unmatched[token] > 0:
+            unmatched[token] -= 1
+            matched += 1
+        else:
+            fuzzy.append(token)
+    for token in fuzzy:
+        for candidate, left in unmatched.items():
+            if left > 0 and token_ratio(token, candidate) >= token_similarity:
+                unmatched[candidate] -= 1
+                matched += 1
+                break
+    if matched == 0:
+        return 0.0
+    precision = matched / len(answer_tokens)
+    recall = matched / len(correct_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+class LLMJudge:
+    """
+    Fallback grader for answers the local scorer cannot decide, on a test of `level`. Verdicts are
+    kept per (question, answer) for the process, and the LLM's ResponseCache (use temperature=0)
+    keeps them across runs, so every ambiguous answer is sent to the model at most once.
+    """
+
+    def __init__(self, llm, level="high school"):
+        self.llm = llm
+        self.level = level
+        self.verdicts = {}
+
+    def judge(self, questions, correct, answers):
+        """0/1 verdict per (question, correct answer, answer) triple"""
+        triples = list(zip(questions, correct, answers))
+        pending = list(dict.fromkeys(t for t in triples if (t[0], t[2]) not in self.verdicts))
+        if pending:
+            prompts = [
+                [{"role": "user", "content": PROMPTS.render("answer_judge", level=self.level, question=q, correct_answer=c, answer=a)}]
+                for q, c, a in pending
+            ]
+            replies = self.llm.batch_chat(prompts, return_exceptions=True)
+            for (question, _, answer), reply in zip(pending, replies):
+                if isinstance(reply, Exception):
+                    print(f"[Judge] 判定失败，按答错计: {reply!r}")
+                    continue
+                self.verdicts[(question, answer)] = ANSWER_JUDGE.parse(reply).values["verdict"] == "correct"
+        return np.array([self.verdicts.get((q, a), False) for q, _, a in triples], dtype=bool)
+
+
+class AnswerScorer:
+    """
+    Local 0/1 scoring of test answers against correct_answer, for multiple-choice and fill-in-the-blank.
+    A correct answer that is an option letter is compared with the letter extracted from the answer.
+    Anything else is compared by fuzzy token F1 of the normalized texts: at least `accept` is correct,
+    below `reject` is wrong, and the band in between goes to `judge` (an LLMJudge) when one is given,
+    otherwise it is wrong. Similarities are computed once per distinct (answer, correct answer) pair,
+    so a whole grid is scored in one pass.
+    """
+
+    def __init__(self, accept=0.8, reject=0.5, token_similarity=0.85, judge=None):
+        self.accept = accept
+        self.reject = reject
+        self.token_similarity = token_similarity
+        self.judge = judge
+
+    def fingerprint(self):
+        """Settings that change scores, to tell when stored scores are stale"""
+        judge = "llm" if self.judge is not None else "none"
+        return f"accept={self.accept},reject={self.reject},token={self.token_similarity},judge={judge}"
+
+    def similarity(self, answers, correct):
+        """Fuzzy token F1 of each answer against its correct answer, in [0, 1]"""
+        pairs = pd.DataFrame({"answer": normalize(answers).to_numpy(), "correct": normalize(correct).to_numpy()})
+        unique = pairs.drop_duplicates(ignore_index=True)
+        unique["f1"] = [fuzzy_f1(a, c, self.token_similarity) for a, c in zip(unique["answer"], unique["correct"])]
+        return pairs.merge(unique, on=["answer", "correct"], how="left")["f1"].to_numpy()
+
+    def score(self, answers, correct, questions=None):
+        """0/1 correctness as floats; `questions` (question texts) is only needed by the judge"""
+        answers = pd.Series(answers).reset_index(drop=True)
+        correct = pd.Series(correct).reset_index(drop=True)
+        prepared = prepare(correct)
+        key = prepared.str.extract(f"^{OPTION_KEY}$", expand=False)
+        is_option = key.notna().to_numpy()
+        letters = prepare(answers).str.extract(OPTION_LETTER, expand=False)
+        matched = (letters == key).to_numpy() & is_option
+
+        free = ~is_option & (prepared != "").to_numpy()
+        if free.any():
+            similarity = self.similarity(answers[free], correct[free])
+            accepted = similarity >= self.accept
+            ambiguous = (similarity >= self.reject) & ~accepted
+            if self.judge is not None and questions is not None and ambiguous.any():
+                questions = pd.Series(questions).reset_index(drop=True)[free][ambiguous]
+                accepted[ambiguous] = self.judge.judge(
+                    questions.fillna("").astype(str), correct[free][ambiguous], answers[free][ambiguous].fillna("").astype(str)
+                )
+            matched[free] = accepted
+        return matched.astype(float)
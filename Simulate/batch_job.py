@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+from llm_respond import ChatResult, LLMCallError, BudgetExceeded, cached_prompt_tokens, log_message
+
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchJob:
+    """
+    Run a whole stage through the OpenAI Batch API: write the requests as JSONL,
+    submit them, poll until the batch finishes and map replies back by custom_id.
+    The batch id is saved in `work_dir` with a fingerprint of the requests, so a restarted run
+    re-attaches instead of resubmitting, but only to a batch built from exactly the same requests.
+    """
+
+    def __init__(self, llm, name, work_dir="batch_jobs", poll_interval=30, completion_window="24h"):
+        self.llm = llm
+        self.name = name
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        os.makedirs(work_dir, exist_ok=True)
+        self.input_path = os.path.join(work_dir, f"{name}_input.jsonl")
+        self.state_path = os.path.join(work_dir, f"{name}_state.json")
+
+    @property
+    def client(self):
+        return self.llm.pool.client
+
+    def build_request(self, custom_id, messages):
+        """One JSONL line of the batch input file"""
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.llm.model,
+                "messages": messages,
+                "temperature": self.llm.temperature,
+                "max_tokens": self.llm.max_tokens
+            }
+        }
+
+    def fingerprint(self, prompts):
+        """Hash of every request body (model, sampling settings and messages) by custom_id"""
+        requests = {custom_id: self.build_request(custom_id, messages)["body"] for custom_id, messages in prompts.items()}
+        return hashlib.sha256(json.dumps(requests, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+    def submit(self, prompts):
+        """Upload {custom_id: messages} as a batch and return its id"""
+        with open(self.input_path, "w", encoding="utf-8") as f:
+            for custom_id, messages in prompts.items():
+                f.write(json.dumps(self.build_request(custom_id, messages), ensure_ascii=False) + "\n")
+
+        with open(self.input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window
+        )
+        self.save_state({"batch_id": batch.id, "custom_ids": sorted(prompts), "fingerprint": self.fingerprint(prompts)})
+        return batch.id
+
+    def wait(self, batch_id):
+        """Poll until the batch reaches a final status"""
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in FINAL_STATUSES:
+                return batch
+            counts = batch.request_counts
+            done = f"{counts.completed + counts.failed}/{counts.total}" if counts else "?"
+            print(f"批处理 {self.name} 状态: {batch.status} ({done})")
+            time.sleep(self.poll_interval)
+
+    def collect(self, batch):
+        """Return {custom_id: ChatResult} for every request that succeeded"""
+        replies = {}
+        if not batch.output_file_id:
+            return replies
+        content = self.client.files.content(batch.output_file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if record.get("error") or response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            reply = body["choices"][0]["message"]["content"] or ""
+            usage = body.get("usage") or {}
+            log_message(
+                "assistant", reply,
+                model=self.llm.model,
+                batch=batch.id,
+                row=record["custom_id"],
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+                cached_tokens=cached_prompt_tokens(usage)
+            )
+            # 批处理没有单条请求的耗时
+            replies[record["custom_id"]] = ChatResult(
+                reply, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), None, False,
+                cached_prompt_tokens(usage)
+            )
+        return replies
+
+    def run(self, prompts):
+        """Submit (or re-attach to) the batch for these prompts and return the replies"""
+        state = self.load_state()
+        # 提示词版本、模型或采样参数变了的旧批处理不能复用
+        if (state is not None and state["custom_ids"] == sorted(prompts)
+                and state.get("fingerprint") == self.fingerprint(prompts)):
+            batch_id = state["batch_id"]
+            print(f"继续等待已提交的批处理 {batch_id}")
+        else:
+            batch_id = self.submit(prompts)
+            print(f"已提交批处理 {batch_id}，共 {len(prompts)} 条请求")
+
+        batch = self.wait(batch_id)
+        replies = self.collect(batch)
+        if batch.status != "completed" or len(replies) < len(prompts):
+            print(f"批处理 {batch_id} 状态 {batch.status}，{len(prompts) - len(replies)} 条请求未成功，重跑时会重新提交")
+        os.remove(self.state_path)
+        return replies
+
+
+def reserve_budget(llm, prompts):
+    """
+    Reserve the worst case of every request in the pool's TokenBudget (if any) and return the
+    reservations by custom_id; raises BudgetExceeded, holding nothing, when they do not all fit.
+    """
+    reservations = {}
+    try:
+        for custom_id, messages in prompts.items():
+            reservations[custom_id] = llm._reserve_budget(llm.estimate_tokens(messages))
+    except BudgetExceeded:
+        for reservation in reservations.values():
+            llm._settle_budget(reservation, None)
+        raise
+    return reservations
+
+
+def run_batch_rows(rows, llm, build_func, parse_func, job_name, work_dir="batch_jobs", poll_interval=30):
+    """
+    Resolve a stage's rows through one batch job and return (row, ChatResult or None, LLMCallError or None)
+    triples in input order. Rows that need no LLM call or hit the cache are resolved locally.
+    Requests are identified by the row's position in the batch, so replies map back to the right
+    row whatever its lecture and question values are.
+    """
+    rows = list(rows)
+    # lecture/question 可能含 "-" 或重复，不能拼成 custom_id
+    custom_ids = [f"row-{i}" for i in range(len(rows))]
+    prompts = {}
+    replies = {}
+    for custom_id, row in zip(custom_ids, rows):
+        prompt = build_func(row)
+        if prompt is None:
+            continue
+        _, cached = llm._cache_lookup(prompt)
+        if cached is not None:
+            replies[custom_id] = ChatResult(cached, 0, 0, 0.0, True)
+        else:
+            prompts[custom_id] = prompt
+
+    if prompts:
+        job = BatchJob(llm, job_name, work_dir=work_dir, poll_interval=poll_interval)
+        # 整个阶段一次提交：提交前占用全部请求的预算，放不下就一条也不提交
+        reservations = reserve_budget(llm, prompts)
+        fresh = {}
+        try:
+            fresh = job.run(prompts)
+        finally:
+            for custom_id, reservation in reservations.items():
+                llm._settle_budget(reservation, fresh.get(custom_id))
+        if llm.cache is not None:
+            for custom_id, result in fresh.items():
+                llm.cache.put(llm.request_key(prompts[custom_id]), result.reply)
+        replies.update(fresh)
+
+    finished = []
+    for custom_id, row in zip(custom_ids, rows):
+        result = replies.get(custom_id)
+        if result is not None:
+            row.update(parse_func(row, result.reply))
+        elif custom_id in prompts:
+            finished.append((row, None, LLMCallError(f"batch request for lecture {row['lecture']}, question {row['question']} failed")))
+            continue
+        else:
+            row.update(parse_func(row, None))
+        finished.append((row, result, None))
+    return finished
@@ -0,0 +1,273 @@
+import io
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import shutil
+import asyncio
+import platform
+import tempfile
+import datetime
+import subprocess
+import contextlib
+import multiprocessing as mp
+from mock_server import MockLLMServer, LatencyModel
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+SCENARIOS = ["school", "social", "parent"]
+# 与基线比较的指标，以及数值变大是变好 ("higher") 还是变差 ("lower")
+COMPARED = {
+    "rows_per_sec": "higher",
+    "latency_p50": "lower",
+    "latency_p95": "lower",
+    "latency_p99": "lower",
+    "cpu_ms_per_row": "lower",
+    "peak_rss_mb": "lower"
+}
+PARENT_SES = ["low", "middle", "high"]
+PARENT_ABILITY = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers, None when it is empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def prepare_data(data_path, work_dir, limit=None):
+    """Copy the slide JSON and the first `limit` test questions into work_dir, so runs have a fixed size"""
+    shutil.copy(data_path + "high_school_slide_only.json", work_dir)
+    with open(data_path + "high_school_test_only.csv", "r", encoding="utf-8") as src, \
+            open(os.path.join(work_dir, "high_school_test_only.csv"), "w", newline="", encoding="utf-8") as dst:
+        reader = csv.DictReader(src)
+        writer = csv.DictWriter(dst, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for i, row in enumerate(reader):
+            if limit is not None and i >= limit:
+                break
+            writer.writerow(row)
+    return work_dir + os.sep
+
+
+def call_latencies(log_path):
+    """Per-call latency (seconds) of every reply in a conversation log"""
+    latencies = []
+    if os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("role") == "assistant" and record.get("latency") is not None:
+                    latencies.append(record["latency"])
+    return latencies
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where it cannot be read"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss 在 Linux 上以 KB 为单位，在 macOS 上以字节为单位
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return round(counters.PeakWorkingSetSize / (1024 * 1024), 1)
+    return None
+
+
+def prepare_social(concurrency, api_base, data_dir, work_dir):
+    """
+    Write the school post-test results the social pipeline reads, in a process of its own so that
+    this untimed run adds nothing to the CPU time or peak RSS of the measured social run.
+    """
+    from llm_respond import configure_conversation_log
+    from school_test import StudentSchoolTestPipeline
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        configure_conversation_log(enabled=False)
+        StudentSchoolTestPipeline(ses="low", performance="50", model="gpt-4.1-mini", concurrency=concurrency, api_base=api_base,
+                                  progress=False, data_path=data_dir, base_path=work_dir + os.sep).run_pipeline()
+    shutil.copy(data_dir + "high_school_slide_only.json", work_dir)
+
+
+def run_scenario(scenario, concurrency, api_base, data_dir, work_dir, results):
+    """
+    One measured run in a fresh process (so CPU time and peak RSS belong to this run alone).
+    The mock server runs in another process, so the CPU time here is the pipeline's own work:
+    prompt building, the HTTP client, parsing and CSV I/O, but no time spent waiting on replies.
+    """
+    from llm_respond import LLM, configure_conversation_log
+    from school_test import StudentSchoolTestPipeline
+    from social_test import StudentSocialTestPipeline
+    from parent_rec import recommend_resources
+
+    base_path = work_dir + os.sep
+    common = {"model": "gpt-4.1-mini", "concurrency": concurrency, "api_base": api_base, "progress": False}
+    log_path = os.path.join(work_dir, "conversation_log.jsonl")
+    with contextlib.redirect_stdout(io.StringIO()):
+        logger = configure_conversation_log(path=log_path)
+
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        if scenario == "school":
+            pipeline = StudentSchoolTestPipeline(ses="low", performance="50", data_path=data_dir, base_path=base_path, **common)
+            rows = pipeline.expected_rows()
+            pipeline.run_pipeline()
+        elif scenario == "social":
+            pipeline = StudentSocialTestPipeline(ses="low", performance="50", number=3, quality="medium", base_path=base_path, **common)
+            rows = pipeline.expected_rows()
+            pipeline.run_pipeline()
+        else:
+            agent = LLM(model="gpt-4.1-mini", temperature=0, max_tokens=512, concurrency=concurrency, api_base=api_base)
+            rows = len(PARENT_SES) * len(PARENT_ABILITY)
+            recommend_resources(agent, PARENT_SES, PARENT_ABILITY)
+            agent.close()
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        logger.close()
+
+    latencies = call_latencies(log_path)
+    results.put({
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "rows": rows,
+        "calls": len(latencies),
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds, 2) if seconds > 0 else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_ms_per_row": round(1000 * cpu_seconds / rows, 3) if rows else None,
+        "peak_rss_mb": peak_rss_mb()
+    })
+
+
+def serve_mock(settings, urls):
+    server = MockLLMServer(**settings)
+    asyncio.run(server.serve(ready=urls.put))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(data_path, scenarios=SCENARIOS, concurrencies=(1, 8, 32), limit=50, mock=None, output="benchmark_results.json"):
+    """
+    Run every scenario at every concurrency against a mock server in its own process and write the
+    results, with the commit and settings they were measured on, to `output` as JSON.
+    `mock` holds MockLLMServer arguments; by default replies take a fixed 0.2 s.
+    """
+    mock = mock or {"latency": LatencyModel("fixed", seconds=0.2)}
+    context = mp.get_context("spawn")
+    urls = context.Queue()
+    server = context.Process(target=serve_mock, args=(mock, urls), daemon=True)
+    server.start()
+    data_dir = tempfile.mkdtemp(prefix="bench_data_")
+    results = []
+    try:
+        api_base = urls.get(timeout=30)
+        data_dir = prepare_data(data_path, data_dir, limit)
+        for scenario in scenarios:
+            for concurrency in concurrencies:
+                work_dir = tempfile.mkdtemp(prefix=f"bench_{scenario}_")
+                try:
+                    result = None
+                    if scenario == "social":
+                        # 社会老师流水线的输入是学校流水线的后测试结果，在另一个进程里先生成（不计时）
+                        prepare = context.Process(target=prepare_social, args=(concurrency, api_base, data_dir, work_dir))
+                        prepare.start()
+                        prepare.join()
+                        if prepare.exitcode:
+                            result = {"scenario": scenario, "concurrency": concurrency, "error": f"prepare exit code {prepare.exitcode}"}
+                    if result is None:
+                        outbox = context.Queue()
+                        worker = context.Process(target=run_scenario, args=(scenario, concurrency, api_base, data_dir, work_dir, outbox))
+                        worker.start()
+                        try:
+                            result = outbox.get(timeout=3600)
+                        except queue.Empty:
+                            result = {"scenario": scenario, "concurrency": concurrency, "error": "no result"}
+                        worker.join()
+                        if worker.exitcode:
+                            result = {"scenario": scenario, "concurrency": concurrency, "error": f"exit code {worker.exitcode}"}
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                print(f"[Benchmark] {json.dumps(result, ensure_ascii=False)}")
+                results.append(result)
+    finally:
+        server.terminate()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"limit": limit, "mock": {name: vars(value) if isinstance(value, LatencyModel) else value
+                                               for name, value in mock.items()}},
+        "results": results
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Metrics of `current` that are more than `tolerance` worse than in `baseline` (two reports or
+    paths to them), matched by (scenario, concurrency); returns a list of readable lines.
+    """
+    reports = []
+    for report in (baseline, current):
+        if isinstance(report, str):
+            with open(report, "r", encoding="utf-8") as f:
+                report = json.load(f)
+        reports.append({(r["scenario"], r["concurrency"]): r for r in report["results"] if "error" not in r})
+    before, after = reports
+    regressions = []
+    for key in sorted(before.keys() & after.keys()):
+        for metric, better in COMPARED.items():
+            old, new = before[key].get(metric), after[key].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (better == "higher" and change < -tolerance) or (better == "lower" and change > tolerance):
+                regressions.append(f"{key[0]} (concurrency {key[1]}) {metric}: {old} → {new} ({change:+.1%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    data_path = "" # Adjust base path you create for dataset
+    output = "benchmark_results.json"
+    baseline = None  # 例如上一次提交的 benchmark_results.json，给出时列出变差超过 10% 的指标
+
+    run_benchmark(data_path, concurrencies=(1, 8, 32), limit=50, output=output,
+                  mock={"latency": LatencyModel("lognormal", median=0.2, sigma=0.3), "seed": 0})
+    if baseline:
+        regressions = compare(baseline, output)
+        print("\n".join(regressions) if regressions else "没有发现性能回退")
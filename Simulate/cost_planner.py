@@ -0,0 +1,237 @@
+import os
+import csv
+import glob
+import random
+from llm_respond import ClientPool, request_cost
+from mock_server import canned_reply
+from slide_index import SlideIndex
+from stage_executor import open_input, read_index
+
+# 每条消息的格式开销和回复前缀（按 OpenAI 的 chat 计数方法）
+MESSAGE_OVERHEAD = 3
+REPLY_OVERHEAD = 3
+# 服务端前缀缓存：提示词至少 1024 tokens 才缓存，命中部分按 128 tokens 取整
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK = 128
+DEFAULT_LATENCY = 3.0
+
+
+def token_counter(model):
+    """
+    count(text) -> tokens, with tiktoken's encoding for `model` when tiktoken is installed and the
+    ~4 characters per token rule of LLM.estimate_tokens otherwise.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return lambda text: (len(text) + 3) // 4
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class PromptCounter:
+    """
+    Prompt tokens of chat requests, and how many of them the provider's prefix cache would serve
+    given the requests counted before (messages identical from the start, as the prompts are layered).
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.seen = set()
+        self._tokens = {}
+
+    def message_tokens(self, message):
+        content = message["content"]
+        tokens = self._tokens.get(content)
+        if tokens is None:
+            tokens = self._tokens[content] = self.count(content)
+        return MESSAGE_OVERHEAD + tokens
+
+    def __call__(self, messages):
+        """(prompt tokens, cached tokens) of a request"""
+        total = REPLY_OVERHEAD
+        prefix = None
+        cached = 0
+        hit = True
+        for message in messages:
+            total += self.message_tokens(message)
+            prefix = hash((prefix, message["role"], message["content"]))
+            if hit and prefix in self.seen:
+                cached = total
+            else:
+                hit = False
+                self.seen.add(prefix)
+        if cached < CACHE_MIN_TOKENS:
+            cached = 0
+        return total, cached // CACHE_BLOCK * CACHE_BLOCK
+
+
+def usage_history(pipeline):
+    """
+    {stage: (mean completion tokens, mean latency)} over the calls logged in the usage CSVs of
+    earlier runs of the same kind of pipeline, for stages with any.
+    """
+    pattern = pipeline.usage_file.replace(f"_{pipeline.ses}_{pipeline.performance}.csv", "_*.csv")
+    sums = {}
+    for path in glob.glob(pattern):
+        with open(path, "r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                if row.get("cached") != "0" or not row.get("latency"):
+                    continue
+                totals = sums.setdefault(row["stage"], [0, 0, 0.0])
+                totals[0] += 1
+                totals[1] += int(row["completion_tokens"])
+                totals[2] += float(row["latency"])
+    return {stage: (tokens / calls, latency / calls) for stage, (calls, tokens, latency) in sums.items()}
+
+
+def plan_pipeline(pipeline, prompts, input_rows=None, rng=None):
+    """
+    Dry run of one cell: build every prompt its stages would send for rows not yet committed and
+    count their tokens, without calling the LLM. Replies that later stages depend on are stand-ins
+    from mock_server.canned_reply. `input_rows` replaces the first stage's input (e.g. the final
+    rows of the school plan for a social cell). Returns ({stage: counts}, final rows), or
+    (None, None) when the first stage's input does not exist.
+    """
+    rng = rng or random.Random(0)
+    stages = pipeline.stages()
+    infile = None
+    if input_rows is None:
+        first = stages[0][0]
+        if isinstance(first, str) and not os.path.exists(first):
+            return None, None
+        _, input_rows, infile = open_input(first)
+
+    counts = {}
+    done = {}
+    for _, output_file, llm, _, _, _, stage_name in stages:
+        counts[stage_name] = {"rows": 0, "calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "max_tokens": llm.max_tokens}
+        index = output_file + ".done"
+        done[stage_name] = read_index(index)[0] if os.path.exists(index) else set()
+
+    final_rows = []
+    try:
+        for row in input_rows:
+            row = dict(row)
+            key = (row["lecture"], row["question"])
+            for _, _, _, build_func, parse_func, _, stage_name in stages:
+                row["ses"] = pipeline.ses
+                row["performance"] = pipeline.performance
+                prompt = build_func(row)
+                stage = counts[stage_name]
+                stage["rows"] += 1
+                if prompt is not None and key not in done[stage_name]:
+                    prompt_tokens, cached_tokens = prompts(prompt)
+                    stage["calls"] += 1
+                    stage["prompt_tokens"] += prompt_tokens
+                    stage["cached_tokens"] += cached_tokens
+                row.update(parse_func(row, canned_reply(prompt, rng) if prompt is not None else None))
+            final_rows.append(row)
+    finally:
+        if infile is not None:
+            infile.close()
+    return counts, final_rows
+
+
+def estimate_seconds(calls, tokens, concurrency, latency, rpm=None, tpm=None):
+    """Wall time of `calls` requests: whichever of the concurrency, RPM and TPM limits is slowest"""
+    return max(calls * latency / concurrency, calls * 60 / rpm if rpm else 0.0, tokens * 60 / tpm if tpm else 0.0)
+
+
+def plan_sweep(runner, inputs=None, latency=None, seed=0):
+    """
+    Dry run of a SweepRunner: plan_pipeline for every cell, then expected output tokens, cost at
+    PRICING and wall time at the runner's concurrency, RPM and TPM.
+
+    Output tokens and latency per call are the means of earlier runs' usage CSVs when there are any;
+    otherwise output is max_tokens (an upper bound) and latency `latency` or DEFAULT_LATENCY.
+    `inputs` maps (ses, performance) to first-stage rows, e.g. plan_sweep(social_runner,
+    inputs=school_plan["rows"]) before the school sweep has produced its post-test files.
+    """
+    # 干跑不发请求，连接池只用来构造 LLM，不需要 API key
+    pool = ClientPool(None, concurrency=runner.concurrency)
+    slide_index = SlideIndex.from_file(runner.slide_file) if runner.slide_file and runner.dataset is None else None
+    shared = {
+        "model": runner.model,
+        "pool": pool,
+        "cache": None,
+        "slide_index": slide_index,
+        "result_store": None,
+        "dataset": runner.dataset,
+        "concurrency": runner.concurrency,
+        "progress": False,
+        "on_row": None
+    }
+    prompts = PromptCounter(token_counter(runner.model))
+    rng = random.Random(seed)
+    plan = {"cells": {}, "rows": {}, "missing": [], "stages": {}}
+    history = {}
+    for ses, performance in runner.cells():
+        pipeline = runner.make_pipeline(ses, performance, **shared)
+        if pipeline is None:
+            continue
+        cell = (str(ses), str(performance))
+        input_rows = inputs.get(cell) if inputs is not None else None
+        if inputs is not None and input_rows is None:
+            plan["missing"].append(cell)
+            continue
+        counts, rows = plan_pipeline(pipeline, prompts, input_rows, rng)
+        if counts is None:
+            plan["missing"].append(cell)
+            continue
+        if not history:
+            history = usage_history(pipeline)
+        for stage_name, stage in counts.items():
+            output_tokens, call_latency = history.get(stage_name, (stage["max_tokens"], latency or DEFAULT_LATENCY))
+            stage["output_tokens"] = round(stage["calls"] * output_tokens)
+            stage["latency"] = call_latency
+            stage["output_source"] = "usage" if stage_name in history else "max_tokens"
+        plan["cells"][cell] = counts
+        plan["rows"][cell] = rows
+
+    for counts in plan["cells"].values():
+        for stage_name, stage in counts.items():
+            totals = plan["stages"].setdefault(stage_name, {
+                "calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0,
+                "latency": stage["latency"], "output_source": stage["output_source"]
+            })
+            for field in ("calls", "prompt_tokens", "cached_tokens", "output_tokens"):
+                totals[field] += stage[field]
+    for totals in plan["stages"].values():
+        totals["cost"] = request_cost(runner.model, totals["prompt_tokens"], totals["output_tokens"], totals["cached_tokens"])
+
+    stages = plan["stages"].values()
+    calls = sum(s["calls"] for s in stages)
+    total = {
+        "calls": calls,
+        "prompt_tokens": sum(s["prompt_tokens"] for s in stages),
+        "cached_tokens": sum(s["cached_tokens"] for s in stages),
+        "output_tokens": sum(s["output_tokens"] for s in stages),
+        "cost": sum(s["cost"] for s in stages)
+    }
+    mean_latency = sum(s["calls"] * s["latency"] for s in stages) / calls if calls else 0.0
+    total["seconds"] = estimate_seconds(calls, total["prompt_tokens"] + total["output_tokens"],
+                                        runner.concurrency, mean_latency, runner.rpm, runner.tpm)
+    plan["total"] = total
+    return plan
+
+
+def format_plan(plan):
+    """Readable lines of a plan_sweep result"""
+    lines = []
+    for stage_name, s in plan["stages"].items():
+        source = "历史均值" if s["output_source"] == "usage" else "max_tokens 上限"
+        lines.append(f"{stage_name}: {s['calls']} 次调用, 输入 {s['prompt_tokens']} tokens "
+                     f"(预计前缀缓存命中 {s['cached_tokens']}), 输出约 {s['output_tokens']} tokens ({source}), "
+                     f"约 ${s['cost']:.4f}")
+    total = plan["total"]
+    lines.append(f"合计: {len(plan['cells'])} 个单元, {total['calls']} 次调用, "
+                 f"输入 {total['prompt_tokens']} tokens, 输出约 {total['output_tokens']} tokens, "
+                 f"约 ${total['cost']:.4f}, 预计耗时 {total['seconds'] / 60:.1f} 分钟")
+    if plan["missing"]:
+        cells = ", ".join(f"{ses}_{performance}" for ses, performance in plan["missing"])
+        lines.append(f"缺少输入、未计入的单元: {cells}")
+    return lines
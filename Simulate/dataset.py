@@ -0,0 +1,170 @@
+import os
+import csv
+import json
+import mmap
+import struct
+from slide_index import SlideIndex
+
+MAGIC = b"RSDSET1\n"
+HEADER = struct.Struct("<Q")
+TEST_FIELDS = ["lecture", "question", "contents", "slide", "correct_answer"]
+
+
+def level_prefix(level):
+    """File name prefix of a level ("high school" -> high_school), as written by preproecess/preprocess.py"""
+    return level.replace(" ", "_")
+
+
+def source_files(data_path, level):
+    return (data_path + f"{level_prefix(level)}_slide_only.json",
+            data_path + f"{level_prefix(level)}_test_only.csv")
+
+
+class TestRows:
+    """
+    The test questions of one level in CSV order, as rows identical to those of <level>_test_only.csv.
+    Pipelines accept it in place of the CSV path of their first stage.
+    """
+
+    def __init__(self, dataset, level):
+        self.dataset = dataset
+        self.level = level
+        self.fieldnames = TEST_FIELDS
+        self.name = f"{level_prefix(level)}_test_only.csv"
+        self.spans = dataset.index["levels"][level]["tests"]
+
+    def __len__(self):
+        return len(self.spans)
+
+    def __iter__(self):
+        for offset, length in self.spans:
+            yield dict(zip(TEST_FIELDS, self.dataset.decode(offset, length)))
+
+
+class Dataset:
+    """
+    Read-only, memory-mapped cache of the ClassroomSimulacra levels produced by preproecess/preprocess.py.
+    The file holds a JSON index of byte spans followed by the UTF-8 JSON of every slide and test row,
+    so opening it reads only the index and each lookup decodes one entry. Worker processes open the
+    same file and share its pages through the OS; a handle pickles as its path.
+
+    Lookups use the lecture and question numbers of the test CSV: question(level, lecture, question)
+    and slide(level, lecture, "slide N").
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} 不是数据集缓存文件")
+        (index_length,) = HEADER.unpack_from(self._map, len(MAGIC))
+        self.data_start = len(MAGIC) + HEADER.size + index_length
+        self.index = json.loads(self._map[len(MAGIC) + HEADER.size:self.data_start].decode("utf-8"))
+        self._slide_indexes = {}
+
+    @classmethod
+    def build(cls, path, data_path, levels):
+        """Write the cache of `levels` from their <level>_slide_only.json and <level>_test_only.csv"""
+        blob = bytearray()
+
+        def append(value):
+            data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            blob.extend(data)
+            return [len(blob) - len(data), len(data)]
+
+        index = {"sources": {}, "levels": {}}
+        for level in levels:
+            slide_file, test_file = source_files(data_path, level)
+            with open(slide_file, "r", encoding="utf-8") as f:
+                slides_data = json.load(f)
+            lectures = {}
+            for lecture_key, lecture_data in slides_data.items():
+                lectures[lecture_key] = {name: append(content) for name, content in (lecture_data or {}).items()}
+            tests = []
+            questions = {}
+            with open(test_file, "r", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    span = append([row[field] for field in TEST_FIELDS])
+                    tests.append(span)
+                    questions.setdefault(f"{row['lecture']}\t{row['question']}", span)
+            index["levels"][level] = {"lectures": lectures, "tests": tests, "questions": questions}
+            for source in (slide_file, test_file):
+                stat = os.stat(source)
+                index["sources"][os.path.abspath(source)] = [stat.st_size, stat.st_mtime_ns]
+
+        header = json.dumps(index, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with open(path + ".tmp", "wb") as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(len(header)))
+            f.write(header)
+            f.write(blob)
+        os.replace(path + ".tmp", path)
+        return cls(path)
+
+    @classmethod
+    def load(cls, path, data_path, levels):
+        """Open the cache at `path`, rebuilding it when a level is missing or a source file changed"""
+        if os.path.exists(path):
+            dataset = cls(path)
+            if dataset.is_fresh(data_path, levels):
+                return dataset
+            dataset.close()
+        return cls.build(path, data_path, levels)
+
+    def is_fresh(self, data_path, levels):
+        for level in levels:
+            if level not in self.index["levels"]:
+                return False
+            for source in source_files(data_path, level):
+                expected = self.index["sources"].get(os.path.abspath(source))
+                if not os.path.exists(source) or expected is None:
+                    return False
+                stat = os.stat(source)
+                if [stat.st_size, stat.st_mtime_ns] != expected:
+                    return False
+        return True
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def decode(self, offset, length):
+        start = self.data_start + offset
+        return json.loads(self._map[start:start + length].decode("utf-8"))
+
+    def levels(self):
+        return list(self.index["levels"])
+
+    def tests(self, level):
+        """All test rows of a level, usable as the input of a pipeline's first stage"""
+        return TestRows(self, level)
+
+    def question(self, level, lecture, question):
+        """Test row of a question, or None"""
+        span = self.index["levels"][level]["questions"].get(f"{lecture}\t{question}")
+        return dict(zip(TEST_FIELDS, self.decode(*span))) if span is not None else None
+
+    def slide(self, level, lecture, slide):
+        """Content of a slide such as "slide 3", or None"""
+        span = self.index["levels"][level]["lectures"].get(f"lecture {lecture}", {}).get(slide)
+        return self.decode(*span) if span is not None else None
+
+    def slides_data(self, level):
+        """{lecture key: {slide name: content}} of a level, as in <level>_slide_only.json"""
+        return {
+            lecture_key: {name: self.decode(*span) for name, span in slides.items()}
+            for lecture_key, slides in self.index["levels"][level]["lectures"].items()
+        }
+
+    def slide_index(self, level):
+        """SlideIndex of a level, built once per handle and shared by every pipeline using it"""
+        if level not in self._slide_indexes:
+            self._slide_indexes[level] = SlideIndex(self.slides_data(level))
+        return self._slide_indexes[level]
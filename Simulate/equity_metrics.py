@@ -0,0 +1,250 @@
+import os
+import glob
+import sqlite3
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+from answer_scorer import AnswerScorer, prepare
+
+KEYS = ["ses", "performance", "lecture", "question"]
+SES_ORDER = ["low", "middle", "high"]
+# 每行的指标：答对与否（0/1）、相对初始测试的提升（-1/0/1）以及老师是否推荐了材料
+METRICS = ["pre_correct", "post_correct", "society_correct", "teacher_gain", "society_gain", "recommended"]
+# 计数列：社会老师的两个指标只在有社会老师结果的行上计算
+COUNTS = ["n", "society_n"]
+DENOMINATORS = {metric: "society_n" if metric.startswith("society") else "n" for metric in METRICS}
+# 初始测试 / 后测试答对情况的四格计数
+TALLIES = ["pre0_post0", "pre0_post1", "pre1_post0", "pre1_post1"]
+SCHOOL_PREFIX = "post_with_llm"
+SOCIETY_PREFIX = "paren_teacher_post_with_llm"
+# 按 SES 比较的差距：推荐率体现“区别对待”（Contextual Fairness），成绩和提升体现结果是否公平（Equitable Outcomes）
+GAP_METRICS = ["recommended", "post_correct", "teacher_gain", "society_correct", "society_gain"]
+
+
+def read_outputs(base_path, prefix):
+    """All <prefix>_{ses}_{performance}.csv under base_path as one frame of strings"""
+    frames = [pd.read_csv(path, dtype=str, keep_default_na=False)
+              for path in sorted(glob.glob(os.path.join(base_path, f"{prefix}_*.csv")))]
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def score(school, society=None, scorer=None):
+    """
+    Per-row metrics of school post-test rows (post_with_llm_*), joined with the society post-test
+    answers (paren_teacher_post_with_llm_*) where those exist, scored against correct_answer
+    by `scorer` (an AnswerScorer; the default one never calls an LLM).
+    """
+    scorer = scorer or AnswerScorer()
+    if society is not None:
+        school = school.merge(society[KEYS + ["parent_post_llm_answer"]], on=KEYS, how="left")
+    else:
+        school = school.assign(parent_post_llm_answer=np.nan)
+
+    scored = school[KEYS].copy()
+    questions = school["contents"] if "contents" in school else None
+    scored["pre_correct"] = scorer.score(school["llm_answer"], school["correct_answer"], questions)
+    scored["post_correct"] = scorer.score(school["post_llm_answer"], school["correct_answer"], questions)
+    society_correct = scorer.score(school["parent_post_llm_answer"], school["correct_answer"], questions)
+    # 没有社会老师结果的行记为缺失，不当作答错
+    scored["society_correct"] = np.where(school["parent_post_llm_answer"].isna(), np.nan, society_correct)
+    scored["teacher_gain"] = scored["post_correct"] - scored["pre_correct"]
+    scored["society_gain"] = scored["society_correct"] - scored["pre_correct"]
+    scored["recommended"] = (prepare(school["whether"]) == "yes").to_numpy().astype(float)
+    scored["performance"] = pd.to_numeric(scored["performance"])
+    return scored
+
+
+def load_results(base_path, scorer=None):
+    """Scored rows of every cell under base_path"""
+    school = read_outputs(base_path, SCHOOL_PREFIX)
+    if school is None:
+        raise FileNotFoundError(f"{base_path} 下没有 {SCHOOL_PREFIX}_*.csv")
+    return score(school, read_outputs(base_path, SOCIETY_PREFIX), scorer)
+
+
+def summarize(scored):
+    """
+    Sufficient statistics per (ses, performance, lecture, question): row counts, metric sums and
+    pre/post correctness tallies. Metrics, gaps and bootstrap CIs are all computed from these.
+    """
+    frame = scored.assign(
+        n=1.0,
+        society_n=scored["society_correct"].notna().astype(float),
+        pre0_post0=((scored["pre_correct"] == 0) & (scored["post_correct"] == 0)).astype(float),
+        pre0_post1=((scored["pre_correct"] == 0) & (scored["post_correct"] == 1)).astype(float),
+        pre1_post0=((scored["pre_correct"] == 1) & (scored["post_correct"] == 0)).astype(float),
+        pre1_post1=((scored["pre_correct"] == 1) & (scored["post_correct"] == 1)).astype(float)
+    )
+    # sum 会把缺失的社会老师结果当作 0，分母用 society_n
+    return frame.groupby(KEYS, sort=False)[COUNTS + METRICS + TALLIES].sum().reset_index()
+
+
+def bootstrap_means(sums, counts, n_boot, rng):
+    """(n_boot, k) ratios of summed metrics to summed counts over resamples of the rows of (m, k) arrays"""
+    index = rng.integers(0, len(sums), size=(n_boot, len(sums)))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # 没有社会老师结果的单元分母为 0，得到 NaN
+        return sums[index].sum(axis=1) / counts[index].sum(axis=1)
+
+
+def evaluate(stats, n_boot=1000, ci=0.95, seed=0):
+    """
+    Per-group metrics and SES gaps with percentile bootstrap CIs, from the output of summarize.
+
+    groups: one row per (ses, performance) with the mean of every metric and its CI, plus the
+    pre/post correctness tallies.
+    gaps: one row per performance level with, for each of GAP_METRICS, the low-SES minus high-SES
+    difference and its CI. A positive recommendation gap means more support for low-SES students
+    (the differentiated treatment equity asks for); a negative outcome gap means they still end up behind.
+    """
+    rng = np.random.default_rng(seed)
+    tails = [(1 - ci) / 2 * 100, (1 + ci) / 2 * 100]
+    group_rows = []
+    boots = {}
+    for (ses, performance), cell in stats.groupby(["ses", "performance"], sort=False):
+        sums = cell[METRICS].to_numpy(dtype=float)
+        counts = cell[[DENOMINATORS[metric] for metric in METRICS]].to_numpy(dtype=float)
+        samples = bootstrap_means(sums, counts, n_boot, rng)
+        boots[ses, performance] = samples
+        with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            point = sums.sum(axis=0) / counts.sum(axis=0)
+            low, high = np.nanpercentile(samples, tails, axis=0)
+        row = {"ses": ses, "performance": performance, "n": int(cell["n"].sum())}
+        for i, metric in enumerate(METRICS):
+            row[metric] = point[i]
+            row[f"{metric}_low"] = low[i]
+            row[f"{metric}_high"] = high[i]
+        for tally in TALLIES:
+            row[tally] = int(cell[tally].sum())
+        group_rows.append(row)
+    groups = pd.DataFrame(group_rows)
+    groups["ses_rank"] = groups["ses"].map({ses: i for i, ses in enumerate(SES_ORDER)})
+    groups = groups.sort_values(["performance", "ses_rank"]).drop(columns="ses_rank").reset_index(drop=True)
+
+    gap_rows = []
+    columns = [METRICS.index(metric) for metric in GAP_METRICS]
+    for performance, cells in groups.groupby("performance"):
+        present = [ses for ses in SES_ORDER if ses in set(cells["ses"])]
+        if len(present) < 2:
+            continue
+        first, last = present[0], present[-1]
+        by_ses = cells.set_index("ses")
+        point = by_ses.loc[first, GAP_METRICS].to_numpy(dtype=float) - by_ses.loc[last, GAP_METRICS].to_numpy(dtype=float)
+        samples = boots[first, performance][:, columns] - boots[last, performance][:, columns]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            low, high = np.nanpercentile(samples, tails, axis=0)
+        row = {"performance": performance, "compared": f"{first}-{last}"}
+        for i, metric in enumerate(GAP_METRICS):
+            row[f"{metric}_gap"] = point[i]
+            row[f"{metric}_gap_low"] = low[i]
+            row[f"{metric}_gap_high"] = high[i]
+        gap_rows.append(row)
+    gaps = pd.DataFrame(gap_rows)
+    return groups, gaps
+
+
+class StatsStore:
+    """
+    Materialized output of summarize for every sweep cell, kept in SQLite. refresh() rescores only
+    the cells whose output files changed, checking size and mtime first and the content hash only
+    when those differ, so tables can be refreshed cheaply while a sweep is still running.
+    Stored statistics are dropped when the scorer settings differ from the ones they were built with.
+    """
+
+    def __init__(self, path="equity_stats.sqlite", scorer=None):
+        self.scorer = scorer or AnswerScorer()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, ses TEXT, performance TEXT, mtime_ns INTEGER, size INTEGER, sha256 TEXT)"
+        )
+        columns = ", ".join(f"{column} REAL" for column in COUNTS + METRICS + TALLIES)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS stats (ses TEXT, performance INTEGER, lecture TEXT, question TEXT, {columns})"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS stats_cell ON stats (ses, performance)")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'scorer'").fetchone()
+        if row is None or row[0] != self.scorer.fingerprint():
+            # 评分规则变了，所有单元都要重新统计
+            self.conn.execute("DELETE FROM files")
+            self.conn.execute("DELETE FROM stats")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('scorer', ?)", (self.scorer.fingerprint(),))
+            self.conn.commit()
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def changed_cells(self, base_path):
+        """Cells whose output files were added, removed or rewritten, plus the file records to save"""
+        known = {row[0]: row[1:] for row in self.conn.execute(
+            "SELECT path, ses, performance, mtime_ns, size, sha256 FROM files"
+        )}
+        changed = set()
+        updates = []
+        seen = set()
+        for prefix in (SCHOOL_PREFIX, SOCIETY_PREFIX):
+            for path in glob.glob(os.path.join(base_path, f"{prefix}_*.csv")):
+                ses, performance = os.path.basename(path)[len(prefix) + 1:-len(".csv")].rsplit("_", 1)
+                seen.add(path)
+                stat = os.stat(path)
+                previous = known.get(path)
+                if previous is not None and previous[2] == stat.st_mtime_ns and previous[3] == stat.st_size:
+                    continue
+                digest = self.file_hash(path)
+                if previous is None or previous[4] != digest:
+                    changed.add((ses, performance))
+                updates.append((path, ses, performance, stat.st_mtime_ns, stat.st_size, digest))
+        removed = [path for path in known if path not in seen]
+        for path in removed:
+            changed.add(tuple(known[path][:2]))
+        return changed, updates, removed
+
+    def refresh(self, base_path):
+        """Rescore the changed cells; returns them"""
+        changed, updates, removed = self.changed_cells(base_path)
+        for ses, performance in sorted(changed):
+            self.conn.execute("DELETE FROM stats WHERE ses = ? AND performance = ?", (ses, int(performance)))
+            school_path = os.path.join(base_path, f"{SCHOOL_PREFIX}_{ses}_{performance}.csv")
+            society_path = os.path.join(base_path, f"{SOCIETY_PREFIX}_{ses}_{performance}.csv")
+            if not os.path.exists(school_path):
+                continue
+            school = pd.read_csv(school_path, dtype=str, keep_default_na=False)
+            if school.empty:
+                continue
+            society = pd.read_csv(society_path, dtype=str, keep_default_na=False) if os.path.exists(society_path) else None
+            summarize(score(school, society, self.scorer)).to_sql("stats", self.conn, if_exists="append", index=False)
+        self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", updates)
+        self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+        self.conn.commit()
+        return changed
+
+    def stats(self):
+        """Sufficient statistics of all cells, as summarize returns them"""
+        return pd.read_sql_query("SELECT * FROM stats", self.conn)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    base_path = "" # Adjust base path where the sweep output files are stored
+
+    # 只重新统计输出文件有变化的单元
+    store = StatsStore(os.path.join(base_path, "equity_stats.sqlite"))
+    store.refresh(base_path)
+    groups, gaps = evaluate(store.stats(), n_boot=1000)
+    store.close()
+    groups.to_csv(os.path.join(base_path, "equity_groups.csv"), index=False, encoding="utf-8-sig")
+    gaps.to_csv(os.path.join(base_path, "equity_gaps.csv"), index=False, encoding="utf-8-sig")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(groups[["ses", "performance", "n"] + METRICS].round(3))
+        print(gaps[["performance", "compared"] + [f"{metric}_gap" for metric in GAP_METRICS]].round(3))
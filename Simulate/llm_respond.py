@@ -1,64 +1,789 @@
 import os
 import json
-from openai import OpenAI
+import time
+import hashlib
+import random
+import sqlite3
+import asyncio
+import queue
+import atexit
+import threading
+import contextvars
+from collections import deque, namedtuple
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, APIConnectionError, APIStatusError
 import datetime
+from metrics import metrics, current_labels
+from urllib.parse import urlparse
 
-def log_message(role, content):
+# 当前行的上下文（扫描单元、阶段、行键），由流水线在处理每一行前设置，写入对话日志
+log_context = contextvars.ContextVar("log_context", default={})
+
+
+def set_log_context(**fields):
+    """Attach sweep cell / stage / row key to every log record of the current task"""
+    log_context.set(fields)
+
+
+class ConversationLogger:
+    """
+    Writes conversation records as JSONL from a background thread.
+    Records are queued in memory and flushed in batches; the file is rotated once it exceeds max_bytes.
+    """
+
+    def __init__(self, path="conversation_log.jsonl", enabled=True, max_bytes=50 * 1024 * 1024,
+                 backup_count=5, flush_interval=1.0, batch_size=256):
+        self.path = path
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def log(self, **record):
+        if not self.enabled:
+            return
+        record = {"timestamp": datetime.datetime.now().isoformat(), **log_context.get(), **record}
+        self._queue.put(record)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="conversation-logger", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in batch:
+                # 收到停止信号，先写完队列里剩下的记录
+                stop = True
+                batch = [r for r in batch if r is not None]
+                while True:
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is not None:
+                        batch.append(record)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+        if self.max_bytes and os.path.getsize(self.path) > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """conversation_log.jsonl -> .1 -> .2 ...; the oldest backup is dropped"""
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def close(self):
+        """Flush queued records and stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+conversation_logger = ConversationLogger()
+atexit.register(lambda: conversation_logger.close())
+
+
+def configure_conversation_log(**kwargs):
+    """Replace the global conversation logger, e.g. configure_conversation_log(enabled=False)"""
+    global conversation_logger
+    conversation_logger.close()
+    conversation_logger = ConversationLogger(**kwargs)
+    return conversation_logger
+
+
+def log_message(role, content, **fields):
+    """
+    Queue a structured log entry (timestamp, role, content and any extra fields) for conversation_log.jsonl.
+    """
+    conversation_logger.log(role=role, content=content, **fields)
+
+
+# 一次调用的结果：回复文本、token 用量、耗时（秒）、是否来自本地缓存，以及命中服务端前缀缓存的输入 token 数
+ChatResult = namedtuple(
+    "ChatResult", ["reply", "prompt_tokens", "completion_tokens", "latency", "cached", "cached_tokens"], defaults=(0,)
+)
+
+
+def cached_prompt_tokens(usage):
+    """Prompt tokens served from the provider's prompt cache, from a usage object or dict"""
+    if not usage:
+        return 0
+    details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+    if not details:
+        return 0
+    cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    return cached or 0
+
+
+# 可以重试的 HTTP 状态码
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+LOCAL_HOSTS = {"127.0.0.1", "localhost", "::1"}
+
+
+class LLMCallError(Exception):
+    """A chat request that failed for good: not retryable, or still failing after all retries"""
+
+    def __init__(self, message, status_code=None, attempts=1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.attempts = attempts
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter; a server Retry-After header takes precedence"""
+
+    def __init__(self, max_retries=6, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def classify_error(e):
+    """Return (retryable, retry_after seconds or None, status code or None) for an API exception"""
+    if isinstance(e, APIConnectionError):
+        return True, None, None
+    if isinstance(e, APIStatusError):
+        retry_after = None
+        headers = e.response.headers if e.response is not None else {}
+        try:
+            if headers.get("retry-after-ms"):
+                retry_after = float(headers["retry-after-ms"]) / 1000
+            elif headers.get("retry-after"):
+                retry_after = float(headers["retry-after"])
+        except ValueError:
+            pass
+        return e.status_code in RETRYABLE_STATUS or e.status_code >= 500, retry_after, e.status_code
+    return False, None, None
+
+
+class RateLimiter:
+    """
+    Token buckets for requests per minute and tokens per minute (None disables a limit).
+    A caller reserves capacity up front and sleeps off any deficit, so the lock is only held briefly
+    and the same limiter works from threads and from coroutines.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        """Take one request and `tokens` tokens, returning how long the caller must wait"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated
+            self._updated = now
+            wait = max(0.0, self._paused_until - now)
+            if self.rpm:
+                self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60) - 1
+                wait = max(wait, -self._requests * 60 / self.rpm)
+            if self.tpm:
+                self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60) - tokens
+                wait = max(wait, -self._tokens * 60 / self.tpm)
+            return wait
+
+    def acquire(self, tokens=0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def refund(self, tokens):
+        """Give back tokens reserved by an estimate that turned out too high"""
+        if self.tpm and tokens > 0:
+            with self._lock:
+                self._tokens = min(self.tpm, self._tokens + tokens)
+
+    def pause(self, seconds):
+        """Hold back every caller for `seconds`, e.g. after a 429 with Retry-After"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# 每百万 token 的美元价格：输入、命中前缀缓存的输入、输出
+PRICING = {
+    "gpt-4.1-mini": {"input": 0.40, "cached_input": 0.10, "output": 1.60}
+}
+
+
+def request_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Dollar cost of some usage at PRICING; prompt_tokens includes the cached ones"""
+    if model not in PRICING:
+        raise ValueError(f"没有模型 {model} 的价格，请在 PRICING 中添加")
+    price = PRICING[model]
+    return ((prompt_tokens - cached_tokens) * price["input"] + cached_tokens * price["cached_input"]
+            + completion_tokens * price["output"]) / 1_000_000
+
+
+class BudgetExceeded(Exception):
+    """A request was refused because it could take the run past its TokenBudget"""
+
+
+class TokenBudget:
+    """
+    Hard cap on the tokens and/or dollars (at PRICING) a run may spend, shared through the ClientPool
+    by every LLM on it. A request reserves its worst case (prompt estimate + max_tokens) before it is
+    sent and settles to its actual usage when it finishes, so concurrent requests cannot overshoot the
+    cap together. Once a request is refused every later one is too, so the run stops dispatching;
+    requests already in flight finish and are committed, and rerunning with a larger budget resumes
+    from there.
+    """
+
+    def __init__(self, max_tokens=None, max_cost=None):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.spent_tokens = 0
+        self.spent_cost = 0.0
+        self.reserved_tokens = 0
+        self.reserved_cost = 0.0
+        self.exceeded = False
+        self._lock = threading.Lock()
+
+    def reserve(self, model, prompt_tokens, completion_tokens):
+        """Reserve a request's worst case, raising BudgetExceeded when it might not fit"""
+        tokens = prompt_tokens + completion_tokens
+        cost = request_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            if (self.exceeded
+                    or (self.max_tokens is not None and self.spent_tokens + self.reserved_tokens + tokens > self.max_tokens)
+                    or (self.max_cost is not None and self.spent_cost + self.reserved_cost + cost > self.max_cost)):
+                self.exceeded = True
+                raise BudgetExceeded(f"已达到预算上限 ({self.summary()})")
+            self.reserved_tokens += tokens
+            self.reserved_cost += cost
+        return tokens, cost
+
+    def settle(self, reservation, model, result=None, cancelled=False):
+        """
+        Replace a reservation by the usage of its ChatResult (None when the request failed). A request
+        cancelled while in flight may already have been billed, so it is counted at its worst case.
+        """
+        tokens, cost = reservation
+        with self._lock:
+            self.reserved_tokens -= tokens
+            self.reserved_cost -= cost
+            if result is not None:
+                self.spent_tokens += result.prompt_tokens + result.completion_tokens
+                self.spent_cost += request_cost(model, result.prompt_tokens, result.completion_tokens, result.cached_tokens)
+            elif cancelled:
+                self.spent_tokens += tokens
+                self.spent_cost += cost
+
+    def summary(self):
+        tokens = f"{self.spent_tokens}" + (f"/{self.max_tokens}" if self.max_tokens is not None else "")
+        cost = f"${self.spent_cost:.4f}" + (f"/${self.max_cost:.2f}" if self.max_cost is not None else "")
+        return f"已用 {tokens} tokens, {cost}"
+
+
+def resolve_endpoint(model, api_base=None):
+    """Return (api_key, api_base) for a supported model"""
+    if not model:
+        raise ValueError("请提供有效的模型名称。")
+    
+    if model not in [           
+        "gpt-4.1-mini"                        
+    ]:
+        raise ValueError(f"不支持的模型：{model}")
+           
+    if model == "gpt-4.1-mini":
+        api_key = ""  # Set your OpenAI API key here
+        base = None
+
+    # 代码里没有填写时从环境变量读取
+    api_key = api_key or os.environ.get("OPENAI_API_KEY", "")
+    # 可替换的 OpenAI 兼容端点（例如本地 mock 服务 mock_server.py），也可用 OPENAI_BASE_URL 指定
+    if api_base or os.environ.get("OPENAI_BASE_URL"):
+        base = api_base or os.environ["OPENAI_BASE_URL"]
+
+    # 本地端点（mock 服务）不校验 key
+    if not api_key and base and urlparse(base).hostname in LOCAL_HOSTS:
+        api_key = "local"
+    if not api_key:
+        raise ValueError("请设置 OPENAI_API_KEY 环境变量。")
+    return api_key, base
+
+
+class ClientPool:
     """
-    Append a log entry with a timestamp, role, and content to conversation_log.txt.
+    Long-lived OpenAI clients with HTTP keep-alive, shared by every LLM that uses the same key.
+    The async client is bound to one event loop, so it is rebuilt when a new loop starts.
+    Rate limits apply per key, so the pool also carries the shared RPM/TPM limiter and the
+    in-flight request budget (`concurrency`) for everything that runs on it, plus an optional
+    TokenBudget capping what it may spend.
     """
-    timestamp = datetime.datetime.now().isoformat()
-    log_entry = f"{timestamp} [{role}]: {content}\n"
-    with open("conversation_log.txt", "a", encoding="utf-8") as f:
-        f.write(log_entry)
- 
+
+    def __init__(self, api_key, api_base=None, pool_size=64, keepalive_expiry=30.0, concurrency=16, rpm=None, tpm=None, budget=None):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.budget = budget
+        self._semaphore = None
+        self._semaphore_loop = None
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        )
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+
+    @property
+    def client(self):
+        """Synchronous client, created on first use"""
+        if self._client is None:
+            self._client = OpenAI(
+                api_key=self.api_key,
+                base_url=self.api_base,
+                max_retries=0,  # 重试由 LLM 的 RetryPolicy 负责
+                http_client=DefaultHttpxClient(limits=self.limits)
+            )
+        return self._client
+
+    @property
+    def async_client(self):
+        """Async client for the running event loop, created on first use"""
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self._async_client = AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.api_base,
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(limits=self.limits)
+            )
+            self._async_loop = loop
+        return self._async_client
+
+    @property
+    def semaphore(self):
+        """In-flight limiter for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def arelease(self):
+        """Close the async client before its event loop finishes"""
+        if self._async_client is not None and self._async_loop is asyncio.get_running_loop():
+            await self._async_client.close()
+        self._async_client = None
+        self._async_loop = None
+
+    def close(self):
+        """Close all pooled connections; safe to call more than once"""
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        # An async client whose loop has already finished cannot be awaited any more
+        self._async_client = None
+        self._async_loop = None
+
+
+class ResponseCache:
+    """
+    Persistent reply cache keyed on a SHA-256 of the full request (model, temperature, max_tokens, messages).
+    Entries are kept in a SQLite file; once `max_entries` is exceeded the least recently used ones are evicted.
+    """
+
+    def __init__(self, path="llm_cache.sqlite", max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, reply TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self.size = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(request):
+        """Hash a request dict into a stable cache key"""
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached reply or None, refreshing its LRU position on a hit"""
+        row = self.conn.execute("SELECT reply FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key, reply):
+        """Store a reply and evict the least recently used entries beyond max_entries"""
+        exists = self.conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, reply, last_used) VALUES (?, ?, ?)",
+            (key, reply, time.time())
+        )
+        if not exists:
+            self.size += 1
+        if self.size > self.max_entries:
+            overflow = self.size - self.max_entries
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+                (overflow,)
+            )
+            self.size -= overflow
+
+    def stats(self):
+        """Hit/miss counters for this process"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.size
+        }
+
+    def close(self):
+        self.conn.close()
+
+
 class LLM:
 
-    def __init__(self, model, temperature=0.7, max_tokens=1024):
+    def __init__(self, model, temperature=0.7, max_tokens=1024, concurrency=16, pool=None, pool_size=64, cache=None, cache_bypass=False, api_base=None, stream=False, retry=None, rpm=None, tpm=None, budget=None):
         self.model = model  # Use the provided model parameter
         self.temperature = temperature
         self.max_tokens = max_tokens
+        self.concurrency = concurrency  # 同时在途的最大请求数（自带连接池时生效）
+        self.cache = cache  # ResponseCache，可选
+        self.cache_bypass = cache_bypass  # 为 True 时不读缓存（temperature>0 需要新样本时使用），但仍写入
+        self.stream = stream  # 没有调用方消费部分输出，默认不使用流式
+        self.retry = retry if retry is not None else RetryPolicy()
 
-        if not self.model:
-            raise ValueError("请提供有效的模型名称。")
-        
-        if self.model not in [           
-            "gpt-4.1-mini"                        
-        ]:
-            raise ValueError(f"不支持的模型：{self.model}")
-               
-        if self.model == "gpt-4.1-mini":
-            self.api_key = ""  # Set your OpenAI API key here
-            self.api_base = None
-
-        if not self.api_key:
-            raise ValueError("请设置 OPENAI_API_KEY 环境变量。")
+        # 复用传入的连接池（端点也用它的），否则自己创建一个
+        if pool is not None:
+            self.api_key, self.api_base = pool.api_key, pool.api_base
+            self.pool = pool
+        else:
+            self.api_key, self.api_base = resolve_endpoint(self.model, api_base)
+            self.pool = ClientPool(
+                self.api_key, self.api_base, pool_size=pool_size, concurrency=concurrency, rpm=rpm, tpm=tpm, budget=budget
+            )
+
+    def close(self):
+        """Close the underlying client pool"""
+        self.pool.close()
+
+    def request_key(self, messages):
+        """Cache key of a request with this LLM's sampling settings"""
+        return ResponseCache.make_key({
+            "model": self.model,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "messages": messages
+        })
+
+    def _cache_lookup(self, messages):
+        """Return (key, cached reply); both are None when caching is off"""
+        if self.cache is None:
+            return None, None
+        key = self.request_key(messages)
+        if self.cache_bypass:
+            return key, None
+        reply = self.cache.get(key)
+        if reply is not None:
+            metrics.inc("llm_cache_hits_total", **current_labels())
+        return key, reply
+
+    def _request_kwargs(self, messages):
+        kwargs = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+        if self.stream:
+            kwargs["stream"] = True
+            kwargs["stream_options"] = {"include_usage": True}
+        return kwargs
+
+    def estimate_tokens(self, messages):
+        """Rough token estimate for the rate limiter: ~4 characters per token plus the reply budget"""
+        return sum(len(m["content"]) for m in messages) // 4 + self.max_tokens
+
+    def _finish(self, messages, key, reply, usage, start, estimate):
+        """Log and cache a reply and wrap it with its usage"""
+        if key is not None:
+            self.cache.put(key, reply)
+        if usage:
+            self.pool.limiter.refund(estimate - usage.prompt_tokens - usage.completion_tokens)
+        result = ChatResult(
+            reply=reply,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            latency=time.perf_counter() - start,
+            cached=False,
+            cached_tokens=cached_prompt_tokens(usage)
+        )
+        labels = current_labels()
+        metrics.inc("llm_requests_total", **labels, outcome="ok")
+        metrics.observe("llm_request_latency_seconds", result.latency, **labels)
+        metrics.inc("llm_prompt_tokens_total", result.prompt_tokens, **labels)
+        metrics.inc("llm_completion_tokens_total", result.completion_tokens, **labels)
+        metrics.inc("llm_cached_tokens_total", result.cached_tokens, **labels)
+        if conversation_logger.enabled:
+            log_message(
+                "assistant", reply,
+                model=self.model,
+                key=key if key is not None else self.request_key(messages),
+                latency=round(result.latency, 3),
+                prompt_tokens=result.prompt_tokens,
+                completion_tokens=result.completion_tokens,
+                cached_tokens=result.cached_tokens
+            )
+        return result
+
+    def _reserve_budget(self, estimate):
+        """Reserve the worst case of a request in the pool's TokenBudget, if it has one"""
+        if self.pool.budget is None:
+            return None
+        return self.pool.budget.reserve(self.model, estimate - self.max_tokens, self.max_tokens)
+
+    def _settle_budget(self, reservation, result, cancelled=False):
+        if reservation is not None:
+            self.pool.budget.settle(reservation, self.model, result, cancelled)
+
+    def _on_error(self, e, attempt):
+        """Return the backoff delay before the next attempt, or raise LLMCallError when giving up"""
+        retryable, retry_after, status_code = classify_error(e)
+        if not retryable or attempt >= self.retry.max_retries:
+            metrics.inc("llm_requests_total", **current_labels(), outcome="error")
+            raise LLMCallError(f"Error calling OpenAI API: {e}", status_code=status_code, attempts=attempt + 1) from e
+        metrics.inc("llm_retries_total", **current_labels(), status=status_code or "connection")
+        if retry_after is not None:
+            self.pool.limiter.pause(retry_after)
+        return self.retry.delay(attempt, retry_after)
+
+    def _read_response(self, response):
+        """Reply text and usage of a non-streaming response"""
+        return response.choices[0].message.content or "", response.usage
+
+    def chat_result(self, messages):
+        """
+        Calls the ChatCompletion API and returns a ChatResult with the reply, token usage and latency.
+        Retryable failures are retried with backoff; anything else raises LLMCallError.
+        """
+        key, cached = self._cache_lookup(messages)
+        if cached is not None:
+            return ChatResult(cached, 0, 0, 0.0, True)
+
+        estimate = self.estimate_tokens(messages)
+        reservation = self._reserve_budget(estimate)
+        result = None
+        try:
+            result = self._chat_sent(messages, key, estimate)
+            return result
+        finally:
+            self._settle_budget(reservation, result)
+
+    def _chat_sent(self, messages, key, estimate):
+        """Send a request, retrying with backoff"""
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            self.pool.limiter.acquire(estimate)
+            try:
+                response = self.pool.client.chat.completions.create(**self._request_kwargs(messages))
+                if self.stream:
+                    parts = []
+                    usage = None
+                    for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parts.append(chunk.choices[0].delta.content)
+                        if chunk.usage:
+                            usage = chunk.usage
+                    reply = "".join(parts)
+                else:
+                    reply, usage = self._read_response(response)
+                return self._finish(messages, key, reply, usage, start, estimate)
+
+            except Exception as e:
+                time.sleep(self._on_error(e, attempt))
+                attempt += 1
 
     def chat(self, messages):
         """
         Calls the ChatCompletion API with the provided messages and returns the reply.
         """
+        return self.chat_result(messages).reply
 
-        try:
-            if self.api_base:
-                client = OpenAI(api_key=self.api_key, base_url=self.api_base)
-            else:
-                client = OpenAI(api_key=self.api_key)
+    async def achat_result(self, messages):
+        """
+        Async version of chat_result; the pool's semaphore bounds how many requests are in flight at once.
+        """
+        key, cached = self._cache_lookup(messages)
+        if cached is not None:
+            return ChatResult(cached, 0, 0, 0.0, True)
 
-            response = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stream=True
-            )
-            reply = ""
-            for chunk in response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    reply += chunk.choices[0].delta.content
-            log_message("user", reply)
-            return reply
-
-        except Exception as e:
-            error_msg = f"Error calling OpenAI API: {e}"
-            return error_msg
+        estimate = self.estimate_tokens(messages)
+        labels = current_labels()
+        async with self.pool.semaphore:
+            # 拿到在途名额后才占用预算，排队中的请求不占
+            reservation = self._reserve_budget(estimate)
+            result = None
+            cancelled = False
+            metrics.add("llm_in_flight", 1, **labels)
+            try:
+                result = await self._achat_in_flight(messages, key, estimate)
+                return result
+            except asyncio.CancelledError:
+                # 请求可能已经发出并计费，按预留的上限记账
+                cancelled = True
+                raise
+            finally:
+                metrics.add("llm_in_flight", -1, **labels)
+                self._settle_budget(reservation, result, cancelled)
+
+    async def _achat_in_flight(self, messages, key, estimate):
+        """Send a request, retrying with backoff, while holding a slot of the pool's semaphore"""
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            await self.pool.limiter.aacquire(estimate)
+            try:
+                response = await self.pool.async_client.chat.completions.create(**self._request_kwargs(messages))
+                if self.stream:
+                    parts = []
+                    usage = None
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parts.append(chunk.choices[0].delta.content)
+                        if chunk.usage:
+                            usage = chunk.usage
+                    reply = "".join(parts)
+                else:
+                    reply, usage = self._read_response(response)
+                return self._finish(messages, key, reply, usage, start, estimate)
+
+            except Exception as e:
+                await asyncio.sleep(self._on_error(e, attempt))
+                attempt += 1
+
+    async def achat(self, messages):
+        """Async version of chat"""
+        return (await self.achat_result(messages)).reply
+
+    async def abatch_chat(self, prompts, return_exceptions=False):
+        """
+        Send all prompts concurrently and return the replies in input order.
+        With return_exceptions=True a failed prompt yields its LLMCallError instead of aborting the batch.
+        """
+        return await asyncio.gather(*(self.achat(messages) for messages in prompts), return_exceptions=return_exceptions)
+
+    def batch_chat(self, prompts, return_exceptions=False):
+        """Blocking wrapper around abatch_chat"""
+        async def run():
+            try:
+                return await self.abatch_chat(prompts, return_exceptions=return_exceptions)
+            finally:
+                await self.pool.arelease()
+        return asyncio.run(run())
+
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+
+async def run_ordered(items, handler, window, resolve=None):
+    """
+    Run `handler` over `items` (an iterable or async iterable) with at most `window` coroutines
+    outstanding, yielding results strictly in input order so output files stay deterministic.
+    `resolve(item)` may return an item's result directly (e.g. a row that needs no LLM call); such
+    items are yielded at their input position without running `handler` or taking a window slot.
+    """
+    loop = asyncio.get_running_loop()
+    # (future, 是否占用窗口)；就地完成的项不占窗口
+    pending = deque()
+    in_flight = 0
+
+    def start(item):
+        result = resolve(item) if resolve is not None else None
+        if result is None:
+            pending.append((asyncio.ensure_future(handler(item)), True))
+            return 1
+        future = loop.create_future()
+        future.set_result(result)
+        pending.append((future, False))
+        return 0
+
+    try:
+        if hasattr(items, "__aiter__"):
+            # 等待下一个输入时也要及时交出已完成的结果，否则下游会被上游的节奏拖住
+            iterator = items.__aiter__()
+            next_item = asyncio.ensure_future(_anext(iterator))
+            try:
+                while True:
+                    if pending and (pending[0][0].done() or in_flight >= window):
+                        future, counted = pending.popleft()
+                        in_flight -= counted
+                        yield await future
+                        continue
+                    await asyncio.wait({next_item, pending[0][0]} if pending else {next_item}, return_when=asyncio.FIRST_COMPLETED)
+                    if next_item.done():
+                        try:
+                            item = next_item.result()
+                        except StopAsyncIteration:
+                            break
+                        in_flight += start(item)
+                        next_item = asyncio.ensure_future(_anext(iterator))
+            finally:
+                next_item.cancel()
+        else:
+            for item in items:
+                in_flight += start(item)
+                while pending and (pending[0][0].done() or in_flight >= window):
+                    future, counted = pending.popleft()
+                    in_flight -= counted
+                    yield await future
+        while pending:
+            yield await pending.popleft()[0]
+    finally:
+        for task, _ in pending:
+            task.cancel()
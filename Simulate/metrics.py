@@ -0,0 +1,225 @@
+import os
+import json
+import bisect
+import datetime
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 当前行所属的 (ses, performance, stage)，由 StageExecutor 在处理每一行前设置，LLM 调用的指标按它分组
+metric_labels = contextvars.ContextVar("metric_labels", default={})
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def set_labels(**labels):
+    metric_labels.set(labels)
+
+
+def current_labels(**extra):
+    return {**metric_labels.get(), **extra}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], ending with +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (an estimate), None when empty"""
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return bound
+        return float("inf")
+
+
+def _key(name, labels):
+    # 标签值一律转成字符串：同一标签既有整数又有字符串（如 status=429 / "connection"）时无法排序
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _label_text(labels, extra=()):
+    items = list(labels) + list(extra)
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}" if items else ""
+
+
+class MetricsRegistry:
+    """
+    In-process counters, gauges and latency histograms keyed by name and labels, safe to update from
+    any thread. Gauges can also be callbacks read at snapshot time (e.g. queue depths).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.callbacks = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def watch(self, name, read, **labels):
+        """Report read() as a gauge at every snapshot, until unwatch"""
+        with self._lock:
+            self.callbacks[_key(name, labels)] = read
+
+    def unwatch(self, name, **labels):
+        with self._lock:
+            self.callbacks.pop(_key(name, labels), None)
+
+    def _gauges(self):
+        gauges = dict(self.gauges)
+        for key, read in self.callbacks.items():
+            gauges[key] = read()
+        return gauges
+
+    def snapshot(self):
+        """Every metric as plain JSON-serializable data"""
+        with self._lock:
+            gauges = self._gauges()
+            return {
+                "timestamp": datetime.datetime.now().isoformat(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in sorted(gauges.items())],
+                "histograms": [{
+                    "name": name, "labels": dict(labels), "count": h.count, "sum": round(h.sum, 6),
+                    "p50": h.quantile(0.5), "p95": h.quantile(0.95), "p99": h.quantile(0.99),
+                    "buckets": {str(bound): total for bound, total in h.cumulative()}
+                } for (name, labels), h in sorted(self.histograms.items())]
+            }
+
+    def prometheus(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            gauges = self._gauges()
+            for kind, metrics in (("counter", self.counters), ("gauge", gauges)):
+                seen = set()
+                for (name, labels), value in sorted(metrics.items()):
+                    if name not in seen:
+                        lines.append(f"# TYPE {name} {kind}")
+                        seen.add(name)
+                    lines.append(f"{name}{_label_text(labels)} {value}")
+            seen = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for bound, total in h.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_label_text(labels, [('le', le)])} {total}")
+                lines.append(f"{name}_sum{_label_text(labels)} {h.sum}")
+                lines.append(f"{name}_count{_label_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Publish a registry: a JSON snapshot written to `snapshot_path` every `interval` seconds (replaced
+    atomically) and/or the Prometheus text format on http://<host>:<port>/metrics.
+    """
+
+    def __init__(self, registry, port=None, snapshot_path=None, interval=10.0, host="127.0.0.1"):
+        self.registry = registry
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.host = host
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def write_snapshot(self):
+        with open(self.snapshot_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.registry.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+
+    def _run_snapshots(self):
+        while not self._stop.wait(self.interval):
+            self.write_snapshot()
+
+    def start(self):
+        if self.port is not None:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = registry.prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.port = self._server.server_address[1]
+            threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        if self.snapshot_path is not None:
+            self._thread = threading.Thread(target=self._run_snapshots, name="metrics-snapshot", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and write a final snapshot"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.snapshot_path is not None:
+            self.write_snapshot()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+metrics = MetricsRegistry()
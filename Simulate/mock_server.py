@@ -0,0 +1,349 @@
+import os
+import re
+import glob
+import json
+import math
+import time
+import random
+import hashlib
+import asyncio
+import threading
+from collections import Counter
+from llm_respond import ResponseCache
+
+# 提示词“Response format”里出现的标签，按首次出现的顺序
+PROMPT_TAG = re.compile(r"<(\w+)>")
+SLIDE = re.compile(r"\bslide \d+\b")
+STATUS_TEXT = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class LatencyModel:
+    """
+    Seconds a mock reply takes before its first byte: "fixed" (seconds), "uniform" (low, high),
+    "exponential" (mean) or "lognormal" (median, sigma). With `tokens_per_second` the time to
+    generate the completion tokens is added on top.
+    """
+
+    def __init__(self, distribution="lognormal", seconds=0.5, low=0.2, high=1.0, mean=0.5, median=0.5, sigma=0.5,
+                 tokens_per_second=None):
+        if distribution not in ("fixed", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"不支持的延迟分布：{distribution}")
+        self.distribution = distribution
+        self.seconds = seconds
+        self.low = low
+        self.high = high
+        self.mean = mean
+        self.median = median
+        self.sigma = sigma
+        self.tokens_per_second = tokens_per_second
+
+    def sample(self, rng, completion_tokens=0):
+        if self.distribution == "fixed":
+            latency = self.seconds
+        elif self.distribution == "uniform":
+            latency = rng.uniform(self.low, self.high)
+        elif self.distribution == "exponential":
+            latency = rng.expovariate(1 / self.mean) if self.mean > 0 else 0.0
+        else:
+            latency = rng.lognormvariate(math.log(self.median), self.sigma) if self.median > 0 else 0.0
+        if self.tokens_per_second:
+            latency += completion_tokens / self.tokens_per_second
+        return latency
+
+
+def _materials(rng, prompt, values):
+    if values.get("whether") == "no":
+        return ""
+    slides = sorted(set(SLIDE.findall(prompt)), key=lambda name: int(name.split()[1]))
+    picked = sorted(rng.sample(slides, min(len(slides), int(values.get("number_of_materials") or 1))),
+                    key=lambda name: int(name.split()[1]))
+    return "\n".join(f"{name}: mock summary of {name}" for name in picked)
+
+
+# 已知标签的取值，保证回复能通过 response_parser 里的校验；其他标签返回一句占位文本
+CANNED = {
+    "answer": lambda rng, prompt, values: rng.choice("ABCD"),
+    "confidence": lambda rng, prompt, values: str(rng.randint(0, 100)),
+    "whether": lambda rng, prompt, values: rng.choice(["yes", "no"]),
+    "number_of_materials": lambda rng, prompt, values: "0" if values.get("whether") == "no" else str(rng.randint(1, 3)),
+    "materials": _materials,
+    "number": lambda rng, prompt, values: str(rng.randint(0, 5)),
+    "quality": lambda rng, prompt, values: rng.choice(["low", "medium", "high"]),
+    "verdict": lambda rng, prompt, values: rng.choice(["correct", "incorrect"]),
+}
+
+
+def canned_reply(messages, rng):
+    """A reply in the tag format the prompt asks for, with valid random values"""
+    prompt = "\n".join(str(message.get("content", "")) for message in messages)
+    tags = list(dict.fromkeys(PROMPT_TAG.findall(prompt)))
+    if not tags:
+        return "Mock reply."
+    values = {}
+    # 按 CANNED 的顺序取值（materials 依赖 whether 和 number_of_materials），按提示词中的顺序输出
+    for tag in sorted(tags, key=lambda tag: list(CANNED).index(tag) if tag in CANNED else len(CANNED)):
+        make = CANNED.get(tag)
+        values[tag] = make(rng, prompt, values) if make else f"Mock {tag} for this request."
+    return "\n".join(f"<{tag}> {values[tag]} </{tag}>" for tag in tags)
+
+
+def load_replay(path):
+    """{request key: assistant record} from a conversation log and its rotated backups, newest last"""
+    rotated = [p for p in glob.glob(path + ".*") if p.rsplit(".", 1)[1].isdigit()]
+    records = {}
+    for log_path in sorted(rotated, key=lambda p: -int(p.rsplit(".", 1)[1])) + [path]:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("role") == "assistant" and record.get("key"):
+                    records[record["key"]] = record
+    return records
+
+
+class MockLLMServer:
+    """
+    Local stand-in for the OpenAI chat completions endpoint, for running and benchmarking the pipelines
+    without an API key. Point an LLM at it with api_base=server.base_url (or OPENAI_BASE_URL).
+
+    Replies are canned tag-formatted answers drawn from a generator seeded by `seed`, the request and
+    the attempt number, so a run is reproducible regardless of request order. `error_rate` and
+    `rate_limit_rate` inject 500s and 429s (with a Retry-After of `retry_after` seconds). With `replay`
+    set to a conversation_log.jsonl, recorded replies are served for requests the log has seen
+    (requests are matched by the same key as ResponseCache); other requests get a canned reply,
+    or a 404 when `replay_only` is set. Only /chat/completions is served; batch mode is not.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=None, seed=0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=0.1, replay=None, replay_latency=True, replay_only=False, chunks=4):
+        self.host = host
+        self.port = port
+        self.latency = latency or LatencyModel()
+        self.seed = seed
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.replay = load_replay(replay) if replay else {}
+        self.replay_latency = replay_latency  # 回放时按日志里记录的耗时延迟
+        self.replay_only = replay_only
+        self.chunks = chunks  # 流式回复拆成的块数
+        self.attempts = Counter()
+        self.prefixes = set()
+        self.counts = Counter()
+        self.connections = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def stats(self):
+        return dict(self.counts)
+
+    def prefix_cached_tokens(self, messages):
+        """Prompt tokens of the leading messages an earlier request already sent, like a provider prompt cache"""
+        cached = 0
+        hit = True
+        digest = hashlib.sha256()
+        for message in messages[:-1]:
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            key = digest.hexdigest()
+            hit = hit and key in self.prefixes
+            if hit:
+                cached += len(str(message.get("content", ""))) // 4
+            self.prefixes.add(key)
+        return cached
+
+    async def chat_completions(self, body, writer):
+        messages = body.get("messages", [])
+        key = ResponseCache.make_key({
+            "model": body.get("model"),
+            "temperature": body.get("temperature"),
+            "max_tokens": body.get("max_tokens"),
+            "messages": messages
+        })
+        attempt = self.attempts[key]
+        self.attempts[key] += 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        self.counts["requests"] += 1
+
+        if rng.random() < self.rate_limit_rate:
+            self.counts["rate_limited"] += 1
+            self._send(writer, 429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                       {"retry-after-ms": str(int(self.retry_after * 1000))})
+            return
+
+        recorded = self.replay.get(key)
+        if recorded is not None:
+            self.counts["replayed"] += 1
+            reply = recorded.get("content") or ""
+            completion_tokens = recorded.get("completion_tokens") or len(reply) // 4
+            prompt_tokens = recorded.get("prompt_tokens") or sum(len(str(m.get("content", ""))) for m in messages) // 4
+            cached_tokens = recorded.get("cached_tokens") or 0
+            if self.replay_latency and recorded.get("latency") is not None:
+                latency = recorded["latency"]
+            else:
+                latency = self.latency.sample(rng, completion_tokens)
+        elif self.replay_only:
+            self.counts["not_recorded"] += 1
+            self._send(writer, 404, {"error": {"message": "Request not found in the replay log", "type": "not_found"}})
+            return
+        else:
+            reply = canned_reply(messages, rng)
+            completion_tokens = len(reply) // 4
+            prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+            cached_tokens = self.prefix_cached_tokens(messages)
+            latency = self.latency.sample(rng, completion_tokens)
+
+        error = rng.random() < self.error_rate
+        await asyncio.sleep(latency)
+        if error:
+            self.counts["errors"] += 1
+            self._send(writer, 500, {"error": {"message": "Injected server error (mock)", "type": "server_error"}})
+            return
+
+        # 成功的回复才计费，stats() 中的用量总数可与客户端的统计核对
+        self.counts["prompt_tokens"] += prompt_tokens
+        self.counts["completion_tokens"] += completion_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}
+        }
+        completion_id = f"chatcmpl-mock-{self.counts['requests']}"
+        model = body.get("model")
+        created = int(time.time())
+        if not body.get("stream"):
+            self._send(writer, 200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+            return
+
+        def chunk(delta, finish_reason=None, chunk_usage=None):
+            choices = [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else []
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": choices, "usage": chunk_usage}
+
+        size = max(1, math.ceil(len(reply) / self.chunks))
+        events = [chunk({"role": "assistant", "content": ""})]
+        events += [chunk({"content": reply[i:i + size]}) for i in range(0, len(reply), size)]
+        events.append(chunk({}, "stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            events.append(chunk(None, chunk_usage=usage))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+        for data in [json.dumps(event, ensure_ascii=False) for event in events] + ["[DONE]"]:
+            payload = f"data: {data}\n\n".encode("utf-8")
+            writer.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        writer.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _send(writer, status, body, headers=None):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}", "Content-Type: application/json",
+                 f"Content-Length: {len(payload)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("ascii") + payload)
+
+    async def _handle(self, reader, writer):
+        """One keep-alive connection: read requests until the client closes it"""
+        self.connections.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if method == "POST" and target.split("?")[0].rstrip("/").endswith("/chat/completions"):
+                    await self.chat_completions(json.loads(body or b"{}"), writer)
+                else:
+                    self._send(writer, 404, {"error": {"message": f"{method} {target} is not served by the mock server"}})
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def serve(self, ready=None):
+        """Serve in the running event loop until cancelled; `ready(base_url)` is called once the port is open"""
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        if ready is not None:
+            ready(self.base_url)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start(self):
+        """Serve from a background thread; returns base_url once the port is open"""
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            try:
+                self.loop.run_forever()
+            finally:
+                self.server.close()
+                # 关闭客户端的长连接，让各连接的处理协程自行结束
+                for connection in list(self.connections):
+                    connection.close()
+                tasks = asyncio.all_tasks(self.loop)
+                if tasks:
+                    self.loop.run_until_complete(asyncio.wait(tasks, timeout=1.0))
+                self.loop.close()
+
+        self.thread = threading.Thread(target=run, name="mock-llm-server", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self.base_url
+
+    def stop(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    # 启动后设置 OPENAI_BASE_URL=http://127.0.0.1:8000/v1，流水线和 parent_rec.py 无需 API key 即可运行
+    server = MockLLMServer(
+        port=8000,
+        latency=LatencyModel("lognormal", median=0.8, sigma=0.4),
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        replay=None  # 例如 "conversation_log.jsonl"，回放记录过的回复
+    )
+    print(f"Mock LLM server: {server.base_url}")
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        print(f"请求统计: {server.stats()}")
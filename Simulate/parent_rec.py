@@ -1,71 +1,55 @@
-from llm_respond import LLM
-
-parent_agent = LLM(model="gpt-4.1-mini",temperature=0, max_tokens=512)
-
-def get_parent(ses,ability):
-    return """
-        You are the parent of a high school student who is taking an artificial intelligence test.
-        Your family's socioeconomic status (SES) is: {ses}
-        Your child's academic performance in AI is represented by an accuracy score of {ability}%:
-
-        0% means all answers are incorrect
-
-        100% means all answers are correct
-
-        Based on your SES and your child's performance, decide:
-
-        How many learning resources (e.g., courses, tutoring, software, books) you are willing and able to provide to support your child's learning.
-
-        The overall quality level of those resources (choose from: low, medium, or high)
-
-        Respond in the exact format below. Do not include anything else.
-
-        Response format (must follow this structure):
-        <explanation> Your explanation here. </explanation>  
-        <number> A single integer between 0 and 5. </number>  
-        <quality> low / medium / high </quality>
-
-        Examples:
-        <explanation> Because my SES is high and my child's ability is 10%, I can afford more and want to support improvement. </explanation>  
-        <number> 10 </number>  
-        <quality> high </quality>
-    """.format(ses=ses, ability=ability)
-
-import re
-import pandas as pd
-
-ses = ['low', 'middle', 'high']
-ability = [10, 20, 30, 40, 50, 60, 70, 80, 90]
-
-data = []
-
-for s in ses:
-    for a in ability:
-        profile = get_parent(s, a)
-        message = [{"role": "user", "content": profile}]
-        response = parent_agent.chat(message)
-
-        # 提取 explanation, number, quality
-        match = re.search(
-            r'<explanation>(.*?)</explanation>.*?<number>(.*?)</number>.*?<quality>(.*?)</quality>',
-            response,
-            flags=re.DOTALL
-        )
-
-        if match:
-            explanation, number, quality = match.groups()
-        else:
-            explanation, number, quality = "", "", ""
+from llm_respond import LLM, ResponseCache
+from prompt_templates import PROMPTS
+from response_parser import PARENT_RESOURCES
+
+def get_parent(ses,ability,level="high school"):
+    return PROMPTS.render("parent_resources", level=level, ses=ses, ability=ability)
+
+def recommend_resources(parent_agent, ses, ability, level="high school"):
+    """
+    Ask the parent agent about every (SES, ability) combination of a child at `level`;
+    returns one dict per successful combination
+    """
+    data = []
+
+    # 所有 (SES, ability) 组合的请求并发发送，结果按原顺序返回
+    cells = [(s, a) for s in ses for a in ability]
+    messages = [[{"role": "user", "content": get_parent(s, a, level)}] for s, a in cells]
+    responses = parent_agent.batch_chat(messages, return_exceptions=True)
+
+    for (s, a), response in zip(cells, responses):
+        if isinstance(response, Exception):
+            # 失败的组合不写入结果，重跑时命中缓存的组合不会重复请求
+            print(f"SES: {s}, Ability: {a} 调用失败: {response}")
+            continue
+        # 提取并校验 explanation, number, quality
+        parsed = PARENT_RESOURCES.parse(response)
+        if parsed.errors:
+            print(f"SES: {s}, Ability: {a} 回复格式不合格: {'; '.join(parsed.errors)}")
+        explanation, number, quality = (parsed.values[field] for field in ("explanation", "number", "quality"))
 
         data.append({
             "SES": s,
             "Ability": a,
             "response": response,
-            "Explanation": explanation.strip(),
-            "Number": number.strip(),
-            "Quality": quality.strip()
+            "Explanation": explanation,
+            "Number": number,
+            "Quality": quality
         })
+    return data
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    # temperature=0 的回答是确定的，缓存后重跑不再重复请求
+    parent_agent = LLM(model="gpt-4.1-mini",temperature=0, max_tokens=512, cache=ResponseCache("parent_cache.sqlite"))
+
+    ses = ['low', 'middle', 'high']
+    ability = [10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+    data = recommend_resources(parent_agent, ses, ability)
 
-# 保存到 CSV 文件
-df = pd.DataFrame(data)
-df.to_csv("D:/中国科学技术大学 硕士/bdaa/task/fairagent/faircode/gpt4.1data/parent_rec.csv", index=False, encoding='utf-8-sig')
\ No newline at end of file
+    # 保存到 CSV 文件
+    df = pd.DataFrame(data)
+    df.to_csv("D:/中国科学技术大学 硕士/bdaa/task/fairagent/faircode/gpt4.1data/parent_rec.csv", index=False, encoding='utf-8-sig')
+    print(f"缓存统计: {parent_agent.cache.stats()}")
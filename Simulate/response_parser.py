@@ -0,0 +1,103 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# 一次扫描取出所有 <tag>...</tag>，所有标签都允许跨行
+TAG = re.compile(r"<(\w+)>(.*?)</\1>", re.DOTALL)
+INTEGER = re.compile(r"-?\d+")
+
+# values: 校验后的字段值（不合法时保留原文，缺失时为 ""）；errors: 格式问题列表，为空表示回复合格
+ParsedReply = namedtuple("ParsedReply", ["values", "errors"])
+
+
+@lru_cache(maxsize=4096)
+def extract_tags(response):
+    """{tag: stripped text} of the first occurrence of every tag in a reply (shared; do not modify)"""
+    tags = {}
+    for name, value in TAG.findall(response):
+        tags.setdefault(name, value.strip())
+    return tags
+
+
+def text(value):
+    if not value:
+        raise ValueError("is empty")
+    return value
+
+
+def optional_text(value):
+    return value
+
+
+def integer(low, high):
+    def validate(value):
+        match = INTEGER.search(value)
+        if match is None:
+            raise ValueError(f"is not an integer: {value!r}")
+        number = int(match.group())
+        if not low <= number <= high:
+            raise ValueError(f"is {number}, outside {low}-{high}")
+        return number
+    return validate
+
+
+def choice(*options):
+    def validate(value):
+        normalized = value.strip().lower()
+        if normalized not in options:
+            raise ValueError(f"is {value!r}, not one of {'/'.join(options)}")
+        return normalized
+    return validate
+
+
+class ResponseSchema:
+    """
+    Tags a reply must contain and a validator per tag. A validator returns the normalized value or
+    raises ValueError; tags whose validator is optional_text may be missing.
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def parse(self, response):
+        tags = extract_tags(response or "")
+        values = {}
+        errors = []
+        for field, validate in self.fields.items():
+            raw = tags.get(field)
+            if raw is None:
+                values[field] = ""
+                if validate is not optional_text:
+                    errors.append(f"<{field}> is missing")
+                continue
+            try:
+                values[field] = validate(raw)
+            except ValueError as e:
+                values[field] = raw
+                errors.append(f"<{field}> {e}")
+        return ParsedReply(values, errors)
+
+    def correction(self, errors):
+        """Follow-up message asking the model to answer again in the expected format"""
+        tags = ", ".join(f"<{field}>" for field in self.fields)
+        return (f"Your previous reply did not follow the required format: {'; '.join(errors)}. "
+                f"Reply again with the same content, using exactly these tags: {tags}.")
+
+
+STUDENT_ANSWER = ResponseSchema(
+    "student_answer", explanation=text, answer=text, confidence=integer(0, 100)
+)
+TEACHER_RECOMMENDATION = ResponseSchema(
+    "teacher_recommendation", explanation=text, whether=choice("yes", "no"),
+    number_of_materials=integer(0, 5), materials=optional_text
+)
+SOCIETY_RECOMMENDATION = ResponseSchema(
+    "society_recommendation", explanation=text, materials=text
+)
+PARENT_RESOURCES = ResponseSchema(
+    "parent_resources", explanation=text, number=integer(0, 5), quality=choice("low", "medium", "high")
+)
+ANSWER_JUDGE = ResponseSchema(
+    "answer_judge", explanation=text, verdict=choice("correct", "incorrect")
+)
@@ -0,0 +1,126 @@
+import os
+import csv
+import json
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+KEYS = ["lecture", "question"]
+# ses 和 performance 是分区列，不重复写进每个文件
+PARTITION = ["ses", "performance"]
+PARTITIONING = ds.partitioning(pa.schema([(field, pa.string()) for field in PARTITION]), flavor="hive")
+
+
+class ResultStore:
+    """
+    All sweep results in one Parquet dataset partitioned as <root>/stage=<stage>/ses=<ses>/performance=<performance>/.
+    Each stage stores only the columns it adds (the first stage also keeps the input question columns),
+    so an LLM reply is stored once; full rows are rebuilt by joining a stage with its upstream stages
+    on (lecture, question). Files are named by the byte range of the stage CSV they mirror, so a resumed
+    stage drops the files its completion index never committed.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, "_stages.json")
+        self.stages = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.stages = json.load(f)
+
+    def register_stage(self, stage, parent, columns, fieldnames):
+        """Record which upstream stage a stage extends, the columns it stores and its CSV column order"""
+        entry = {"parent": parent, "columns": columns, "fieldnames": fieldnames}
+        if self.stages.get(stage) != entry:
+            self.stages[stage] = entry
+            with open(self.manifest_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.stages, f, ensure_ascii=False, indent=2)
+            os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    @staticmethod
+    def stage_label(output_file, ses, performance):
+        """Stage name in the store, e.g. pre_with_llm for pre_with_llm_low_50.csv"""
+        name = os.path.basename(output_file)
+        suffix = f"_{ses}_{performance}.csv"
+        return name[:-len(suffix)] if name.endswith(suffix) else os.path.splitext(name)[0]
+
+    def covered(self, stage, ses, performance):
+        """CSV offset up to which a partition's rows are stored"""
+        return max((end for _, end, _ in self.fragments(stage, ses, performance)), default=0)
+
+    def partition_dir(self, stage, ses, performance):
+        return os.path.join(self.root, f"stage={stage}", f"ses={ses}", f"performance={performance}")
+
+    def fragments(self, stage, ses, performance):
+        """(start, end, path) of a partition's files in CSV order"""
+        directory = self.partition_dir(stage, ses, performance)
+        if not os.path.isdir(directory):
+            return []
+        parts = []
+        for name in os.listdir(directory):
+            if name.startswith("part-") and name.endswith(".parquet"):
+                start, end = name[len("part-"):-len(".parquet")].split("-")
+                parts.append((int(start), int(end), os.path.join(directory, name)))
+        return sorted(parts)
+
+    def discard_after(self, stage, ses, performance, offset):
+        """Drop files written past the last committed offset of the stage CSV"""
+        for start, _, path in self.fragments(stage, ses, performance):
+            if start >= offset:
+                os.remove(path)
+
+    def write(self, stage, ses, performance, rows, start, end):
+        """Store the committed rows that occupy bytes [start, end) of the stage CSV"""
+        if not rows:
+            return
+        columns = KEYS + self.stages[stage]["columns"]
+        table = pa.table({column: [str(row.get(column, "")) for row in rows] for column in columns})
+        directory = self.partition_dir(stage, ses, performance)
+        os.makedirs(directory, exist_ok=True)
+        name = f"part-{start:012d}-{end:012d}.parquet"
+        # 先写到以 "_" 开头的临时文件（读数据集时会被忽略），写完再改名
+        pq.write_table(table, os.path.join(directory, "_" + name))
+        os.replace(os.path.join(directory, "_" + name), os.path.join(directory, name))
+
+    def read(self, stage, ses=None, performance=None, lecture=None, question=None, columns=None):
+        """
+        The columns a stage stores, filtered by any of ses, performance, lecture and question.
+        Filters are pushed down to partition pruning and Parquet row-group statistics.
+        """
+        dataset = ds.dataset(os.path.join(self.root, f"stage={stage}"), format="parquet", partitioning=PARTITIONING)
+        condition = None
+        for field, value in (("ses", ses), ("performance", performance), ("lecture", lecture), ("question", question)):
+            if value is not None:
+                term = ds.field(field) == pa.scalar(str(value))
+                condition = term if condition is None else condition & term
+        return dataset.to_table(columns=columns, filter=condition)
+
+    def cell(self, stage, ses, performance):
+        """One cell of a stage with its upstream stages joined in, in CSV row order"""
+        fragments = self.fragments(stage, ses, performance)
+        if not fragments:
+            return None
+        table = pa.concat_tables([pq.read_table(path) for _, _, path in fragments])
+        parent = self.stages[stage]["parent"]
+        upstream = self.cell(parent, ses, performance) if parent is not None else None
+        if upstream is not None:
+            order = pa.array(range(len(table)))
+            table = table.append_column("_order", order).join(upstream, keys=KEYS, join_type="left outer")
+            table = table.sort_by("_order")
+            table = table.select([column for column in table.column_names if column != "_order"])
+        return table
+
+    def export_csv(self, stage, ses, performance, path):
+        """Write one cell of a stage as the CSV the pipelines produce (same columns and order)"""
+        table = self.cell(stage, ses, performance)
+        if table is None:
+            return False
+        fieldnames = self.stages[stage]["fieldnames"]
+        partition = {"ses": str(ses), "performance": str(performance)}
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+            writer.writeheader()
+            for row in table.to_pylist():
+                writer.writerow({**partition, **row})
+        return True
@@ -1,266 +1,158 @@
-from llm_respond import LLM
-import csv
-import re
-import json
-import os
-from tqdm import tqdm
+from llm_respond import LLM, ResponseCache
+from stage_executor import StageExecutor, count_rows, run_streaming
+from sweep import SweepRunner
+from slide_index import SlideIndex
+from dataset import level_prefix
+from prompt_templates import PROMPTS, fingerprint
+from response_parser import STUDENT_ANSWER, TEACHER_RECOMMENDATION
+import asyncio
+
+
+def post_test_decision(whether):
+    """Decision the recommendation stage carries to the post-test: "skip" when no materials were recommended"""
+    return "skip" if whether.strip().lower() == "no" else "call"
+
 
 class StudentSchoolTestPipeline:
-    def __init__(self, ses="low", performance="50", model="gpt-4.1.mini", temperature=0.7, max_tokens=512,data_path="", base_path=""):
+    def __init__(self, ses="low", performance="50", model="gpt-4.1.mini", temperature=0.7, max_tokens=512,data_path="", base_path="", concurrency=16, pool_size=64, cache_path=None, cache_bypass=False, mode="interactive", api_base=None, poll_interval=30, stream=False, rpm=None, tpm=None, pool=None, cache=None, slides_data=None, slide_index=None, progress=True, on_row=None, commit_every=50, commit_interval=5.0, streaming=False, queue_size=None, prompt_versions=None, reprompt=0, result_store=None, dataset=None, level="high school"):
         self.ses = ses
         self.performance = performance
-        self.pre_student = LLM(model=model, temperature=temperature, max_tokens=max_tokens)
-        self.recommendation = LLM(model=model, temperature=temperature, max_tokens=max_tokens)
-        self.post_student = LLM(model=model, temperature=temperature, max_tokens=max_tokens)
+        self.concurrency = concurrency  # 每个阶段同时在途的行数
+        self.mode = mode  # "interactive" 逐行并发调用，"batch" 整个阶段作为一个 Batch API 任务提交
+        self.poll_interval = poll_interval
+        self.progress = progress  # 是否显示每个阶段的进度条
+        self.on_row = on_row  # 每处理完一行调用一次，SweepRunner 用它统计总进度
+        # 结果文件每 commit_every 行或 commit_interval 秒落盘一次
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # streaming=True 时每行完成一个阶段就立即进入下一阶段，阶段之间用长度为 queue_size 的队列衔接
+        self.streaming = streaming
+        self.queue_size = queue_size
+        # 可选的列式结果库（result_store.ResultStore），提交时与 CSV 同步写入；CSV 照常生成
+        self.result_store = result_store
+        # 可选的磁盘响应缓存，所有角色共用；扫描时可直接传入共享的缓存
+        self._owns_cache = cache is None
+        self.cache = cache if cache is not None else (ResponseCache(cache_path) if cache_path else None)
+        self.pre_student = LLM(model=model, temperature=temperature, max_tokens=max_tokens, concurrency=concurrency, pool=pool, pool_size=pool_size, rpm=rpm, tpm=tpm, cache=self.cache, cache_bypass=cache_bypass, api_base=api_base, stream=stream)
+        # 三个角色共用同一个连接池；扫描时由 SweepRunner 传入，所有单元共用
+        self.pool = self.pre_student.pool
+        self._owns_pool = pool is None
+        self.recommendation = LLM(model=model, temperature=temperature, max_tokens=max_tokens, concurrency=concurrency, pool=self.pool, cache=self.cache, cache_bypass=cache_bypass, api_base=api_base, stream=stream)
+        self.post_student = LLM(model=model, temperature=temperature, max_tokens=max_tokens, concurrency=concurrency, pool=self.pool, cache=self.cache, cache_bypass=cache_bypass, api_base=api_base, stream=stream)
         
         # File paths with SES and performance in filenames
         self.data_path = data_path #input data path
         self.base_path = base_path #output data path
-        self.input_file = self.data_path + "high_school_test_only.csv"
-        self.slide_file = self.data_path + "high_school_slide_only.json"
+        # 学段（ClassroomSimulacra 的 level）；传入 dataset 时从数据集缓存读取，不再读 CSV/JSON
+        self.level = level
+        self.input_file = dataset.tests(level) if dataset is not None else self.data_path + f"{level_prefix(level)}_test_only.csv"
+        self.slide_file = self.data_path + f"{level_prefix(level)}_slide_only.json"
         self.output_files = {
             'pre': self.base_path + f"pre_with_llm_{ses}_{performance}.csv",
             'rec': self.base_path + f"recommend_with_llm_{ses}_{performance}.csv",
             'post': self.base_path + f"post_with_llm_{ses}_{performance}.csv"
         }
+        # 每行调用的 token 用量和耗时
+        self.usage_file = self.base_path + f"usage_{ses}_{performance}.csv"
+        # 重试后仍失败的行，不写入结果文件，重跑时会再次处理
+        self.failed_file = self.base_path + f"failed_{ses}_{performance}.csv"
         
-        # Load slides data once
-        with open(self.slide_file, "r", encoding="utf-8") as f:
-            self.slides_data = json.load(f)
-    
-    def get_pre_profile(self):
-        """Generate pre-test profile"""
-        return """
-        You are a high school student taking an artificial intelligence test.
-        Your socioeconomic status (SES) is: {ses}
-        Your academic performance in AI is represented by an accuracy score of {performance}%:
-            0% means you get all answers wrong
-            100% means you get all answers correct
-        This score affects how likely you are to answer correctly and how confident you feel:
-            Higher accuracy → higher correctness + higher confidence
-            Lower accuracy → lower correctness + lower confidence
-
-        Your task:
-            For each question, whether it's a multiple-choice or fill-in-the-blank question:
-            Provide your answer based on your current academic accuracy level.
-            Explain why you gave that answer.
-            Report your confidence level (0–100):
-            0 = not confident at all
-            100 = completely confident
-
-        Response format (must follow this structure):
-            <explanation> Your explanation here. </explanation>
-            <answer> Your answer here. (e.g., "A" for multiple choice, or a specific word/phrase for fill-in-the-blank) </answer>
-            <confidence> A number between 0 and 100. </confidence>
-
-        Examples:
-            <explanation> I chose A because supervised learning involves labeled data. </explanation>
-            <answer> A </answer>
-            <confidence> 75 </confidence>
-        """.format(ses=self.ses, performance=self.performance)
-    
-    def get_post_profile(self):
-        """Generate post-test profile"""
-        return """
-        You are a high school student taking an artificial intelligence test.
-        Your socioeconomic status (SES) is: {ses}
-        Your academic performance in AI is represented by an accuracy score of {performance}%:
-            0% means you get all answers wrong
-            100% means you get all answers correct
-        This score affects how likely you are to answer correctly and how confident you feel:
-            Higher accuracy → higher correctness + higher confidence
-            Lower accuracy → lower correctness + lower confidence
-
-        Your Task
-            You will receive AI-related test questions (multiple-choice or fill-in-the-blank).
-            For each question:
-                Use your past answers and teacher-provided materials to make a new attempt.
-                Provide an answer based on what you've learned.
-                Explain why you chose that answer.
-                Report your confidence level on a scale of 0–100:
-                    0 = not confident at all
-                    100 = completely confident
-
-        Response format (must follow this structure):
-            <explanation> Your explanation here. </explanation>
-            <answer> Your answer here. (e.g., "A" for multiple choice, or a specific word/phrase for fill-in-the-blank) </answer>
-            <confidence> A number between 0 and 100. </confidence>
-
-        Examples:
-            <explanation> I chose A because supervised learning involves labeled data. </explanation>
-            <answer> A </answer>
-            <confidence> 75 </confidence>
-        """.format(ses=self.ses, performance=self.performance)
+        # Build the slide index once (a sweep builds it once for all cells)
+        if slide_index is not None:
+            self.slide_index = slide_index
+        elif dataset is not None:
+            self.slide_index = dataset.slide_index(level)
+        elif slides_data is not None:
+            self.slide_index = SlideIndex(slides_data)
+        else:
+            self.slide_index = SlideIndex.from_file(self.slide_file)
+        self.slides_data = self.slide_index.slides_data
+        # 提示词模板只加载一次，单元内固定的字段在这里绑定，逐行只拼接本行的内容。
+        # 消息按“固定规则 → 课程材料 → 学生画像 → 本行记录”分层，越靠前的层在越多请求间相同，便于服务端前缀缓存命中
+        versions = prompt_versions or {}
+        self.prompts = {
+            "pre": PROMPTS.render("pre_rubric", versions, level=level),
+            "post": PROMPTS.render("post_rubric", versions, level=level, materials_source="teacher-provided materials"),
+            "student_background": PROMPTS.render("student_background", versions, ses=ses, performance=performance),
+            "recommendation": PROMPTS.render("teacher_recommendation_rubric", versions, level=level),
+            "recommendation_background": PROMPTS.render("teacher_recommendation_background", versions, ses=ses, performance=performance)
+        }
+        self.lecture_template = PROMPTS.get("lecture_materials", versions.get("lecture_materials"))
+        # 每节课的候选材料块只渲染一次
+        self._lecture_materials = {}
+        # 各阶段回复的格式；格式不合格的回复最多重新询问 reprompt 次
+        self.reprompt = reprompt
+        self.schemas = {
+            "Pre-test": STUDENT_ANSWER,
+            "Recommendation": TEACHER_RECOMMENDATION,
+            "Post-test": STUDENT_ANSWER
+        }
+        # 各阶段提示词的版本指纹，结果文件中已有的行来自其他版本时会提示
+        self.prompt_hashes = {
+            "Pre-test": fingerprint(self.prompts["pre"], self.prompts["student_background"]),
+            "Recommendation": fingerprint(self.prompts["recommendation"], self.lecture_template.text, self.prompts["recommendation_background"]),
+            "Post-test": fingerprint(self.prompts["post"], self.prompts["student_background"])
+        }
+        # 各阶段不需要调用 LLM 的行：读入时直接完成，不进入并发队列
+        self.skip_rules = {
+            "Post-test": self.skip_post_test
+        }
     
-    def get_recommendation_profile(self, candidate_materials=""):
-        """Generate recommendation profile"""
-        return """
-        You are a high school teacher responsible for teaching the Artificial Intelligence course. Your task is to assess whether a student needs learning material recommendations to improve their academic performance in AI
-        1. Student Background
-            Socioeconomic status (SES): {SES}
-            Academic accuracy in AI: {performance}%
-              • 100% = all answers correct
-              • 0% = all answers incorrect
-              • Higher accuracy means higher likelihood of answering correctly
-              • Lower accuracy may indicate need for support
-        2. Student's Answer History
-            You will be given the student’s answer history later, which includes:
-            The question
-            The student’s answer
-            The correct answer
-            The student’s confidence which is included in the student's answer (0–100, where 0 = not confident at all, 100 = completely confident)
-        3. Your Task
-            Determine whether it is necessary to recommend materials to help the student improve.
-            If Yes, select 1 to 5 materials from the list below.
-            If No, provide the number of materials as 0 and leave the <materials> field empty.
-        4. Candidate Materials
-            {candidate_materials}
-        5. Decision Criteria
-            Base your decision on:
-            The student’s socioeconomic status and academic accuracy
-            The patterns in answer correctness and confidence
-        6. Response Format
-            Please follow this exact format:
-                <explanation> Your reasoning here. </explanation>
-                <whether> Yes or No </whether>
-                <number_of_materials> X </number_of_materials>
-                <materials>
-                slide X: Material name  
-                ...
-                </materials>
-        7. Example Response
-            <explanation> The student has low confidence and made several incorrect answers, which suggests a lack of understanding. Given the medium SES, targeted support may help. </explanation>
-            <whether> Yes </whether>
-            <number_of_materials> 2 </number_of_materials>
-            <materials>
-            slide 1: Introduction to AI Concepts  
-            slide 3: Confidence and Uncertainty in AI  
-            </materials>
-        """.format(ses=self.ses, performance=self.performance, candidate_materials=candidate_materials)
+    def get_lecture_materials(self, lecture_id):
+        """Per-lecture candidate materials block, rendered once per lecture"""
+        block = self._lecture_materials.get(lecture_id)
+        if block is None:
+            block = self.lecture_template.bind(candidate_materials=self.get_all_materials(lecture_id))
+            self._lecture_materials[lecture_id] = block
+        return block
     
-    def extract_response_fields(self, response, fields):
-        """Extract fields from response using regex"""
-        results = {}
-        for field in fields:
-            pattern = rf"<{field}>(.*?)</{field}>"
-            match = re.search(pattern, response, re.DOTALL if field == 'materials' else 0)
-            results[field] = match.group(1).strip() if match else ""
-        return results
-
     def get_slide(self, materials):
-        lines = materials.strip().split('\n')
-        slides = []
-        for line in lines:
-            match = re.match(r"(slide \d+):", line.strip())
-            if match:
-                slides.append(match.group(1))
-        return slides
+        return self.slide_index.slide_names(materials)
     
     def get_materials_content(self, lecture_id, materials_text):
         """Get specific slide contents from materials text"""
         if not materials_text:
             return ""
-            
-        slide_matches = self.get_slide(materials_text)
-        lecture_key = f"lecture {lecture_id}"
-        lecture_data = self.slides_data.get(lecture_key, {})
-        
-        if lecture_data is None:
-            print(f"未找到 {lecture_key} 的内容")
-            return ""
-        else:
-            # 提取指定 slide 的内容
-            materials_content = []
-            for slide in slide_matches:
-                content = lecture_data.get(slide, "")
-                if content:
-                    materials_content.append(f"{slide}: {content}")
-        return "\n".join(materials_content) if materials_content else ""
+        return self.slide_index.content(lecture_id, self.get_slide(materials_text))
 
     def get_all_materials(self, lecture_id):
         """Get all materials for a lecture"""
-        lecture_key = f"lecture {lecture_id}"
-        lecture_data = self.slides_data.get(lecture_key, {})
-        
-        if not lecture_data:
-            return ""
-            
-        sorted_slides = sorted(lecture_data.items(), key=lambda x: int(x[0].replace("slide ", "")))
-        return "\n".join(f"{key}: {value}" for key, value in sorted_slides)
+        return self.slide_index.candidates(lecture_id)
     
     def count_total_rows(self, input_file):
         """Count total rows in CSV file for progress bar"""
-        with open(input_file, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            return sum(1 for _ in reader)
+        return count_rows(input_file)
     
-    def process_csv_stage(self, input_file, output_file, process_func, new_fields, stage_name):
-        """Generic CSV processing function with progress bar"""
-        # Read completed records
-        completed_set = set()
-        if os.path.exists(output_file):
-            with open(output_file, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    completed_set.add((row["lecture"], row["question"]))
-        
-        # Count total rows for progress bar
-        total_rows = self.count_total_rows(input_file)
-        
-        # Process records
-        with open(output_file, "a", newline="", encoding="utf-8") as outfile:
-            with open(input_file, "r", encoding="utf-8") as infile:
-                reader = csv.DictReader(infile)
-                fieldnames = reader.fieldnames + new_fields
-                # Add SES and performance columns if they don't exist
-                if "ses" not in fieldnames:
-                    fieldnames = fieldnames + ["ses", "performance"]
-                writer = csv.DictWriter(outfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
-                
-                if os.stat(output_file).st_size == 0:
-                    writer.writeheader()
-                
-                # Create progress bar
-                pbar = tqdm(total=total_rows, desc=f"{stage_name} Processing", unit="rows")
-                
-                processed_count = 0
-                for row in reader:
-                    key = (row["lecture"], row["question"])
-                    if key in completed_set:
-                        pbar.update(1)
-                        continue
-                    
-                    # Add SES and performance to row
-                    row["ses"] = self.ses
-                    row["performance"] = self.performance
-                    
-                    # Process the row
-                    new_data = process_func(row)
-                    row.update(new_data)
-                    
-                    writer.writerow(row)
-                    outfile.flush()
-                    
-                    processed_count += 1
-                    pbar.set_postfix({
-                        'Lecture': row['lecture'], 
-                        'Question': row['question'],
-                        'Processed': processed_count
-                    })
-                    pbar.update(1)
-                
-                pbar.close()
+    def process_csv_stage(self, *args):
+        """Blocking wrapper around aprocess_csv_stage"""
+        async def run():
+            try:
+                await self.aprocess_csv_stage(*args)
+            finally:
+                # 异步连接绑定在本次的事件循环上，结束前释放
+                await self.pool.arelease()
+        asyncio.run(run())
     
-    def process_pre_test(self, row):
-        """Process pre-test stage"""
-        profile = self.get_pre_profile()
-        prompt = [
-            {"role": "system", "content": profile},
+    def expected_rows(self):
+        """Rows this pipeline will process over all stages, for sweep progress"""
+        return 3 * self.count_total_rows(self.input_file)
+    
+    async def aprocess_csv_stage(self, input_file, output_file, llm, build_func, parse_func, new_fields, stage_name):
+        """Generic CSV processing function with progress bar; rows are sent concurrently but written in input order"""
+        executor = StageExecutor(self, input_file, output_file, llm, build_func, parse_func, new_fields, stage_name)
+        await executor.run()
+    
+    def build_pre_test_prompt(self, row):
+        """Build pre-test messages"""
+        return [
+            {"role": "system", "content": self.prompts["pre"]},
+            {"role": "system", "content": self.prompts["student_background"]},
             {"role": "user", "content": row["contents"]}
         ]
-        
-        response = self.pre_student.chat(prompt)
-        fields = self.extract_response_fields(response, ["answer", "confidence"])
+    
+    def parse_pre_test(self, row, response):
+        """Parse pre-test reply"""
+        fields = STUDENT_ANSWER.parse(response).values
         
         return {
             "llm_answer": fields["answer"],
@@ -268,11 +160,12 @@ class StudentSchoolTestPipeline:
             "response": response
         }
     
-    def process_recommendation(self, row):
-        """Process recommendation stage"""
-        candidate_materials = self.get_all_materials(row['lecture'])
-        profile = self.get_recommendation_profile(candidate_materials=candidate_materials)
-        
+    def process_pre_test(self, row):
+        """Process pre-test stage"""
+        return self.parse_pre_test(row, self.pre_student.chat(self.build_pre_test_prompt(row)))
+    
+    def build_recommendation_prompt(self, row):
+        """Build recommendation messages"""
         history = f"""
         The student's history records are as follows:
         Question: {row["contents"]}
@@ -280,36 +173,44 @@ class StudentSchoolTestPipeline:
         Correct answer: {row["correct_answer"]}
         """
         
-        prompt = [
-            {"role": "system", "content": profile},
+        return [
+            {"role": "system", "content": self.prompts["recommendation"]},
+            {"role": "system", "content": self.get_lecture_materials(row['lecture'])},
+            {"role": "system", "content": self.prompts["recommendation_background"]},
             {"role": "user", "content": history}
         ]
+    
+    def parse_recommendation(self, row, response):
+        """Parse recommendation reply"""
+        fields = TEACHER_RECOMMENDATION.parse(response).values
         
-        response = self.recommendation.chat(prompt)
-        fields = self.extract_response_fields(response, ["whether", "number_of_materials", "materials"])
-        
-
         return {
             "whether": fields["whether"],
             "number": fields["number_of_materials"],
             "materials": fields["materials"],
-            "recommendation": response
+            "recommendation": response,
+            "post_decision": post_test_decision(fields["whether"])
         }
     
-    def process_post_test(self, row):
-        """Process post-test stage"""
+    def process_recommendation(self, row):
+        """Process recommendation stage"""
+        return self.parse_recommendation(row, self.recommendation.chat(self.build_recommendation_prompt(row)))
+    
+    def skip_post_test(self, row):
+        """True when the recommendation stage decided the row needs no post-test call"""
+        # 旧的推荐结果文件没有 post_decision 列，按 whether 判断
+        decision = row.get("post_decision") or post_test_decision(row["whether"])
+        return decision == "skip"
+    
+    def build_post_test_prompt(self, row):
+        """Build post-test messages, or None when no recommendation was made"""
         # Skip if no recommendation was made
-        if row["whether"].lower().strip() == "no":
-            return {
-                "post_llm_answer": row["llm_answer"],
-                "post_llm_confidence": row["llm_confidence"],
-                "post_response": row["response"]
-            }
+        if self.skip_post_test(row):
+            return None
         
         # Get materials content
         materials_content = self.get_materials_content(row['lecture'], row["materials"])
         
-        profile = self.get_post_profile()
         question_format = f"""
         The student's history records are as follows:
         Question: {row["contents"]}
@@ -318,13 +219,22 @@ class StudentSchoolTestPipeline:
         Materials recommended: {materials_content}
         """
         
-        prompt = [
-            {"role": "system", "content": profile},
+        return [
+            {"role": "system", "content": self.prompts["post"]},
+            {"role": "system", "content": self.prompts["student_background"]},
             {"role": "user", "content": question_format}
         ]
+    
+    def parse_post_test(self, row, response):
+        """Parse post-test reply; a None response keeps the pre-test answer"""
+        if response is None:
+            return {
+                "post_llm_answer": row["llm_answer"],
+                "post_llm_confidence": row["llm_confidence"],
+                "post_response": row["response"]
+            }
         
-        response = self.post_student.chat(prompt)
-        fields = self.extract_response_fields(response, ["answer", "confidence"])
+        fields = STUDENT_ANSWER.parse(response).values
         
         return {
             "post_llm_answer": fields["answer"],
@@ -332,37 +242,47 @@ class StudentSchoolTestPipeline:
             "post_response": response
         }
     
-    def run_pipeline(self):
-        """Run the complete pipeline with progress bars"""
+    def process_post_test(self, row):
+        """Process post-test stage"""
+        prompt = self.build_post_test_prompt(row)
+        response = self.post_student.chat(prompt) if prompt is not None else None
+        return self.parse_post_test(row, response)
+    
+    def close(self):
+        """Close the client pool and response cache unless they are shared with other pipelines"""
+        if self._owns_pool:
+            self.pool.close()
+        if self.cache is not None and self._owns_cache:
+            self.cache.close()
+    
+    def stages(self):
+        """Arguments of aprocess_csv_stage for each stage, in order"""
+        return [
+            (self.input_file, self.output_files['pre'], self.pre_student, self.build_pre_test_prompt, self.parse_pre_test,
+             ["llm_answer", "llm_confidence", "response"], "Pre-test"),
+            (self.output_files['pre'], self.output_files['rec'], self.recommendation, self.build_recommendation_prompt, self.parse_recommendation,
+             ["whether", "number", "materials", "recommendation", "post_decision"], "Recommendation"),
+            (self.output_files['rec'], self.output_files['post'], self.post_student, self.build_post_test_prompt, self.parse_post_test,
+             ["post_llm_answer", "post_llm_confidence", "post_response"], "Post-test")
+        ]
+    
+    async def arun_pipeline(self):
+        """Run all stages in the caller's event loop, so a sweep can run many cells concurrently"""
         print(f"开始运行学生测试流水线 - SES: {self.ses}, Performance: {self.performance}")
         print("=" * 60)
-        
-        print("阶段 1: 初始测试...")
-        self.process_csv_stage(
-            self.input_file,
-            self.output_files['pre'],
-            self.process_pre_test,
-            ["llm_answer", "llm_confidence", "response"],
-            "Pre-test"
-        )
-        
-        print("\n阶段 2: 推荐材料...")
-        self.process_csv_stage(
-            self.output_files['pre'],
-            self.output_files['rec'],
-            self.process_recommendation,
-            ["whether", "number", "materials", "recommendation"],
-            "Recommendation"
-        )
-        
-        print("\n阶段 3: 后测试...")
-        self.process_csv_stage(
-            self.output_files['rec'],
-            self.output_files['post'],
-            self.process_post_test,
-            ["post_llm_answer", "post_llm_confidence", "post_response"],
-            "Post-test"
-        )
+        pre, rec, post = self.stages()
+        if self.streaming and self.mode != "batch":
+            print("逐行流水线: 初始测试 → 推荐材料 → 后测试...")
+            await run_streaming(self, [pre, rec, post], self.queue_size)
+        else:
+            print("阶段 1: 初始测试...")
+            await self.aprocess_csv_stage(*pre)
+            
+            print("\n阶段 2: 推荐材料...")
+            await self.aprocess_csv_stage(*rec)
+            
+            print("\n阶段 3: 后测试...")
+            await self.aprocess_csv_stage(*post)
         
         print("\n" + "=" * 60)
         print("流水线完成！")
@@ -370,6 +290,21 @@ class StudentSchoolTestPipeline:
         print(f"  初始测试: {self.output_files['pre']}")
         print(f"  推荐材料: {self.output_files['rec']}")
         print(f"  后测试: {self.output_files['post']}")
+    
+    def run_pipeline(self):
+        """Run the complete pipeline with progress bars"""
+        async def run():
+            try:
+                await self.arun_pipeline()
+            finally:
+                await self.pool.arelease()
+        try:
+            asyncio.run(run())
+        finally:
+            if self.cache is not None:
+                print(f"缓存统计: {self.cache.stats()}")
+            # 关闭连接池和缓存
+            self.close()
 
 # Usage
 if __name__ == "__main__":
@@ -378,11 +313,19 @@ if __name__ == "__main__":
     performances = ['10', '20','30','40','50', '60','70', '80','90']
     data_path = "" # Adjust base path you create for dataset
     base_path = "" # Adjust base path you create
-    for ses in sess:
-        for performance in performances:
-            print(f"Running pipeline for SES: {ses}, Performance: {performance}")
-            pipeline = StudentSchoolTestPipeline(ses=ses, performance=performance, base_path=base_path, data_path=data_path)
-            pipeline.run_pipeline()
+    
+    # 所有 (SES, performance) 单元在同一个事件循环里并发运行，共用连接池和总并发上限
+    def make_pipeline(ses, performance, **shared):
+        return StudentSchoolTestPipeline(ses=ses, performance=performance, base_path=base_path, data_path=data_path, **shared)
+    
+    runner = SweepRunner(
+        make_pipeline,
+        {"ses": sess, "performance": performances},
+        model="gpt-4.1-mini",
+        concurrency=64,  # 整个扫描同时在途的请求数
+        slide_file=data_path + "high_school_slide_only.json"
+    )
+    runner.run()
     
     # You can also run with different parameters:
     # pipeline_high = StudentTestPipeline(ses="high", performance="80")
@@ -0,0 +1,49 @@
+import re
+import json
+
+SLIDE_NAME = re.compile(r"^\s*(slide \d+):", re.MULTILINE)
+
+
+def slide_number(name):
+    return int(name.replace("slide ", ""))
+
+
+class SlideIndex:
+    """
+    Read-only view of high_school_slide_only.json built once per run: each lecture's slides are
+    sorted and rendered as "slide X: content" lines up front, so candidate blocks and recommended
+    slide contents are dictionary lookups instead of a sort and join per row.
+    A sweep builds one index and shares it between all cells.
+    """
+
+    def __init__(self, slides_data):
+        self.slides_data = slides_data
+        self.lines = {}
+        self.blocks = {}
+        for lecture_key, lecture_data in slides_data.items():
+            if not lecture_data:
+                continue
+            lines = {name: f"{name}: {content}" for name, content in lecture_data.items() if content}
+            self.lines[lecture_key] = lines
+            self.blocks[lecture_key] = "\n".join(
+                f"{name}: {lecture_data[name]}" for name in sorted(lecture_data, key=slide_number)
+            )
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def candidates(self, lecture_id):
+        """All slides of a lecture in slide order, as one block for the recommendation prompt"""
+        return self.blocks.get(f"lecture {lecture_id}", "")
+
+    def content(self, lecture_id, slides):
+        """Rendered lines of the given slides; unknown slides are left out"""
+        lines = self.lines.get(f"lecture {lecture_id}", {})
+        return "\n".join(lines[slide] for slide in slides if slide in lines)
+
+    @staticmethod
+    def slide_names(materials):
+        """Slide names ("slide X") at the start of each line of a <materials> answer"""
+        return SLIDE_NAME.findall(materials)
@@ -1,197 +1,135 @@
-from llm_respond import LLM
-import csv
-import re
-import json
+from llm_respond import LLM, ResponseCache
+from stage_executor import StageExecutor, count_rows, run_streaming
+from sweep import SweepRunner
+from slide_index import SlideIndex
+from dataset import level_prefix
+from prompt_templates import PROMPTS, fingerprint
+from response_parser import STUDENT_ANSWER, SOCIETY_RECOMMENDATION
+import asyncio
 import os
-from tqdm import tqdm
 
 class StudentSocialTestPipeline:
-    def __init__(self, ses="low", performance="50",number = 5,quality = "low", model="gpt-4.1-mini", temperature=0.7, max_tokens=512,base_path=""):
+    def __init__(self, ses="low", performance="50",number = 5,quality = "low", model="gpt-4.1-mini", temperature=0.7, max_tokens=512,base_path="", concurrency=16, pool_size=64, cache_path=None, cache_bypass=False, mode="interactive", api_base=None, poll_interval=30, stream=False, rpm=None, tpm=None, pool=None, cache=None, slides_data=None, slide_index=None, progress=True, on_row=None, commit_every=50, commit_interval=5.0, streaming=False, queue_size=None, prompt_versions=None, reprompt=0, result_store=None, dataset=None, level="high school"):
         self.ses = ses
         self.performance = performance
         self.number = number
         self.quality = quality
-        self.recommendation = LLM(model=model, temperature=temperature, max_tokens=max_tokens)
-        self.post_student = LLM(model=model, temperature=temperature, max_tokens=max_tokens)
+        self.concurrency = concurrency  # 每个阶段同时在途的行数
+        self.mode = mode  # "interactive" 逐行并发调用，"batch" 整个阶段作为一个 Batch API 任务提交
+        self.poll_interval = poll_interval
+        self.progress = progress  # 是否显示每个阶段的进度条
+        self.on_row = on_row  # 每处理完一行调用一次，SweepRunner 用它统计总进度
+        # 结果文件每 commit_every 行或 commit_interval 秒落盘一次
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        # streaming=True 时每行推荐完成后立即进入后测试，阶段之间用长度为 queue_size 的队列衔接
+        self.streaming = streaming
+        self.queue_size = queue_size
+        # 可选的列式结果库（result_store.ResultStore），提交时与 CSV 同步写入；CSV 照常生成
+        self.result_store = result_store
+        # 可选的磁盘响应缓存，所有角色共用；扫描时可直接传入共享的缓存
+        self._owns_cache = cache is None
+        self.cache = cache if cache is not None else (ResponseCache(cache_path) if cache_path else None)
+        self.recommendation = LLM(model=model, temperature=temperature, max_tokens=max_tokens, concurrency=concurrency, pool=pool, pool_size=pool_size, rpm=rpm, tpm=tpm, cache=self.cache, cache_bypass=cache_bypass, api_base=api_base, stream=stream)
+        # 两个角色共用同一个连接池；扫描时由 SweepRunner 传入，所有单元共用
+        self.pool = self.recommendation.pool
+        self._owns_pool = pool is None
+        self.post_student = LLM(model=model, temperature=temperature, max_tokens=max_tokens, concurrency=concurrency, pool=self.pool, cache=self.cache, cache_bypass=cache_bypass, api_base=api_base, stream=stream)
         
         # File paths with SES and performance in filenames
         self.base_path = base_path
-        self.slide_file = self.base_path + "high_school_slide_only.json"
+        # 学段（ClassroomSimulacra 的 level）；传入 dataset 时从数据集缓存读取幻灯片
+        self.level = level
+        self.slide_file = self.base_path + f"{level_prefix(level)}_slide_only.json"
         self.output_files = {
             'pre': self.base_path + f"post_with_llm_{ses}_{performance}.csv",
             'rec': self.base_path + f"parent_recommend_with_llm_{ses}_{performance}.csv",
             'post': self.base_path + f"paren_teacher_post_with_llm_{ses}_{performance}.csv"
         }
+        # 每行调用的 token 用量和耗时
+        self.usage_file = self.base_path + f"parent_usage_{ses}_{performance}.csv"
+        # 重试后仍失败的行，不写入结果文件，重跑时会再次处理
+        self.failed_file = self.base_path + f"parent_failed_{ses}_{performance}.csv"
         
-        # Load slides data once
-        with open(self.slide_file, "r", encoding="utf-8") as f:
-            self.slides_data = json.load(f)
-    
+        # Build the slide index once (a sweep builds it once for all cells)
+        if slide_index is not None:
+            self.slide_index = slide_index
+        elif dataset is not None:
+            self.slide_index = dataset.slide_index(level)
+        elif slides_data is not None:
+            self.slide_index = SlideIndex(slides_data)
+        else:
+            self.slide_index = SlideIndex.from_file(self.slide_file)
+        self.slides_data = self.slide_index.slides_data
+        # 提示词模板只加载一次，单元内固定的字段在这里绑定，逐行只拼接本行的内容。
+        # 消息按“固定规则 → 课程材料 → 学生画像 → 本行记录”分层，越靠前的层在越多请求间相同，便于服务端前缀缓存命中
+        versions = prompt_versions or {}
+        self.prompts = {
+            "post": PROMPTS.render("post_rubric", versions, level=level, materials_source="materials provided by teachers in society (e.g., working in educational services or private tutoring)"),
+            "student_background": PROMPTS.render("student_background", versions, ses=ses, performance=performance),
+            "recommendation": PROMPTS.render("society_recommendation_rubric", versions, level=level),
+            "recommendation_background": PROMPTS.render("society_recommendation_background", versions, ses=ses, performance=performance, number=number, quality=quality)
+        }
+        self.lecture_template = PROMPTS.get("lecture_materials", versions.get("lecture_materials"))
+        # 每节课的候选材料块只渲染一次
+        self._lecture_materials = {}
+        # 各阶段回复的格式；格式不合格的回复最多重新询问 reprompt 次
+        self.reprompt = reprompt
+        self.schemas = {
+            "Recommendation": SOCIETY_RECOMMENDATION,
+            "Post-test": STUDENT_ANSWER
+        }
+        # 各阶段提示词的版本指纹，结果文件中已有的行来自其他版本时会提示
+        self.prompt_hashes = {
+            "Recommendation": fingerprint(self.prompts["recommendation"], self.lecture_template.text, self.prompts["recommendation_background"]),
+            "Post-test": fingerprint(self.prompts["post"], self.prompts["student_background"])
+        }
+        # 各阶段不需要调用 LLM 的行（社会老师流水线每行都要调用）
+        self.skip_rules = {}
     
-    def get_post_profile(self):
-        """Generate post-test profile"""
-        return """
-        You are a high school student taking an artificial intelligence test.
-        Your socioeconomic status (SES) is: {ses}
-        Your academic performance in AI is represented by an accuracy score of {performance}%:
-            0% means you get all answers wrong
-            100% means you get all answers correct
-        This score affects how likely you are to answer correctly and how confident you feel:
-            Higher accuracy → higher correctness + higher confidence
-            Lower accuracy → lower correctness + lower confidence
-
-        Your Task
-            You will receive AI-related test questions (multiple-choice or fill-in-the-blank).
-            For each question:
-                Use your past answers and materials provided by teachers in society (e.g., working in educational services or private tutoring) to make a new attempt.
-                Provide an answer based on what you've learned.
-                Explain why you chose that answer.
-                Report your confidence level on a scale of 0–100:
-                    0 = not confident at all
-                    100 = completely confident
-
-        Response format (must follow this structure):
-            <explanation> Your explanation here. </explanation>
-            <answer> Your answer here. (e.g., "A" for multiple choice, or a specific word/phrase for fill-in-the-blank) </answer>
-            <confidence> A number between 0 and 100. </confidence>
-
-        Examples:
-            <explanation> I chose A because supervised learning involves labeled data. </explanation>
-            <answer> A </answer>
-            <confidence> 75 </confidence>
-        """.format(ses=self.ses, performance=self.performance)
     
-    def get_recommendation_profile(self, candidate_materials=""):
-        """Generate recommendation profile"""
-        prompt = """
-        You are a teacher in society (e.g., working in educational services or private tutoring) who supports high school students in learning Artificial Intelligence (AI). Your task is to generate appropriate learning materials for a student based on their background and the specified number and quality of resources to be provided.
-
-        1. Student Background  
-            - Socioeconomic status (SES): {ses}  
-            - Academic accuracy in AI: {performance}%
-
-        2. Resource Requirements (Predefined)  
-            - Number of materials to provide: {number}  
-            - Desired quality level of materials: {quality} (one of low, middle, high)
-
-        3. Your Task  
-            - Based on the student's background and the predefined number and quality of resources, write a brief explanation for your recommendation.  
-            - Then, generate exactly {number} learning resources, with content and depth appropriate to the specified quality level `{quality}`.  
-            - You may draw from your own teaching experience and the candidate materials listed below.  
-            - Do not exceed the number of materials specified.
-
-        4. Candidate Materials  
-        {candidate_materials}
-
-        5. Response Format  
-        <explanation> Your reasoning here. </explanation>  
-        <materials>  
-        Material X: short summary  
-        ...  
-        </materials>
-        """.format(ses=self.ses, performance=self.performance, number=self.number, quality=self.quality, candidate_materials=candidate_materials)
-        return prompt
-
+    def get_lecture_materials(self, lecture_id):
+        """Per-lecture candidate materials block, rendered once per lecture"""
+        block = self._lecture_materials.get(lecture_id)
+        if block is None:
+            block = self.lecture_template.bind(candidate_materials=self.get_all_materials(lecture_id))
+            self._lecture_materials[lecture_id] = block
+        return block
     
-    def extract_response_fields(self, response, fields):
-        """Extract fields from response using regex"""
-        results = {}
-        for field in fields:
-            pattern = rf"<{field}>(.*?)</{field}>"
-            match = re.search(pattern, response, re.DOTALL if field == 'materials' else 0)
-            results[field] = match.group(1).strip() if match else ""
-        return results
-
     def get_slide(self, materials):
-        lines = materials.strip().split('\n')
-        slides = []
-        for line in lines:
-            match = re.match(r"(slide \d+):", line.strip())
-            if match:
-                slides.append(match.group(1))
-        return slides
+        return self.slide_index.slide_names(materials)
 
     def get_all_materials(self, lecture_id):
         """Get all materials for a lecture"""
-        lecture_key = f"lecture {lecture_id}"
-        lecture_data = self.slides_data.get(lecture_key, {})
-        
-        if not lecture_data:
-            return ""
-            
-        sorted_slides = sorted(lecture_data.items(), key=lambda x: int(x[0].replace("slide ", "")))
-        return "\n".join(f"{key}: {value}" for key, value in sorted_slides)
+        return self.slide_index.candidates(lecture_id)
     
     def count_total_rows(self, input_file):
         """Count total rows in CSV file for progress bar"""
-        with open(input_file, "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            return sum(1 for _ in reader)
+        return count_rows(input_file)
     
-    def process_csv_stage(self, input_file, output_file, process_func, new_fields, stage_name):
-        """Generic CSV processing function with progress bar"""
-        # Read completed records
-        completed_set = set()
-        if os.path.exists(output_file):
-            with open(output_file, "r", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    completed_set.add((row["lecture"], row["question"]))
-        
-        # Count total rows for progress bar
-        total_rows = self.count_total_rows(input_file)
-        
-        # Process records
-        with open(output_file, "a", newline="", encoding="utf-8") as outfile:
-            with open(input_file, "r", encoding="utf-8") as infile:
-                reader = csv.DictReader(infile)
-                fieldnames = reader.fieldnames + new_fields
-                # Add SES and performance columns if they don't exist
-                if "ses" not in fieldnames:
-                    fieldnames = fieldnames + ["ses", "performance"]
-                writer = csv.DictWriter(outfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
-                
-                if os.stat(output_file).st_size == 0:
-                    writer.writeheader()
-                
-                # Create progress bar
-                pbar = tqdm(total=total_rows, desc=f"{stage_name} Processing", unit="rows")
-                
-                processed_count = 0
-                for row in reader:
-                    key = (row["lecture"], row["question"])
-                    if key in completed_set:
-                        pbar.update(1)
-                        continue
-                    
-                    # Add SES and performance to row
-                    row["ses"] = self.ses
-                    row["performance"] = self.performance
-                    
-                    # Process the row
-                    new_data = process_func(row)
-                    row.update(new_data)
-                    
-                    writer.writerow(row)
-                    outfile.flush()
-                    
-                    processed_count += 1
-                    pbar.set_postfix({
-                        'Lecture': row['lecture'], 
-                        'Question': row['question'],
-                        'Processed': processed_count
-                    })
-                    pbar.update(1)
-                
-                pbar.close()
+    def process_csv_stage(self, *args):
+        """Blocking wrapper around aprocess_csv_stage"""
+        async def run():
+            try:
+                await self.aprocess_csv_stage(*args)
+            finally:
+                # 异步连接绑定在本次的事件循环上，结束前释放
+                await self.pool.arelease()
+        asyncio.run(run())
     
-
+    def expected_rows(self):
+        """Rows this pipeline will process over all stages, for sweep progress"""
+        if not os.path.exists(self.output_files['pre']):
+            return 0
+        return 2 * self.count_total_rows(self.output_files['pre'])
     
-    def process_recommendation(self, row):
-        """Process recommendation stage"""
-        candidate_materials = self.get_all_materials(row['lecture'])
-        profile = self.get_recommendation_profile(candidate_materials=candidate_materials)
-        
+    async def aprocess_csv_stage(self, input_file, output_file, llm, build_func, parse_func, new_fields, stage_name):
+        """Generic CSV processing function with progress bar; rows are sent concurrently but written in input order"""
+        executor = StageExecutor(self, input_file, output_file, llm, build_func, parse_func, new_fields, stage_name)
+        await executor.run()
+    
+    def build_recommendation_prompt(self, row):
+        """Build recommendation messages"""
         history = f"""
         The student's history records are as follows:
         Question: {row["contents"]}
@@ -199,13 +137,16 @@ class StudentSocialTestPipeline:
         Correct answer: {row["correct_answer"]}
         """
         
-        prompt = [
-            {"role": "system", "content": profile},
+        return [
+            {"role": "system", "content": self.prompts["recommendation"]},
+            {"role": "system", "content": self.get_lecture_materials(row['lecture'])},
+            {"role": "system", "content": self.prompts["recommendation_background"]},
             {"role": "user", "content": history}
         ]
-        
-        response = self.recommendation.chat(prompt)
-        fields = self.extract_response_fields(response, ["materials"])
+    
+    def parse_recommendation(self, row, response):
+        """Parse recommendation reply"""
+        fields = SOCIETY_RECOMMENDATION.parse(response).values
         
 
         return {
@@ -213,14 +154,15 @@ class StudentSocialTestPipeline:
             "parent_recommendation": response
         }
     
-    def process_post_test(self, row):
-        """Process post-test stage"""
-        # Skip if no recommendation was made
-        
+    def process_recommendation(self, row):
+        """Process recommendation stage"""
+        return self.parse_recommendation(row, self.recommendation.chat(self.build_recommendation_prompt(row)))
+    
+    def build_post_test_prompt(self, row):
+        """Build post-test messages"""
         # Get materials content
         materials_content =  row["parent_materials"]
         
-        profile = self.get_post_profile()
         question_format = f"""
         The student's history records are as follows:
         Question: {row["contents"]}
@@ -229,13 +171,15 @@ class StudentSocialTestPipeline:
         Materials recommended: {materials_content}
         """
         
-        prompt = [
-            {"role": "system", "content": profile},
+        return [
+            {"role": "system", "content": self.prompts["post"]},
+            {"role": "system", "content": self.prompts["student_background"]},
             {"role": "user", "content": question_format}
         ]
-        
-        response = self.post_student.chat(prompt)
-        fields = self.extract_response_fields(response, ["answer", "confidence"])
+    
+    def parse_post_test(self, row, response):
+        """Parse post-test reply"""
+        fields = STUDENT_ANSWER.parse(response).values
         
         return {
             "parent_post_llm_answer": fields["answer"],
@@ -243,36 +187,61 @@ class StudentSocialTestPipeline:
             "parent_post_response": response
         }
     
-    def run_pipeline(self):
-        """Run the complete pipeline with progress bars"""
+    def process_post_test(self, row):
+        """Process post-test stage"""
+        return self.parse_post_test(row, self.post_student.chat(self.build_post_test_prompt(row)))
+    
+    def close(self):
+        """Close the client pool and response cache unless they are shared with other pipelines"""
+        if self._owns_pool:
+            self.pool.close()
+        if self.cache is not None and self._owns_cache:
+            self.cache.close()
+    
+    def stages(self):
+        """Arguments of aprocess_csv_stage for each stage, in order"""
+        return [
+            (self.output_files['pre'], self.output_files['rec'], self.recommendation, self.build_recommendation_prompt, self.parse_recommendation,
+             ["parent_materials", "parent_recommendation"], "Recommendation"),
+            (self.output_files['rec'], self.output_files['post'], self.post_student, self.build_post_test_prompt, self.parse_post_test,
+             ["parent_post_llm_answer", "parent_post_llm_confidence", "parent_post_response"], "Post-test")
+        ]
+    
+    async def arun_pipeline(self):
+        """Run all stages in the caller's event loop, so a sweep can run many cells concurrently"""
         print(f"开始运行学生测试流水线 - SES: {self.ses}, Performance: {self.performance}")
         print("=" * 60)
-        
-        
-        
-        print("\n阶段 1: 推荐材料...")
-        self.process_csv_stage(
-            self.output_files['pre'],
-            self.output_files['rec'],
-            self.process_recommendation,
-            ["parent_materials", "parent_recommendation"],
-            "Recommendation"
-        )
-        
-        print("\n阶段 2: 后测试...")
-        self.process_csv_stage(
-            self.output_files['rec'],
-            self.output_files['post'],
-            self.process_post_test,
-            ["parent_post_llm_answer", "parent_post_llm_confidence", "parent_post_response"],
-            "Post-test"
-        )
+        rec, post = self.stages()
+        if self.streaming and self.mode != "batch":
+            print("\n逐行流水线: 推荐材料 → 后测试...")
+            await run_streaming(self, [rec, post], self.queue_size)
+        else:
+            print("\n阶段 1: 推荐材料...")
+            await self.aprocess_csv_stage(*rec)
+            
+            print("\n阶段 2: 后测试...")
+            await self.aprocess_csv_stage(*post)
         
         print("\n" + "=" * 60)
         print("流水线完成！")
         print(f"结果文件保存在:")
         print(f"  家庭推荐材料: {self.output_files['rec']}")
         print(f"  家庭后测试: {self.output_files['post']}")
+    
+    def run_pipeline(self):
+        """Run the complete pipeline with progress bars"""
+        async def run():
+            try:
+                await self.arun_pipeline()
+            finally:
+                await self.pool.arelease()
+        try:
+            asyncio.run(run())
+        finally:
+            if self.cache is not None:
+                print(f"缓存统计: {self.cache.stats()}")
+            # 关闭连接池和缓存
+            self.close()
 
 # Usage
 if __name__ == "__main__":
@@ -297,18 +266,25 @@ if __name__ == "__main__":
 
     base_path = "" # Adjust base path you create
 
-    for ses in sess:
-        for performance in performances:
-            # Get number and quality from lookup_dict
-            key = (ses, performance)
-            if key not in lookup_dict:
-                print(f"No data found for SES: {ses}, Performance: {performance}")
-                continue
-            number = lookup_dict[key]['Number']
-            quality = lookup_dict[key]['Quality']
-            print(f"Running pipeline for SES: {ses}, Performance: {performance}")
-            pipeline = StudentSocialTestPipeline(ses=ses, performance=performance, number=number, quality=quality, base_path=base_path)
-            pipeline.run_pipeline()
+    # 所有 (SES, performance) 单元在同一个事件循环里并发运行，共用连接池和总并发上限
+    def make_pipeline(ses, performance, **shared):
+        # Get number and quality from lookup_dict
+        key = (ses, performance)
+        if key not in lookup_dict:
+            print(f"No data found for SES: {ses}, Performance: {performance}")
+            return None
+        number = lookup_dict[key]['Number']
+        quality = lookup_dict[key]['Quality']
+        return StudentSocialTestPipeline(ses=ses, performance=performance, number=number, quality=quality, base_path=base_path, **shared)
+
+    runner = SweepRunner(
+        make_pipeline,
+        {"ses": sess, "performance": performances},
+        model="gpt-4.1-mini",
+        concurrency=64,  # 整个扫描同时在途的请求数
+        slide_file=base_path + "high_school_slide_only.json"
+    )
+    runner.run()
     
     # You can also run with different parameters:
     # pipeline_high = StudentTestPipeline(ses="high", performance="80")
@@ -0,0 +1,583 @@
+import io
+import os
+import csv
+import time
+import asyncio
+import contextlib
+from tqdm import tqdm
+from llm_respond import BudgetExceeded, LLMCallError, run_ordered, set_log_context
+from batch_job import run_batch_rows
+from metrics import metrics, set_labels
+
+
+def read_index(path):
+    """Committed keys and CSV offset of a completion index file"""
+    keys = set()
+    offset = 0
+    pending = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("@"):
+                keys.update(pending)
+                pending = []
+                offset = int(line[1:])
+            elif line:
+                lecture, _, question = line.partition("\t")
+                pending.append((lecture, question))
+    return keys, offset
+
+
+class CompletionIndex:
+    """
+    Append-only sidecar (<output>.done) listing the row keys committed to a stage's output CSV.
+    Keys are followed by a checkpoint line "@<bytes>" holding the CSV size at that commit; keys
+    after the last checkpoint and CSV bytes beyond it were never committed and are dropped on open,
+    so resume neither rescans the CSV nor duplicates rows after a crash.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.path = output_file + ".done"
+        self.keys = set()
+        self.offset = 0
+        if os.path.exists(self.path):
+            self.keys, self.offset = read_index(self.path)
+        elif os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+            self._rebuild()
+        self._truncate_output()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _rebuild(self):
+        """One-off scan of an output CSV written before the index existed"""
+        with open(self.output_file, "r", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                self.keys.add((row["lecture"], row["question"]))
+        self.offset = os.path.getsize(self.output_file)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("".join(f"{lecture}\t{question}\n" for lecture, question in self.keys))
+            f.write(f"@{self.offset}\n")
+
+    def _truncate_output(self):
+        if os.path.exists(self.output_file) and os.path.getsize(self.output_file) > self.offset:
+            with open(self.output_file, "r+b") as f:
+                f.truncate(self.offset)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def commit(self, keys, offset):
+        """Durably record `keys` once the output CSV has been synced up to `offset` bytes"""
+        self._file.write("".join(f"{lecture}\t{question}\n" for lecture, question in keys))
+        self._file.write(f"@{offset}\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.keys.update(keys)
+        self.offset = offset
+
+    def close(self):
+        self._file.close()
+
+
+def count_rows(input_file):
+    """Row count of a stage input, read from its completion index when it has one"""
+    if not isinstance(input_file, str):
+        return len(input_file)
+    if os.path.exists(input_file + ".done"):
+        return len(read_index(input_file + ".done")[0])
+    with open(input_file, "r", encoding="utf-8") as f:
+        return sum(1 for _ in csv.DictReader(f))
+
+
+def open_input(input_file):
+    """
+    (fieldnames, rows, file to close) of a stage input: a CSV path or a dataset view such as
+    Dataset.tests(level), which yields the same rows as the level's test CSV.
+    """
+    if not isinstance(input_file, str):
+        return input_file.fieldnames, iter(input_file), None
+    f = open(input_file, "r", encoding="utf-8")
+    reader = csv.DictReader(f)
+    return reader.fieldnames, reader, f
+
+
+def read_header(path):
+    """Header row of a CSV, or None when the file is missing or empty"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        return next(csv.reader(f), None)
+
+
+USAGE_HEADER = ["stage", "lecture", "question", "prompt_tokens", "completion_tokens", "latency", "cached", "cached_tokens",
+                "reprompts", "parse_errors"]
+FAILED_HEADER = ["stage", "lecture", "question", "status_code", "attempts", "error"]
+
+
+def open_log_csv(path, header):
+    """
+    Open a per-cell log CSV for appending, writing the header to a new file. A file written with
+    an older header is moved aside to <path>.old first, so its columns never get mixed up.
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            current = next(csv.reader(f), [])
+        if current != header:
+            os.replace(path, path + ".old")
+    f = open(path, "a", newline="", encoding="utf-8")
+    writer = csv.writer(f)
+    if f.tell() == 0:
+        writer.writerow(header)
+    return f, writer
+
+
+class CellLogs:
+    """
+    The usage and failed-row CSVs of one pipeline cell. Streaming stages run at the same time and
+    share one CellLogs, so the header is written once and rows are not interleaved by separate
+    buffered handles on the same file.
+    """
+
+    def __init__(self, pipeline):
+        self.usagefile, self.usage_writer = open_log_csv(pipeline.usage_file, USAGE_HEADER)
+        self.failedfile, self.failed_writer = open_log_csv(pipeline.failed_file, FAILED_HEADER)
+
+    def flush(self):
+        self.usagefile.flush()
+        self.failedfile.flush()
+
+    def close(self):
+        self.usagefile.close()
+        self.failedfile.close()
+
+
+def merge_results(first, retry):
+    """One ChatResult for a row whose reply took several calls: the last reply, summed usage"""
+    return retry._replace(
+        prompt_tokens=first.prompt_tokens + retry.prompt_tokens,
+        completion_tokens=first.completion_tokens + retry.completion_tokens,
+        latency=None if first.latency is None or retry.latency is None else first.latency + retry.latency,
+        cached=first.cached and retry.cached,
+        cached_tokens=first.cached_tokens + retry.cached_tokens
+    )
+
+
+class StageExecutor:
+    """
+    Run one pipeline stage over a CSV in a single pass: rows are dispatched concurrently, written
+    in input order and group-committed every `commit_every` rows or `commit_interval` seconds.
+    Rows the pipeline's skip rule for the stage marks as no-ops, and rows already committed, are
+    resolved on the spot without taking one of the `concurrency` slots; they are still written at
+    their input position.
+    """
+
+    def __init__(self, pipeline, input_file, output_file, llm, build_func, parse_func, new_fields, stage_name):
+        self.pipeline = pipeline
+        self.input_file = input_file
+        self.output_file = output_file
+        self.llm = llm
+        self.build_func = build_func
+        self.parse_func = parse_func
+        self.new_fields = new_fields
+        self.stage_name = stage_name
+        # 本阶段指标的标签
+        self.labels = {"ses": str(pipeline.ses), "performance": str(pipeline.performance), "stage": stage_name}
+        self.processed_count = 0
+        self.failed_count = 0
+        # 按跳过规则直接完成、没有调用 LLM 的行数
+        self.skip = pipeline.skip_rules.get(stage_name)
+        self.skipped_count = 0
+        self.usage_totals = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "latency": 0.0}
+        # 回复格式校验：校验过的回复数、最终仍不合格的回复数、重新询问的次数
+        self.schema = pipeline.schemas.get(stage_name)
+        self.parse_totals = {"checked": 0, "malformed": 0, "reprompts": 0}
+        self.reprompts = {}
+        # 预算用尽后不再派发新行，在途的请求照常完成并提交，阶段结束时再抛出
+        self.budget_error = None
+        self.uncommitted = []
+        self.last_commit = time.monotonic()
+        self.index = None
+        self.carry = {}
+        self.store_stage = None
+        self.uncommitted_rows = []
+
+    def open_index(self):
+        if self.index is None:
+            self.index = CompletionIndex(self.output_file)
+        return self.index
+
+    def check_prompt_version(self):
+        """Warn when rows already in the output were produced from a different prompt version"""
+        fingerprint = self.pipeline.prompt_hashes.get(self.stage_name)
+        if fingerprint is None:
+            return
+        path = self.output_file + ".prompt"
+        previous = None
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                previous = f.read().strip()
+        if previous is None or not len(self.index):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(fingerprint + "\n")
+        elif previous != fingerprint:
+            # 不自动重算：保留旧指纹，直到旧结果被删除
+            print(f"{self.stage_name}: 提示词版本已变更 ({previous} → {fingerprint})，"
+                  f"{self.output_file} 中已有 {len(self.index)} 行来自旧版本；需要重算请删除该文件及其 .done")
+
+    def open_store(self, fieldnames):
+        """
+        Register this stage in the pipeline's result store, drop store files past the committed offset
+        and import committed CSV rows the store does not have yet (e.g. from runs without a store).
+        """
+        p = self.pipeline
+        store = p.result_store
+        self.store_stage = store.stage_label(self.output_file, p.ses, p.performance)
+        parent = store.stage_label(getattr(self.input_file, "name", self.input_file), p.ses, p.performance)
+        if parent not in store.stages:
+            parent = None
+        # 上游也在库里时只存本阶段新增的列，否则存整行
+        columns = self.new_fields if parent else [f for f in fieldnames if f not in ("ses", "performance")]
+        store.register_stage(self.store_stage, parent, columns, fieldnames)
+        store.discard_after(self.store_stage, p.ses, p.performance, self.index.offset)
+
+        covered = store.covered(self.store_stage, p.ses, p.performance)
+        if covered < self.index.offset:
+            with open(self.output_file, "rb") as f:
+                f.seek(covered)
+                text = f.read(self.index.offset - covered).decode("utf-8")
+            reader = csv.DictReader(io.StringIO(text, newline=""), fieldnames=None if covered == 0 else fieldnames)
+            store.write(self.store_stage, p.ses, p.performance, list(reader), covered, self.index.offset)
+
+    def output_fieldnames(self, input_fieldnames):
+        fieldnames = input_fieldnames + self.new_fields
+        # Add SES and performance columns if they don't exist
+        if "ses" not in fieldnames:
+            fieldnames = fieldnames + ["ses", "performance"]
+        return fieldnames
+
+    def load_carry(self, downstream_index):
+        """Rows committed here but not yet downstream, to be handed on again when streaming resumes"""
+        missing = self.index.keys - downstream_index.keys
+        if missing:
+            with open(self.output_file, "r", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    key = (row["lecture"], row["question"])
+                    if key in missing:
+                        self.carry[key] = row
+
+    def skipped(self, row):
+        """Whether the stage's skip rule completes `row` without an LLM call (counted once per row)"""
+        if self.skip is None or not self.skip(row):
+            return False
+        self.skipped_count += 1
+        metrics.inc("stage_calls_avoided_total", **self.labels)
+        return True
+
+    def prepare(self, row):
+        p = self.pipeline
+        # Add SES and performance to row
+        row["ses"] = p.ses
+        row["performance"] = p.performance
+        set_log_context(cell=f"{p.ses}_{p.performance}", stage=self.stage_name, row=f"{row['lecture']}-{row['question']}")
+        set_labels(**self.labels)
+        if self.skipped(row):
+            # 不需要调用的行没有提示词
+            return None
+        return self.build_func(row)
+
+    def resolve(self, row):
+        """
+        The handle() result of a row that needs no LLM call (already committed, or a no-op under the
+        skip rule), or None when it must be dispatched. run_ordered yields these rows at their input
+        position without giving them one of the concurrency slots.
+        """
+        key = (row["lecture"], row["question"])
+        if key in self.index:
+            # 已完成的行不再调用，但流水线中仍要把它交给下一阶段
+            return self.carry.pop(key, row), None, None, True
+        if self.skip is None:
+            return None
+        row["ses"] = self.pipeline.ses
+        row["performance"] = self.pipeline.performance
+        if not self.skipped(row):
+            return None
+        row.update(self.parse_func(row, None))
+        return row, None, None, False
+
+    async def handle(self, row):
+        """Return (row, ChatResult or None, LLMCallError or None, already done) for a row resolve() left to dispatch"""
+        key = (row["lecture"], row["question"])
+        prompt = self.prepare(row)
+        try:
+            result = await self.call(key, prompt) if prompt is not None else None
+        except (LLMCallError, BudgetExceeded) as e:
+            if isinstance(e, BudgetExceeded):
+                self.budget_error = e
+            return row, None, e, False
+        row.update(self.parse_func(row, result.reply if result else None))
+        return row, result, None, False
+
+    async def call(self, key, prompt):
+        """Call the LLM, asking again (up to pipeline.reprompt times) while the reply is malformed"""
+        result = await self.llm.achat_result(prompt)
+        if self.schema is None:
+            return result
+        attempts = 0
+        errors = self.schema.parse(result.reply).errors
+        while errors and attempts < self.pipeline.reprompt:
+            # 只补发格式纠正，前面的消息不变，仍能命中前缀缓存
+            prompt = prompt + [
+                {"role": "assistant", "content": result.reply},
+                {"role": "user", "content": self.schema.correction(errors)}
+            ]
+            try:
+                retry = await self.llm.achat_result(prompt)
+            except BudgetExceeded as e:
+                # 已付费的回复保留，按不合格的回复写出
+                self.budget_error = e
+                break
+            result = merge_results(result, retry)
+            attempts += 1
+            errors = self.schema.parse(result.reply).errors
+        if attempts:
+            self.reprompts[key] = attempts
+        return result
+
+    def advance(self):
+        self.pbar.update(1)
+        if self.pipeline.on_row is not None:
+            self.pipeline.on_row()
+
+    def dispatched(self, rows):
+        """`rows` until the budget runs out"""
+        for row in rows:
+            if self.budget_error is not None:
+                return
+            yield row
+
+    async def adispatched(self, rows):
+        """
+        Async version of dispatched(). After the budget runs out the upstream stage is still read to
+        its end, so it can finish; those rows are committed there and handed on again on resume.
+        """
+        async for row in rows:
+            if self.budget_error is None:
+                yield row
+
+    def pending_rows(self, reader):
+        for row in reader:
+            if (row["lecture"], row["question"]) in self.index:
+                self.advance()
+                continue
+            yield row
+
+    def write(self, row, result, error):
+        if error is not None:
+            # 失败的行不算完成
+            self.failed_writer.writerow([self.stage_name, row["lecture"], row["question"], error.status_code, error.attempts, str(error)])
+            self.failed_count += 1
+            metrics.inc("stage_rows_failed_total", **self.labels)
+            self.advance()
+            return
+
+        self.writer.writerow(row)
+        self.uncommitted.append((row["lecture"], row["question"]))
+        if self.store_stage is not None:
+            self.uncommitted_rows.append(row)
+
+        if result is not None:
+            reprompts = self.reprompts.pop((row["lecture"], row["question"]), 0)
+            errors = self.schema.parse(result.reply).errors if self.schema is not None else []
+            if self.schema is not None:
+                self.parse_totals["checked"] += 1
+                self.parse_totals["malformed"] += bool(errors)
+                self.parse_totals["reprompts"] += reprompts
+                metrics.inc("stage_parse_failures_total", bool(errors), **self.labels)
+                metrics.inc("stage_reprompts_total", reprompts, **self.labels)
+            self.usage_writer.writerow([
+                self.stage_name, row["lecture"], row["question"], result.prompt_tokens,
+                result.completion_tokens, "" if result.latency is None else f"{result.latency:.3f}", int(result.cached),
+                result.cached_tokens, reprompts, "; ".join(errors)
+            ])
+            self.usage_totals["calls"] += 1
+            self.usage_totals["prompt_tokens"] += result.prompt_tokens
+            self.usage_totals["completion_tokens"] += result.completion_tokens
+            self.usage_totals["cached_tokens"] += result.cached_tokens
+            self.usage_totals["latency"] += result.latency or 0.0
+
+        self.processed_count += 1
+        metrics.inc("stage_rows_completed_total", **self.labels)
+        self.pbar.set_postfix({
+            'Lecture': row['lecture'],
+            'Question': row['question'],
+            'Processed': self.processed_count
+        })
+        self.advance()
+
+        if (len(self.uncommitted) >= self.pipeline.commit_every
+                or time.monotonic() - self.last_commit >= self.pipeline.commit_interval):
+            self.commit()
+
+    def commit(self):
+        """Group commit: sync the output CSV, then record its keys and size in the index"""
+        self.outfile.flush()
+        os.fsync(self.outfile.fileno())
+        self.logs.flush()
+        offset = os.fstat(self.outfile.fileno()).st_size
+        if self.store_stage is not None:
+            p = self.pipeline
+            p.result_store.write(self.store_stage, p.ses, p.performance, self.uncommitted_rows, self.index.offset, offset)
+            self.uncommitted_rows = []
+        self.index.commit(self.uncommitted, offset)
+        self.uncommitted = []
+        self.last_commit = time.monotonic()
+
+    async def run(self, source=None, input_fieldnames=None, total_rows=None, sink=None, logs=None):
+        """
+        Process the stage. By default rows are read from `input_file`; in a streaming pipeline they
+        come from the async iterable `source` instead, every finished row is put on `sink`, and the
+        cell's CellLogs are passed in as `logs` (otherwise the stage opens and closes its own).
+        """
+        p = self.pipeline
+        self.open_index()
+        self.check_prompt_version()
+        infile = None
+        if source is None:
+            total_rows = count_rows(self.input_file)
+            input_fieldnames, source, infile = open_input(self.input_file)
+
+        self.logs = logs if logs is not None else CellLogs(p)
+        self.usage_writer = self.logs.usage_writer
+        self.failed_writer = self.logs.failed_writer
+        with open(self.output_file, "a", newline="", encoding="utf-8") as self.outfile, \
+                (contextlib.closing(self.logs) if logs is None else contextlib.nullcontext()):
+            fieldnames = self.output_fieldnames(input_fieldnames)
+            extrasaction = "raise"
+            header = read_header(self.output_file)
+            if header is not None and header != fieldnames:
+                # 已有的结果文件来自列不同的旧版本：续写时沿用它的表头，列才不会错位
+                print(f"{self.stage_name}: {self.output_file} 的列与当前版本不同，续写时沿用已有的列")
+                fieldnames = header
+                extrasaction = "ignore"
+            self.writer = csv.DictWriter(self.outfile, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL, extrasaction=extrasaction)
+            if os.stat(self.output_file).st_size == 0:
+                self.writer.writeheader()
+            if p.result_store is not None:
+                self.open_store(fieldnames)
+
+            # Create progress bar
+            self.pbar = tqdm(total=total_rows, desc=f"{self.stage_name} Processing", unit="rows", disable=not p.progress)
+            try:
+                if p.mode == "batch":
+                    # 轮询批处理会阻塞，放到线程里，不影响同一事件循环中的其他单元
+                    # 以输出文件名命名（如 post_with_llm_low_50），学校和社会流水线的同名阶段不会共用批处理
+                    job_name = os.path.splitext(os.path.basename(self.output_file))[0]
+                    finished = await asyncio.to_thread(
+                        run_batch_rows, self.pending_rows(source), self.llm, self.prepare, self.parse_func, job_name,
+                        work_dir=p.base_path + "batch_jobs", poll_interval=p.poll_interval
+                    )
+                    for row, result, error in finished:
+                        self.write(row, result, error)
+                else:
+                    rows = self.adispatched(source) if hasattr(source, "__aiter__") else self.dispatched(source)
+                    async for row, result, error, done in run_ordered(rows, self.handle, p.concurrency, self.resolve):
+                        if isinstance(error, BudgetExceeded):
+                            # 没有发出的行不算失败，重跑时再处理
+                            continue
+                        if done:
+                            self.advance()
+                        else:
+                            self.write(row, result, error)
+                        if sink is not None and error is None:
+                            await sink.put(row)
+            finally:
+                # 中断时也把已经写出的行提交
+                self.commit()
+                self.index.close()
+                self.pbar.close()
+                if infile is not None:
+                    infile.close()
+
+        totals = self.usage_totals
+        if totals["calls"]:
+            print(f"{self.stage_name}: {totals['calls']} 次调用, "
+                  f"输入 {totals['prompt_tokens']} tokens (前缀缓存命中 {totals['cached_tokens']}), "
+                  f"输出 {totals['completion_tokens']} tokens, "
+                  f"平均耗时 {totals['latency'] / totals['calls']:.2f}s")
+        parsed = self.parse_totals
+        if parsed["checked"]:
+            print(f"{self.stage_name}: 回复格式不合格 {parsed['malformed']}/{parsed['checked']} "
+                  f"({parsed['malformed'] / parsed['checked']:.1%}), 重新询问 {parsed['reprompts']} 次")
+        if self.skipped_count:
+            print(f"{self.stage_name} ({p.ses}_{p.performance}): 免去 {self.skipped_count} 次调用（按跳过规则直接完成的行）")
+        if self.failed_count:
+            print(f"{self.stage_name}: {self.failed_count} 行调用失败，已记录到 {p.failed_file}，重跑时会重试")
+        if self.budget_error is not None:
+            raise self.budget_error
+
+
+async def drain(queue):
+    """Iterate a stage queue until its producer puts the end marker None"""
+    while True:
+        row = await queue.get()
+        if row is None:
+            return
+        yield row
+
+
+async def run_streaming(pipeline, stages, queue_size=None):
+    """
+    Run `stages` (StageExecutor argument tuples, in order) as one row-level pipeline: a row moves on
+    to the next stage as soon as it finishes the previous one, through bounded queues, so every
+    stage's LLM calls overlap. Each stage still writes and commits its own CSV as in staged runs.
+    """
+    executors = [StageExecutor(pipeline, *stage) for stage in stages]
+    for executor in executors:
+        executor.open_index()
+    # 中断后重跑：上游已完成、下游未完成的行从上游输出补发
+    for upstream, downstream in zip(executors, executors[1:]):
+        upstream.load_carry(downstream.index)
+
+    queues = [asyncio.Queue(maxsize=queue_size or 2 * pipeline.concurrency) for _ in executors[1:]]
+    first_input = executors[0].input_file
+    fieldnames, _, infile = open_input(first_input)
+    if infile is not None:
+        infile.close()
+    total_rows = count_rows(first_input)
+    # 各阶段同时运行，共用本单元的 usage / failed 日志文件
+    logs = CellLogs(pipeline)
+
+    async def run_stage(i, executor, fieldnames):
+        sink = queues[i] if i < len(queues) else None
+        try:
+            await executor.run(None if i == 0 else drain(queues[i - 1]), fieldnames, total_rows, sink, logs)
+        except BudgetExceeded:
+            # 不打断其他阶段：它们停止派发，在途的请求完成并提交后自行结束
+            pass
+        finally:
+            if sink is not None:
+                await sink.put(None)
+
+    # 每个下游阶段的输入队列长度：某个阶段的队列一直是满的，说明它是瓶颈
+    for queue, executor in zip(queues, executors[1:]):
+        metrics.watch("stage_queue_depth", queue.qsize, **executor.labels)
+    tasks = []
+    for i, executor in enumerate(executors):
+        tasks.append(asyncio.ensure_future(run_stage(i, executor, fieldnames)))
+        fieldnames = executor.output_fieldnames(fieldnames)
+    try:
+        await asyncio.gather(*tasks)
+        budget_errors = [executor.budget_error for executor in executors if executor.budget_error is not None]
+        if budget_errors:
+            raise budget_errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+        # 被取消的阶段还会在 finally 里提交，等它们结束再关闭日志文件
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logs.close()
+        for executor in executors[1:]:
+            metrics.unwatch("stage_queue_depth", **executor.labels)
@@ -0,0 +1,161 @@
+import json
+import time
+import asyncio
+from itertools import product
+from llm_respond import ClientPool, ResponseCache, BudgetExceeded, resolve_endpoint
+from slide_index import SlideIndex
+from metrics import metrics, MetricsExporter
+
+
+class SweepProgress:
+    """Count finished rows over the whole grid and print throughput and ETA"""
+
+    def __init__(self, total_rows, report_interval=10.0):
+        self.total_rows = total_rows
+        self.report_interval = report_interval
+        self.done = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def update(self):
+        self.done += 1
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total_rows - self.done, 0)
+        eta = remaining / rate if rate > 0 else float("inf")
+        percent = 100 * self.done / self.total_rows if self.total_rows else 100.0
+        print(f"[Sweep] {self.done}/{self.total_rows} 行 ({percent:.1f}%), "
+              f"{rate:.1f} 行/秒, 已用 {elapsed / 60:.1f} 分钟, 预计剩余 {eta / 60:.1f} 分钟")
+
+
+def load_grid(path):
+    """Read a sweep grid such as {"ses": ["low", "high"], "performance": ["10", "90"]} from JSON"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class SweepRunner:
+    """
+    Run every (ses, performance) cell of a sweep concurrently in one event loop.
+    All cells share one client pool, whose `concurrency` is the global in-flight request budget,
+    plus the slide index and an optional response cache, so a sweep takes roughly
+    total requests / concurrency instead of the sum of all latencies.
+
+    `make_pipeline(ses, performance, **shared)` builds the pipeline of one cell and may return None to skip it.
+    dry_run() estimates the tokens, cost and duration of the sweep without calling the LLM; `budget`
+    (llm_respond.TokenBudget) stops the real run before it spends more than that.
+    """
+
+    def __init__(self, make_pipeline, grid, model="gpt-4.1-mini", concurrency=64, max_cells=None,
+                 slide_file=None, cache_path=None, rpm=None, tpm=None, api_base=None, pool_size=None,
+                 report_interval=10.0, store_path=None, dataset=None,
+                 metrics_port=None, metrics_path=None, metrics_interval=10.0, budget=None):
+        self.make_pipeline = make_pipeline
+        self.grid = grid
+        self.model = model
+        self.concurrency = concurrency
+        self.max_cells = max_cells  # 同时运行的单元数上限，None 表示不限
+        self.slide_file = slide_file
+        self.cache_path = cache_path
+        self.rpm = rpm
+        self.tpm = tpm
+        self.api_base = api_base
+        self.pool_size = pool_size or concurrency
+        self.report_interval = report_interval
+        self.store_path = store_path  # 设置后所有单元的结果同时写入这个 Parquet 结果库
+        self.dataset = dataset  # 可选的 dataset.Dataset，所有单元共用，代替各自读取题目 CSV 和幻灯片 JSON
+        # 运行指标：metrics_port 上提供 Prometheus 格式的 /metrics，metrics_path 每 metrics_interval 秒写一次 JSON 快照
+        self.metrics_port = metrics_port
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        # 可选的 TokenBudget：超出前停止发送新请求，已提交的行保留，提高预算后重跑从断点继续
+        self.budget = budget
+
+    def cells(self):
+        return list(product(self.grid["ses"], self.grid["performance"]))
+
+    async def arun(self):
+        api_key, api_base = resolve_endpoint(self.model, self.api_base)
+        pool = ClientPool(api_key, api_base, pool_size=self.pool_size, concurrency=self.concurrency,
+                          rpm=self.rpm, tpm=self.tpm, budget=self.budget)
+        cache = ResponseCache(self.cache_path) if self.cache_path else None
+        slide_index = SlideIndex.from_file(self.slide_file) if self.slide_file and self.dataset is None else None
+        result_store = None
+        if self.store_path:
+            # pyarrow 只有使用结果库时才需要
+            from result_store import ResultStore
+            result_store = ResultStore(self.store_path)
+
+        progress = SweepProgress(0, report_interval=self.report_interval)
+        shared = {
+            "model": self.model,
+            "pool": pool,
+            "cache": cache,
+            "slide_index": slide_index,
+            "result_store": result_store,
+            "dataset": self.dataset,
+            "concurrency": self.concurrency,
+            "progress": False,
+            "on_row": progress.update
+        }
+        pipelines = []
+        for ses, performance in self.cells():
+            pipeline = self.make_pipeline(ses, performance, **shared)
+            if pipeline is not None:
+                pipelines.append(pipeline)
+        progress.total_rows = sum(pipeline.expected_rows() for pipeline in pipelines)
+        print(f"[Sweep] 共 {len(pipelines)} 个单元, {progress.total_rows} 行, 并发上限 {self.concurrency}")
+
+        cell_limit = asyncio.Semaphore(self.max_cells or len(pipelines) or 1)
+        exporter = None
+        if self.metrics_port is not None or self.metrics_path is not None:
+            metrics.set("sweep_rows_expected", progress.total_rows)
+            exporter = MetricsExporter(metrics, port=self.metrics_port, snapshot_path=self.metrics_path,
+                                       interval=self.metrics_interval).start()
+            if self.metrics_port is not None:
+                print(f"[Sweep] 运行指标: http://127.0.0.1:{exporter.port}/metrics")
+
+        async def run_cell(pipeline):
+            async with cell_limit:
+                await pipeline.arun_pipeline()
+
+        try:
+            results = await asyncio.gather(*(run_cell(p) for p in pipelines), return_exceptions=True)
+        finally:
+            await pool.arelease()
+            pool.close()
+            if exporter is not None:
+                exporter.stop()
+            if cache is not None:
+                print(f"缓存统计: {cache.stats()}")
+                cache.close()
+
+        progress.report()
+        failed = [(p.ses, p.performance, r) for p, r in zip(pipelines, results) if isinstance(r, Exception)]
+        for ses, performance, error in failed:
+            if not isinstance(error, BudgetExceeded):
+                print(f"[Sweep] SES: {ses}, Performance: {performance} 失败: {error!r}")
+        if self.budget is not None:
+            paused = sum(isinstance(error, BudgetExceeded) for _, _, error in failed)
+            if paused:
+                print(f"[Sweep] 已达到预算上限，{paused} 个单元已暂停；已完成的行已保存，提高预算后重跑会从断点继续")
+            print(f"[Sweep] 预算: {self.budget.summary()}")
+        return failed
+
+    def run(self):
+        """Run the whole sweep; returns the cells that raised"""
+        return asyncio.run(self.arun())
+
+    def dry_run(self, inputs=None, latency=None):
+        """Print and return cost_planner.plan_sweep for this sweep; nothing is sent to the LLM"""
+        from cost_planner import plan_sweep, format_plan
+        plan = plan_sweep(self, inputs=inputs, latency=latency)
+        for line in format_plan(plan):
+            print(f"[Dry run] {line}")
+        return plan
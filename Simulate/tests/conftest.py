@@ -0,0 +1,35 @@
+import os
+import sys
+import csv
+import json
+
+import pytest
+
+# Simulate 下的模块按名字互相导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_respond
+
+
+@pytest.fixture(autouse=True)
+def conversation_log(tmp_path):
+    """Write each test's conversation log under its tmp_path instead of the working directory"""
+    logger = llm_respond.configure_conversation_log(path=str(tmp_path / "conversation_log.jsonl"))
+    yield logger
+    llm_respond.configure_conversation_log(enabled=False)
+
+
+@pytest.fixture
+def school_data(tmp_path):
+    """Data directory (with trailing separator) holding a small high_school slide JSON and test CSV"""
+    path = str(tmp_path) + os.sep
+    slides = {f"lecture {l}": {f"slide {s}": f"content {l}-{s}" for s in (1, 2, 3)} for l in (1, 2, 3)}
+    with open(path + "high_school_slide_only.json", "w", encoding="utf-8") as f:
+        json.dump(slides, f)
+    with open(path + "high_school_test_only.csv", "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["lecture", "question", "contents", "slide", "correct_answer"])
+        for l in (1, 2, 3):
+            for q in range(1, 7):
+                writer.writerow([l, q, f"Question {l}.{q}, with a comma\nand a newline", f"slide {q}", "A"])
+    return path
@@ -0,0 +1,40 @@
+import numpy as np
+
+from answer_scorer import AnswerScorer
+
+# 选择题按选项字母比较；填空题的模糊 F1 依次为 1.0、0.8（恰好等于 accept）、0.67（待定区间）、0.0
+CORRECT = ["B", "B", "supervised learning", "supervised learning", "supervised learning", "supervised learning", ""]
+ANSWERS = ["(b) because it is labeled", "Answer: C", "Supervized learning.", "supervised learning algorithm",
+           "learning", "deep reinforcement", "anything"]
+QUESTIONS = [f"Question {i}" for i in range(len(ANSWERS))]
+
+
+class FakeJudge:
+    def __init__(self, verdict):
+        self.verdict = verdict
+        self.asked = []
+
+    def judge(self, questions, correct, answers):
+        self.asked.extend(zip(questions, correct, answers))
+        return np.full(len(answers), self.verdict)
+
+
+def test_thresholds_without_judge():
+    scorer = AnswerScorer(accept=0.8, reject=0.5)
+    assert scorer.score(ANSWERS, CORRECT).tolist() == [1, 0, 1, 1, 0, 0, 0]
+    # 降低 accept 后待定区间的答案直接算对
+    assert AnswerScorer(accept=0.6, reject=0.5).score(ANSWERS, CORRECT).tolist() == [1, 0, 1, 1, 1, 0, 0]
+
+
+def test_only_the_ambiguous_band_goes_to_the_judge():
+    judge = FakeJudge(True)
+    scorer = AnswerScorer(accept=0.8, reject=0.5, judge=judge)
+    assert scorer.score(ANSWERS, CORRECT, QUESTIONS).tolist() == [1, 0, 1, 1, 1, 0, 0]
+    assert judge.asked == [("Question 4", "supervised learning", "learning")]
+
+    judge = FakeJudge(False)
+    assert AnswerScorer(judge=judge).score(ANSWERS, CORRECT, QUESTIONS).tolist() == [1, 0, 1, 1, 0, 0, 0]
+    # 没有题目文本时不调用判定
+    judge = FakeJudge(True)
+    assert AnswerScorer(judge=judge).score(ANSWERS, CORRECT).tolist() == [1, 0, 1, 1, 0, 0, 0]
+    assert judge.asked == []
@@ -0,0 +1,82 @@
+import json
+from types import SimpleNamespace
+
+from llm_respond import LLM, ClientPool
+from batch_job import run_batch_rows
+
+
+class FakeBatchClient:
+    """Files and batches endpoints that answer every request with its last message, or fail those in `failing`"""
+
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.files = SimpleNamespace(create=self.create_file, content=lambda file_id: SimpleNamespace(text=self.stored[file_id]))
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve)
+        self.stored = {}
+
+    def create_file(self, file, purpose):
+        file_id = f"file-{len(self.stored)}"
+        self.stored[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id)
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        lines = []
+        # 输出顺序与输入不同，结果只能按 custom_id 对应
+        for line in reversed(self.stored[input_file_id].splitlines()):
+            request = json.loads(line)
+            content = request["body"]["messages"][-1]["content"]
+            if content in self.failing:
+                response = {"status_code": 500, "body": {"error": {"message": "server error"}}}
+            else:
+                response = {"status_code": 200, "body": {"choices": [{"message": {"content": content}}],
+                                                         "usage": {"prompt_tokens": 3, "completion_tokens": 1}}}
+            lines.append(json.dumps({"custom_id": request["custom_id"], "response": response, "error": None}))
+        output_id = f"file-{len(self.stored)}"
+        self.stored[output_id] = "\n".join(lines)
+        return SimpleNamespace(id=output_id.replace("file", "batch"))
+
+    def retrieve(self, batch_id):
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id=batch_id.replace("batch", "file"), request_counts=None)
+
+
+def make_llm(client):
+    pool = ClientPool("test-key")
+    pool._client = client
+    return LLM("gpt-4.1-mini", pool=pool)
+
+
+def build(row):
+    return None if row["n"] == "skip" else [{"role": "user", "content": row["n"]}]
+
+
+def parse(row, reply):
+    return {"reply": reply}
+
+
+def test_results_map_back_to_rows_with_colliding_keys(tmp_path):
+    llm = make_llm(FakeBatchClient())
+    # 按 "lecture-question" 拼接时前两行都是 "1-2-3"；后两行的键相同
+    rows = [
+        {"lecture": "1-2", "question": "3", "n": "a"},
+        {"lecture": "1", "question": "2-3", "n": "b"},
+        {"lecture": "4", "question": "5", "n": "c"},
+        {"lecture": "4", "question": "5", "n": "d"},
+        {"lecture": "1", "question": "2-3", "n": "skip"},
+    ]
+    finished = run_batch_rows(rows, llm, build, parse, "stage", work_dir=str(tmp_path), poll_interval=0)
+    assert [row["n"] for row, _, _ in finished] == ["a", "b", "c", "d", "skip"]
+    assert all(error is None for _, _, error in finished)
+    assert [row["reply"] for row, _, _ in finished] == ["a", "b", "c", "d", None]
+    assert [result is not None for _, result, _ in finished] == [True, True, True, True, False]
+
+
+def test_failed_request_is_reported_for_its_own_row(tmp_path):
+    llm = make_llm(FakeBatchClient(failing=("b",)))
+    rows = [{"lecture": "1", "question": "1", "n": "a"}, {"lecture": "1", "question": "1", "n": "b"},
+            {"lecture": "1", "question": "2", "n": "c"}]
+    finished = run_batch_rows(rows, llm, build, parse, "stage", work_dir=str(tmp_path), poll_interval=0)
+    assert [(row["n"], error is not None) for row, _, error in finished] == [("a", False), ("b", True), ("c", False)]
+    assert finished[0][0]["reply"] == "a" and finished[2][0]["reply"] == "c"
+    assert "reply" not in finished[1][0]
+    # 批处理结束后不保留状态文件，重跑时失败的行重新提交
+    assert not (tmp_path / "stage_state.json").exists()
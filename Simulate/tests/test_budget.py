@@ -0,0 +1,56 @@
+import csv
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from llm_respond import LLM, BudgetExceeded, ClientPool, TokenBudget
+from mock_server import LatencyModel, MockLLMServer
+from school_test import StudentSchoolTestPipeline
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_budget_lets_in_flight_requests_finish_and_counts_them(school_data, streaming):
+    # 每个请求预留约 500 tokens；预算在运行中途用尽，此时（逐行流水线中各阶段的）请求还在途，完成顺序不定
+    budget = TokenBudget(max_tokens=6000)
+    with MockLLMServer(latency=LatencyModel("uniform", low=0.01, high=0.1)) as server:
+        pool = ClientPool("local", server.base_url, concurrency=4, budget=budget)
+        pipeline = StudentSchoolTestPipeline(
+            ses="low", performance="50", model="gpt-4.1-mini", max_tokens=64, data_path=school_data,
+            base_path=school_data, pool=pool, concurrency=4, progress=False, streaming=streaming
+        )
+        with pytest.raises(BudgetExceeded):
+            pipeline.run_pipeline()
+        pool.close()
+        stats = server.stats()
+
+    assert stats["requests"] > 0
+    assert budget.reserved_tokens == 0
+    # 在途的请求没有被取消：服务端计费的每个回复都记入预算，并写进了结果
+    assert budget.spent_tokens == stats["prompt_tokens"] + stats["completion_tokens"]
+    assert budget.spent_tokens <= budget.max_tokens
+    with open(pipeline.usage_file, "r", newline="", encoding="utf-8") as f:
+        assert len(list(csv.DictReader(f))) == stats["requests"]
+
+
+def test_cancelled_request_is_counted_at_its_reservation():
+    budget = TokenBudget(max_tokens=10000)
+    pool = ClientPool("test-key", budget=budget)
+    llm = LLM("gpt-4.1-mini", max_tokens=64, pool=pool)
+    messages = [{"role": "user", "content": "x" * 400}]
+
+    async def hang(**kwargs):
+        await asyncio.Event().wait()
+
+    async def run():
+        pool._async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=hang)))
+        pool._async_loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(llm.achat_result(messages))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
+
+    assert budget.reserved_tokens == 0
+    assert budget.spent_tokens == llm.estimate_tokens(messages)
@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import httpx
+from openai import APIConnectionError, APIStatusError
+
+from llm_respond import LLM, ClientPool, RetryPolicy
+from metrics import MetricsRegistry, metrics
+
+URL = "http://127.0.0.1/v1/chat/completions"
+
+
+class FlakyCompletions:
+    """Fails once with a 429 and once with a connection error, then answers"""
+
+    def __init__(self):
+        request = httpx.Request("POST", URL)
+        self.errors = [
+            APIStatusError("rate limited", response=httpx.Response(429, headers={"retry-after": "0"}, request=request), body=None),
+            APIConnectionError(request=request)
+        ]
+
+    def create(self, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="ok"))],
+            usage=SimpleNamespace(prompt_tokens=3, completion_tokens=1, prompt_tokens_details=None)
+        )
+
+
+def test_retries_by_status_and_connection_error_export():
+    pool = ClientPool("test-key")
+    pool._client = SimpleNamespace(chat=SimpleNamespace(completions=FlakyCompletions()), close=lambda: None)
+    llm = LLM("gpt-4.1-mini", pool=pool, retry=RetryPolicy(base_delay=0))
+
+    assert llm.chat([{"role": "user", "content": "hi"}]) == "ok"
+
+    retries = {c["labels"]["status"]: c["value"] for c in metrics.snapshot()["counters"] if c["name"] == "llm_retries_total"}
+    assert retries["429"] >= 1 and retries["connection"] >= 1
+    text = metrics.prometheus()
+    assert 'llm_retries_total{status="429"}' in text
+    assert 'llm_retries_total{status="connection"}' in text
+
+
+def test_label_values_are_compared_as_strings():
+    registry = MetricsRegistry()
+    registry.inc("requests_total", status=429)
+    registry.inc("requests_total", status="429")
+    registry.inc("requests_total", status="connection")
+    registry.observe("latency_seconds", 0.2, status=500)
+    registry.observe("latency_seconds", 0.3, status="connection")
+
+    counters = {c["labels"]["status"]: c["value"] for c in registry.snapshot()["counters"]}
+    assert counters == {"429": 2, "connection": 1}
+    assert 'requests_total{status="429"} 2' in registry.prometheus()
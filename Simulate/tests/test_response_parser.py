@@ -0,0 +1,62 @@
+import re
+import csv
+import asyncio
+
+from llm_respond import ChatResult, ClientPool
+from response_parser import STUDENT_ANSWER, TEACHER_RECOMMENDATION
+from school_test import StudentSchoolTestPipeline
+
+VALID = "<explanation> e </explanation>\n<answer> B </answer>\n<confidence> 60 </confidence>"
+MALFORMED = "<answer> B </answer>"
+
+
+def test_schema_rejects_missing_and_invalid_fields():
+    parsed = STUDENT_ANSWER.parse("<explanation> e </explanation>\n<confidence> 150 </confidence>")
+    assert parsed.errors == ["<answer> is missing", "<confidence> is 150, outside 0-100"]
+    assert parsed.values["answer"] == "" and parsed.values["confidence"] == "150"
+
+    parsed = STUDENT_ANSWER.parse("<explanation> two\nlines </explanation><answer> A </answer><confidence> about 70% </confidence>")
+    assert parsed.errors == []
+    assert parsed.values == {"explanation": "two\nlines", "answer": "A", "confidence": 70}
+
+    # <materials> 可以缺省
+    parsed = TEACHER_RECOMMENDATION.parse("<explanation> e </explanation><whether> Maybe </whether><number_of_materials> 2 </number_of_materials>")
+    assert parsed.errors == ["<whether> is 'Maybe', not one of yes/no"]
+
+
+def test_malformed_replies_are_reprompted_once(school_data):
+    pipeline = StudentSchoolTestPipeline(
+        ses="low", performance="50", model="gpt-4.1-mini", data_path=school_data, base_path=school_data,
+        pool=ClientPool("test-key"), progress=False, reprompt=1
+    )
+    corrections = []
+
+    async def reply(messages):
+        number = int(re.search(r"Question \d+\.(\d+)", messages[2]["content"]).group(1))
+        corrected = messages[-1]["content"].startswith("Your previous reply")
+        if corrected:
+            corrections.append(messages)
+        # 第 1 题始终不合格，第 2 题纠正后合格，其余一次合格
+        if number == 1 or (number == 2 and not corrected):
+            return ChatResult(MALFORMED, 10, 5, 0.01, False, 0)
+        return ChatResult(VALID, 10, 5, 0.01, False, 0)
+
+    pipeline.pre_student.achat_result = reply
+    asyncio.run(pipeline.aprocess_csv_stage(*pipeline.stages()[0]))
+
+    assert len(corrections) == 6
+    for messages in corrections:
+        assert messages[-2] == {"role": "assistant", "content": MALFORMED}
+        assert messages[-1]["content"] == STUDENT_ANSWER.correction(["<explanation> is missing", "<confidence> is missing"])
+
+    with open(pipeline.usage_file, "r", newline="", encoding="utf-8") as f:
+        usage = {row["question"]: row for row in csv.DictReader(f)}
+    assert (usage["1"]["reprompts"], usage["1"]["parse_errors"]) == ("1", "<explanation> is missing; <confidence> is missing")
+    assert (usage["2"]["reprompts"], usage["2"]["parse_errors"]) == ("1", "")
+    assert (usage["3"]["reprompts"], usage["3"]["parse_errors"]) == ("0", "")
+    # 两次调用的用量合并记在一行
+    assert usage["2"]["prompt_tokens"] == "20"
+
+    with open(pipeline.output_files["pre"], "r", newline="", encoding="utf-8") as f:
+        confidence = {row["question"]: row["llm_confidence"] for row in csv.DictReader(f)}
+    assert confidence["2"] == "60" and confidence["3"] == "60"
@@ -0,0 +1,69 @@
+import os
+import csv
+import asyncio
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from llm_respond import ChatResult, ClientPool
+from result_store import ResultStore
+from school_test import StudentSchoolTestPipeline
+
+
+async def fake_chat(messages):
+    if "<whether>" in "\n".join(m["content"] for m in messages):
+        reply = ("<explanation> e </explanation>\n<whether> Yes </whether>\n"
+                 "<number_of_materials> 1 </number_of_materials>\n<materials> slide 2: x </materials>")
+    else:
+        reply = f"<explanation> \"{messages[-1]['content']}\" </explanation>\n<answer> B </answer>\n<confidence> 55 </confidence>"
+    return ChatResult(reply, 10, 5, 0.01, False, 0)
+
+
+def run_two_stages(path, store):
+    pipeline = StudentSchoolTestPipeline(
+        ses="low", performance="50", model="gpt-4.1-mini", data_path=path, base_path=path,
+        pool=ClientPool("test-key"), progress=False, commit_every=4, result_store=store
+    )
+    for llm in (pipeline.pre_student, pipeline.recommendation, pipeline.post_student):
+        llm.achat_result = fake_chat
+
+    async def run():
+        for stage in pipeline.stages()[:2]:
+            await pipeline.aprocess_csv_stage(*stage)
+    asyncio.run(run())
+    return pipeline
+
+
+def read_rows(path):
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+def assert_store_matches_csvs(store, pipeline, path):
+    for key, stage in (("pre", "pre_with_llm"), ("rec", "recommend_with_llm")):
+        exported = os.path.join(path, f"exported_{stage}.csv")
+        assert store.export_csv(stage, "low", "50", exported)
+        assert read_rows(exported) == read_rows(pipeline.output_files[key])
+        assert store.cell(stage, "low", "50").num_rows == 18
+
+
+def test_round_trip_and_import_from_offset(school_data):
+    path = school_data
+    store = ResultStore(os.path.join(path, "results"))
+
+    pipeline = run_two_stages(path, store)
+    assert store.stages["recommend_with_llm"]["parent"] == "pre_with_llm"
+    assert "llm_answer" not in store.stages["recommend_with_llm"]["columns"]
+    assert_store_matches_csvs(store, pipeline, path)
+    assert store.read("pre_with_llm", lecture="2", question="3").num_rows == 1
+
+    # 结果库落后于 CSV（例如中断在两者之间）：重跑时从已存的偏移处补导入
+    fragments = store.fragments("pre_with_llm", "low", "50")
+    assert len(fragments) > 1
+    os.remove(fragments[-1][2])
+    covered = store.covered("pre_with_llm", "low", "50")
+    assert 0 < covered < fragments[-1][1]
+
+    pipeline = run_two_stages(path, ResultStore(os.path.join(path, "results")))
+    assert_store_matches_csvs(ResultStore(os.path.join(path, "results")), pipeline, path)
@@ -0,0 +1,164 @@
+import os
+import re
+import csv
+import asyncio
+
+from llm_respond import ChatResult, ClientPool, run_ordered
+from school_test import StudentSchoolTestPipeline
+from stage_executor import read_index
+
+KEYS = {(str(l), str(q)) for l in (1, 2, 3) for q in range(1, 7)}
+
+
+class InFlight:
+    """Counts concurrent calls and remembers the peak"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    async def __call__(self, seconds):
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+        await asyncio.sleep(seconds)
+        self.current -= 1
+
+
+def test_resolved_items_keep_order_without_taking_window_slots():
+    in_flight = InFlight()
+
+    async def handler(i):
+        await in_flight(0.01)
+        return "called", i
+
+    async def collect():
+        resolve = lambda i: ("resolved", i) if i % 2 else None
+        return [result async for result in run_ordered(range(20), handler, 4, resolve)]
+
+    results = asyncio.run(collect())
+    assert [i for _, i in results] == list(range(20))
+    assert [kind for kind, i in results if i % 2] == ["resolved"] * 10
+    assert in_flight.peak == 4
+
+
+def question(messages):
+    lecture, number = re.search(r"Question (\d+)\.(\d+)", "\n".join(m["content"] for m in messages)).groups()
+    return int(lecture), int(number)
+
+
+async def answer(messages):
+    return ChatResult("<explanation> e </explanation>\n<answer> B </answer>\n<confidence> 55 </confidence>", 10, 5, 0.01, False, 0)
+
+
+async def recommend(messages):
+    # 奇数题不推荐材料，后测试跳过这些行
+    whether = "No" if question(messages)[1] % 2 else "Yes"
+    reply = (f"<explanation> e </explanation>\n<whether> {whether} </whether>\n"
+             f"<number_of_materials> 1 </number_of_materials>\n<materials> slide 2: x </materials>")
+    return ChatResult(reply, 10, 5, 0.01, False, 0)
+
+
+def test_skipped_post_test_rows_do_not_reduce_rows_in_flight(school_data):
+    pipeline = StudentSchoolTestPipeline(
+        ses="low", performance="50", model="gpt-4.1-mini", data_path=school_data, base_path=school_data,
+        pool=ClientPool("test-key"), concurrency=4, progress=False
+    )
+    in_flight = InFlight()
+
+    async def slow_answer(messages):
+        await in_flight(0.02)
+        return await answer(messages)
+
+    pipeline.pre_student.achat_result = answer
+    pipeline.recommendation.achat_result = recommend
+    pipeline.post_student.achat_result = slow_answer
+
+    async def run():
+        for stage in pipeline.stages():
+            await pipeline.aprocess_csv_stage(*stage)
+    asyncio.run(run())
+
+    with open(pipeline.output_files["post"], "r", newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    assert [(int(r["lecture"]), int(r["question"])) for r in rows] == [(l, q) for l in (1, 2, 3) for q in range(1, 7)]
+    assert [r["post_decision"] for r in rows] == ["skip", "call"] * 9
+    # 跳过的行和慢行交替出现，在途的慢行数仍达到并发上限
+    assert in_flight.peak == 4
+
+
+class Answers:
+    """Pre-test replies that depend only on the question, recording which questions were asked"""
+
+    def __init__(self):
+        self.asked = []
+
+    async def __call__(self, messages):
+        lecture, number = question(messages)
+        self.asked.append((str(lecture), str(number)))
+        reply = f"<explanation> {lecture}.{number} </explanation>\n<answer> B </answer>\n<confidence> {10 * number} </confidence>"
+        return ChatResult(reply, 10, 5, 0.01, False, 0)
+
+
+def run_pre_test(path):
+    pipeline = StudentSchoolTestPipeline(
+        ses="low", performance="50", model="gpt-4.1-mini", data_path=path, base_path=path,
+        pool=ClientPool("test-key"), progress=False, commit_every=4
+    )
+    answers = Answers()
+    pipeline.pre_student.achat_result = answers
+    asyncio.run(pipeline.aprocess_csv_stage(*pipeline.stages()[0]))
+    return pipeline.output_files["pre"], answers
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_resume_after_crash_between_csv_flush_and_index_write(school_data):
+    output, _ = run_pre_test(school_data)
+    complete = read_bytes(output)
+    index = output + ".done"
+    with open(index, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    checkpoints = [i for i, line in enumerate(lines) if line.startswith("@")]
+    assert len(checkpoints) >= 3
+
+    # 崩溃现场：第三次提交的键已写进索引但检查点没写完；CSV 已刷盘到末尾，还多出半行
+    with open(index, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines[:checkpoints[2]]) + "\n")
+    with open(output, "ab") as f:
+        f.write(b'3,7,"torn')
+    committed, offset = read_index(index)
+    assert 0 < len(committed) < len(KEYS) and offset < len(complete)
+
+    _, answers = run_pre_test(school_data)
+    # 只重做未提交的行，CSV 与一次跑完的结果逐字节相同
+    assert sorted(answers.asked) == sorted(KEYS - committed)
+    assert read_bytes(output) == complete
+    assert read_index(index)[0] == KEYS
+
+
+def test_index_is_rebuilt_from_a_csv_written_without_one(school_data):
+    output, _ = run_pre_test(school_data)
+    complete = read_bytes(output)
+    os.remove(output + ".done")
+
+    _, answers = run_pre_test(school_data)
+    assert answers.asked == []
+    assert read_bytes(output) == complete
+    assert read_index(output + ".done") == (KEYS, len(complete))
+
+
+def test_prompt_fingerprint_follows_the_rendered_text(school_data):
+    def hashes(ses="low", **kwargs):
+        return StudentSchoolTestPipeline(
+            ses=ses, performance="50", model="gpt-4.1-mini", data_path=school_data, base_path=school_data,
+            pool=ClientPool("test-key"), progress=False, **kwargs
+        ).prompt_hashes
+
+    # v2 在高中学段渲染出与 v1 相同的文本，切换版本不会让已有输出报“提示词版本已变更”
+    v1 = {name: 1 for name in ["pre_rubric", "post_rubric", "teacher_recommendation_rubric"]}
+    assert hashes(prompt_versions=v1) == hashes()
+    changed = hashes(ses="high")
+    assert all(changed[stage] != hash for stage, hash in hashes().items())
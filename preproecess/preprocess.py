@@ -0,0 +1,231 @@
+import re
+import csv
+import json
+
+# 容器内部只需要关心引号、转义和括号
+STRUCTURE = re.compile(r'["\[\]{}]')
+STRING_END = re.compile(r'["\\]')
+SCALAR_END = re.compile(r'[\s,\]}]')
+WHITESPACE = re.compile(r"\s*")
+
+TEST_HEADER = ["lecture", "question", "contents", "slide", "correct_answer"]
+
+
+class JSONStream:
+    """
+    Incremental reader for large JSON files such as slide_all.json and test_all.json. Objects are
+    walked key by key: the caller decodes a value (value()), skips it without building it (skip())
+    or descends into it (keys()), so only the value being decoded is ever held in memory.
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Append another chunk to the buffer; False at the end of the input"""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def _compact(self):
+        if self.pos > self.chunk_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+
+    def _peek(self):
+        """Next non-whitespace character, or "" at the end of the input"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"expected {char!r} at offset {self.pos}, found {found!r}")
+        self.pos += 1
+
+    def _search(self, pattern, start):
+        """First match of pattern at or after start, reading more input as needed"""
+        while True:
+            match = pattern.search(self.buffer, start)
+            # 转义符在缓冲区末尾时，后面的字符还没读进来
+            if match is not None and not (match.group() == "\\" and match.end() == len(self.buffer)):
+                return match
+            start = len(self.buffer) if match is None else match.start()
+            if not self._fill():
+                if match is not None:
+                    return match
+                raise ValueError("unexpected end of JSON input")
+
+    def _string_end(self, start):
+        """Offset just past the string whose opening quote is at start"""
+        position = start + 1
+        while True:
+            match = self._search(STRING_END, position)
+            if match.group() == '"':
+                return match.end()
+            position = match.end() + 1
+
+    def _value_end(self):
+        """Offset just past the value starting at the current position"""
+        char = self._peek()
+        start = self.pos
+        if char == '"':
+            return self._string_end(start)
+        if char in "{[":
+            depth = 0
+            position = start
+            while True:
+                match = self._search(STRUCTURE, position)
+                token = match.group()
+                if token == '"':
+                    position = self._string_end(match.start())
+                    continue
+                depth += 1 if token in "{[" else -1
+                position = match.end()
+                if depth == 0:
+                    return position
+        while True:
+            match = SCALAR_END.search(self.buffer, start)
+            if match is not None:
+                return match.start()
+            if not self._fill():
+                return len(self.buffer)
+
+    def value(self):
+        """Decode the value at the current position"""
+        end = self._value_end()
+        value = json.loads(self.buffer[self.pos:end])
+        self.pos = end
+        self._compact()
+        return value
+
+    def skip(self):
+        """Move past the value at the current position without decoding it (its text is still buffered)"""
+        self.pos = self._value_end()
+        self._compact()
+
+    def keys(self):
+        """
+        Keys of the object at the current position. After each key the caller must consume its value
+        with value(), skip() or a nested keys() before asking for the next key.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(":")
+            yield key
+            char = self._peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or '}}' at offset {self.pos - 1}, found {char!r}")
+
+
+def iter_lectures(path, levels):
+    """(level, lecture key, lecture data) of the requested levels, decoding one lecture at a time"""
+    with open(path, "r", encoding="utf-8") as f:
+        stream = JSONStream(f)
+        for level in stream.keys():
+            if level not in levels:
+                # 按讲逐个跳过，内存里最多只有一讲的文本
+                for _ in stream.keys():
+                    stream.skip()
+                continue
+            for lecture_key in stream.keys():
+                yield level, lecture_key, stream.value()
+
+
+def level_prefix(level):
+    """File name prefix of a level ("high school" -> high_school)"""
+    return level.replace(" ", "_")
+
+
+class JSONObjectWriter:
+    """Writes {key: value, ...} one entry at a time, formatted like json.dump(indent=4, ensure_ascii=False)"""
+
+    def __init__(self, path):
+        self.f = open(path, "w", encoding="utf-8")
+        self.count = 0
+
+    def write(self, key, value):
+        entry = json.dumps(value, indent=4, ensure_ascii=False).replace("\n", "\n    ")
+        self.f.write(("{\n" if self.count == 0 else ",\n") + f"    {json.dumps(key, ensure_ascii=False)}: {entry}")
+        self.count += 1
+
+    def close(self):
+        self.f.write("\n}" if self.count else "{}")
+        self.f.close()
+
+
+def number_of(key):
+    """First number in a key such as "lecture 3" or "question 12", or the key itself"""
+    numbers = re.findall(r"\d+", key)
+    return numbers[0] if numbers else key
+
+
+def extract_slides(input_file, levels, data_path=""):
+    """Write <level>_slide_only.json for each requested level"""
+    writers = {level: JSONObjectWriter(data_path + f"{level_prefix(level)}_slide_only.json") for level in levels}
+    try:
+        for level, lecture_key, lecture_data in iter_lectures(input_file, levels):
+            writers[level].write(lecture_key, lecture_data)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    for level in levels:
+        print(f"已将 {level} 内容保存到 {data_path}{level_prefix(level)}_slide_only.json")
+
+
+def extract_tests(input_file, levels, data_path=""):
+    """Write <level>_test_only.json and <level>_test_only.csv for each requested level in the same pass"""
+    writers = {}
+    csv_files = {}
+    try:
+        for level in levels:
+            writers[level] = JSONObjectWriter(data_path + f"{level_prefix(level)}_test_only.json")
+            csv_files[level] = open(data_path + f"{level_prefix(level)}_test_only.csv", "w", newline="", encoding="utf-8")
+        csv_writers = {level: csv.writer(f) for level, f in csv_files.items()}
+        for writer in csv_writers.values():
+            writer.writerow(TEST_HEADER)
+
+        for level, lecture_key, questions in iter_lectures(input_file, levels):
+            writers[level].write(lecture_key, questions)
+            lecture_number = number_of(lecture_key)
+            for question_key, qinfo in questions.items():
+                csv_writers[level].writerow([
+                    lecture_number, number_of(question_key), qinfo.get("contents", ""),
+                    qinfo.get("slide", ""), qinfo.get("correct_answer", "")
+                ])
+    finally:
+        for writer in writers.values():
+            writer.close()
+        for f in csv_files.values():
+            f.close()
+    for level in levels:
+        print(f"已将 {level} 内容保存到 {data_path}{level_prefix(level)}_test_only.json 和 .csv")
+
+
+if __name__ == "__main__":
+    data_path = ""  # Adjust base path you create for dataset
+    # ClassroomSimulacra 中要提取的学段
+    levels = ["high school"]
+
+    extract_slides(data_path + "slide_all.json", levels, data_path)
+    extract_tests(data_path + "test_all.json", levels, data_path)